@@ -0,0 +1,187 @@
+import asyncio
+import collections
+
+import zmq
+import zmq.asyncio
+
+from gridvm.network.protocol.packet.packet import Packet
+from gridvm.network.protocol.packet.ptype  import PacketType
+
+from .nethandler import NetHandler
+
+# seconds a peer may take to take a request or answer it, a peer that is gone
+# or stuck would hold up everything else that is to be sent otherwise
+REPLY_TIMEOUT = 5.0
+
+class AsyncNetHandler(NetHandler):
+    """ NetHandler that runs as tasks on the event loop of its runtime,
+    instead of a thread of its own (see AsyncNetworkCommunication).
+
+    The receiver task handles each packet as soon as it arrives, the sender
+    task sends what the runtime queued once notified and awaits the ACKs,
+    so the loop keeps running interpreters meanwhile.
+    """
+    context_class = zmq.asyncio.Context
+    poller_class = zmq.asyncio.Poller
+
+    def __init__(self, comms, runtime_id, net_interface):
+        super().__init__(comms, runtime_id, net_interface)
+        self._replies = collections.deque()     # (addr, packet) the handlers send to peers
+        self._ready = None                      # asyncio.Event, set once there is something to send
+        self._peers = { }                       # (ip, port) -> REQ socket
+
+    async def run(self):
+        """ Called from Runtime on its event loop, returns once shut down """
+        self._ready = asyncio.Event()
+        self._ready.set()   # whatever was queued before
+        self.discover()
+
+        sender = asyncio.ensure_future(self._sender())
+        try:
+            await self._receiver()
+        finally:
+            sender.cancel()
+            self.logger.debug('Cleaning up...')
+            for sock in self._peers.values():
+                sock.close(linger=0)
+            self.cleanup()
+
+    def notify(self):
+        if self._ready is not None:
+            self._ready.set()
+
+    async def _receiver(self):
+        while not self._terminate:
+            try:
+                avail_socks = dict(await self.poller.poll(timeout=100))
+                for sock in avail_socks:
+                    if sock is self.rep_sock: # ROUTER socket
+                        addr, _, packet = await sock.recv_multipart()
+                        packet = Packet.from_bytes(packet)
+                    else: # SUB socket
+                        addr, packet = None, await sock.recv_pyobj()
+
+                    # Check if packet is the same we previously sent over multicast
+                    if packet in self.msend_packets:
+                        self.msend_packets.remove(packet)
+                        continue
+
+                    self.handle_packet(addr, packet)
+            except zmq.ZMQError as e:
+                self.logger.warning('Receiving failed: {}'.format(e))
+
+    async def _sender(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+
+            await self._send_replies()
+
+            for (runtime_id, packet) in self.batch_requests(self.comms.get_to_send_requests()):
+                try:
+                    await self._send_request(runtime_id, packet)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as ex:
+                    self._request_failed(runtime_id, packet, ex)
+
+                # the handlers may have replies to send meanwhile
+                await self._send_replies()
+
+    async def _send_replies(self):
+        while self._replies:
+            addr, packet = self._replies.popleft()
+            try:
+                await self._request(addr, packet)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self.logger.warning('Sending "{}" to {}:{} failed: {!r}'.format(
+                    PacketType(packet.type).name, addr[0], addr[1], ex
+                ))
+
+    def _request_failed(self, runtime_id, packet, ex):
+        """ A request of the runtime could not be sent, the peer may be gone """
+        self.logger.warning('Sending "{}" to {} failed: {!r}'.format(
+            PacketType(packet.type).name, runtime_id, ex
+        ))
+        if packet.type == PacketType.THREAD_MESSAGES:
+            # lost, they aren't in flight anymore
+            self.comms.messages_acked(runtime_id, packet['messages'])
+        elif packet.type == PacketType.MIGRATE_THREAD:
+            self.comms.migrate_thread_completed(False, packet, None)
+
+    async def _send_request(self, runtime_id, packet):
+        """ send_request(), awaiting the peer instead of blocking """
+        packet['ip'] = self.ip
+        packet['port'] = self.port
+        packet['runtime_id'] = self.runtime_id
+
+        if packet.type == PacketType.MIGRATE_THREAD:
+            await self._do_migration(runtime_id, packet)
+        elif runtime_id:
+            await self._request(self.runtimes[runtime_id], packet)
+            if packet.type == PacketType.THREAD_MESSAGES:
+                self.comms.messages_acked(runtime_id, packet['messages'])
+        else:
+            self.logger.debug('Sending packet "{}" over multicast'.format(
+                PacketType(packet.type).name
+            ))
+            self.send_packet(packet)
+
+    async def _do_migration(self, runtime_id, packet):
+        if runtime_id:
+            peers = [ runtime_id ]
+        else:
+            # Discard it somewhere
+            peers = [ peer for peer in self.runtimes if peer != self.runtime_id ]
+
+        response, location = None, None
+        for peer in peers:
+            if peer not in self.runtimes:
+                continue
+            try:
+                response = await self._request(self.runtimes[peer], packet)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self.logger.warning('Migrating to {} failed: {!r}'.format(peer, ex))
+                response = None
+            if response == PacketType.ACK:
+                location = peer
+                break
+
+        self.comms.migrate_thread_completed(response == PacketType.ACK, packet, location)
+
+    async def _request(self, addr, packet):
+        """ Send a packet to a peer over its REQ socket, returns the type of its reply """
+        ip, port = addr
+        self.logger.debug('Sending packet "{}" to {}:{}'.format(
+            PacketType(packet.type).name, ip, port
+        ))
+
+        # a REQ socket per peer, connected once
+        sock = self._peers.get(addr)
+        if sock is None:
+            sock = self._peers[addr] = self.context.socket(zmq.REQ)
+            sock.connect('tcp://{}:{}'.format(ip, port))
+
+        try:
+            await asyncio.wait_for(sock.send(packet.to_bytes()), REPLY_TIMEOUT)
+            rep_packet = Packet.from_bytes(await asyncio.wait_for(sock.recv(), REPLY_TIMEOUT))
+        except:
+            # stuck waiting for the reply otherwise
+            del self._peers[addr]
+            sock.close(linger=0)
+            raise
+
+        self.logger.debug('Got {}!'.format(PacketType(rep_packet.type).name))
+        return rep_packet.type
+
+    def send_packet(self, packet, addr=None):
+        if addr: # the sender task owns the REQ socket
+            self._replies.append( (addr, packet) )
+            self.notify()
+        else:
+            self.mpub_sock.send_pyobj(packet)
+            self.msend_packets.add(packet)
@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+import threading
 import zmq
 
 from gridvm.logger import get_logger
@@ -14,7 +15,31 @@ from .utils import get_if_address
 MULTICAST_IP = '224.0.0.1'
 MULTICAST_PORT = 19999
 
+# THREAD_MESSAGEs queued for the same peer go out as one THREAD_MESSAGES
+# packet, of up to this many messages. A batch holds what was queued by the
+# time the sender gets to it, so it is never held back waiting for more
+BATCH_MESSAGES = 256
+
+RECV_TYPES = [
+    PacketType.DISCOVER_REQ,        # Multicast
+    PacketType.DISCOVER_REP,        # Multicast
+    PacketType.DISCOVER_THREAD_REQ, # Multicast
+    PacketType.DISCOVER_THREAD_REP, # Local
+    PacketType.SHUTDOWN_REQ,        # Multicast
+    PacketType.SHUTDOWN_ACK,        # Local
+    PacketType.THREAD_MESSAGE,      # Local
+    PacketType.THREAD_MESSAGES,     # Local
+    PacketType.RUNTIME_STATUS_REQ,  # Local
+    PacketType.RUNTIME_PRINT_REQ,   # Local
+    PacketType.MIGRATE_THREAD,      # Local
+    PacketType.MIGRATION_COMPLETED, # Multicast
+    PacketType.RUNTIME_LOAD         # Multicast
+]
+
 class NetHandler:
+    context_class = zmq.Context
+    poller_class = zmq.Poller
+
     def __init__(self, comms, runtime_id, net_interface):
         self.runtime_id = runtime_id
         self.logger = get_logger('{}:NetHandler'.format(self.runtime_id), terminal_log_level='DEBUG')
@@ -33,7 +58,7 @@ class NetHandler:
         self.logger.debug('Local: {}.{}'.format(net_interface, self.ip))
 
         ################ SOCKETS #################
-        context = self.context = zmq.Context()
+        context = self.context = self.context_class()
 
         # Multicast PUB socket
         self.mpub_sock = context.socket(zmq.PUB)
@@ -52,68 +77,41 @@ class NetHandler:
         self.port = self.rep_sock.bind_to_random_port('tcp://*')
 
         # Setup polling mechanism
-        self.poller = zmq.Poller()
+        self.poller = self.poller_class()
         self.poller.register(self.msub_sock, zmq.POLLIN)
         self.poller.register(self.rep_sock, zmq.POLLIN)
+
+        # Waiting for a reply, see await_reply()
+        self.reply_poller = zmq.Poller()
+        self.reply_poller.register(self.req_sock, zmq.POLLIN)
+        self.reply_poller.register(self.rep_sock, zmq.POLLIN)
+
+        # Wakes up the poll of start(), see notify()
+        self.wake_sock = None
+        self._wake_send = None
+        self._wake_lock = threading.Lock()
         #########################################
 
         # Add myself to runtimes
         self.runtimes[self.runtime_id] = (self.ip, self.port)
 
-    def start(self):
-        # Send DISCOVER_REQ packet through multicast
-        self.logger.debug('Broadcast DISCOVER...')
-        pkt = make_packet(
-            PacketType.DISCOVER_REQ,
-            ip=self.ip,
-            port=self.port,
-            runtime_id=self.runtime_id
-        )
-        self.send_packet(pkt)
-
         self._terminate = False
         self._shutdown_req = False
-        while not self._terminate:
 
-            to_send = self.comms.get_to_send_requests()
-            for (runtime_id, packet) in to_send:
-                # Add required fields to packet
-                packet['ip'] = self.ip
-                packet['port'] = self.port
-                packet['runtime_id'] = self.runtime_id
+    def start(self):
+        self._open_wakeup()
 
-                if packet.type == PacketType.MIGRATE_THREAD:
-                    self.do_migration(runtime_id, packet)
-                    continue
+        # Send DISCOVER_REQ packet through multicast
+        self.discover()
 
-                # Send packet over network
-                if runtime_id:
-                    addr = self.runtimes[runtime_id]
-                    self.logger.debug('Sending packet "{}" to {}:{}'.format(
-                        PacketType(packet.type).name, *addr
-                    ))
-                    self.send_packet(packet, addr=addr)
-                else:
-                    self.logger.debug('Sending packet "{}" over multicast'.format(
-                        PacketType(packet.type).name
-                    ))
-                    self.send_packet(packet)
+        while not self._terminate:
+
+            for (runtime_id, packet) in self.batch_requests(self.comms.get_to_send_requests()):
+                self.send_request(runtime_id, packet)
 
             try:
                 #self.logger.debug('Waiting for packets...')
-                data = self.recv_packet([
-                    PacketType.DISCOVER_REQ,        # Multicast
-                    PacketType.DISCOVER_REP,        # Multicast
-                    PacketType.DISCOVER_THREAD_REQ, # Multicast
-                    PacketType.DISCOVER_THREAD_REP, # Local
-                    PacketType.SHUTDOWN_REQ,        # Multicast
-                    PacketType.SHUTDOWN_ACK,        # Local
-                    PacketType.THREAD_MESSAGE,      # Local
-                    PacketType.RUNTIME_STATUS_REQ,  # Local
-                    PacketType.RUNTIME_PRINT_REQ,   # Local
-                    PacketType.MIGRATE_THREAD,      # Local
-                    PacketType.MIGRATION_COMPLETED  # Multicast
-                ], timeout=100)
+                data = self.recv_packet(RECV_TYPES, timeout=100)
             except:
                 #self.shutdown()
                 continue
@@ -123,164 +121,265 @@ class NetHandler:
                 #self.print_runtimes()
                 continue
 
-            addr, packet = data
-            self.logger.debug('Got packet "{}" from {}'.format(
-                PacketType(packet.type).name, 'peer' if addr else 'multicast'
-            ))
-            self.logger.debug(packet)
+            self.handle_packet(*data)
+
+        self.logger.debug('Cleaning up...')
+        self.cleanup()
+
+    def notify(self):
+        """ Called from NetworkCommunication once it queued a packet to send,
+        wakes up start() to send it """
+        with self._wake_lock:
+            if self._wake_send is None:
+                return  # start() sends whatever is queued by then
+            try:
+                self._wake_send.send(b'', zmq.NOBLOCK)
+            except zmq.Again:
+                pass    # a wakeup is pending already
+
+    def _open_wakeup(self):
+        """ A PAIR of inproc sockets, notify() may be called from any thread
+        so it sends through its own socket, under the lock """
+        self.wake_sock = self.context.socket(zmq.PAIR)
+        self.wake_sock.bind('inproc://wakeup')
+        self.poller.register(self.wake_sock, zmq.POLLIN)
+
+        wake_send = self.context.socket(zmq.PAIR)
+        wake_send.connect('inproc://wakeup')
+        with self._wake_lock:
+            self._wake_send = wake_send
+
+    def _close_wakeup(self):
+        with self._wake_lock:
+            if self._wake_send is not None:
+                self._wake_send.close(linger=0)
+                self._wake_send = None
+        if self.wake_sock is not None:
+            self.wake_sock.close(linger=0)
+            self.wake_sock = None
+
+    def discover(self):
+        self.logger.debug('Broadcast DISCOVER...')
+        pkt = make_packet(
+            PacketType.DISCOVER_REQ,
+            ip=self.ip,
+            port=self.port,
+            runtime_id=self.runtime_id
+        )
+        self.send_packet(pkt)
 
-            ###### DEBUGGING #########
-            if packet.type == PacketType.PRINT:
-                self.print_runtimes()
+    def batch_requests(self, requests):
+        """ Coalesce the THREAD_MESSAGEs of requests into THREAD_MESSAGES
+        packets per peer, any other packet is sent after the messages queued
+        before it. Returns a list of (runtime_id, packet) """
+        batched = [ ]
+        batches = { }   # <runtime_id> -> [ (recv, sender, msg) ]
+        for (runtime_id, packet) in requests:
+            if packet.type != PacketType.THREAD_MESSAGE or not runtime_id:
+                self._add_batches(batched, batches)
+                batched.append( (runtime_id, packet) )
                 continue
 
-            # TODO: Split into functions
-            ip, port, runtime_id = packet['ip'], packet['port'], packet['runtime_id']
+            batch = batches.setdefault(runtime_id, [ ])
+            batch.append( (packet['recv'], packet['sender'], packet['msg']) )
+            if len(batch) >= BATCH_MESSAGES:
+                self._add_batches(batched, { runtime_id: batches.pop(runtime_id) })
 
-            if packet.type == PacketType.DISCOVER_REQ:
-                # Save runtime data & listen for later requests
-                self.runtimes[runtime_id] = (ip, port)
-                self.logger.info('Found peer @ {}:{}'.format(ip, port))
+        self._add_batches(batched, batches)
+        return batched
 
-                # Send runtime info
-                self.logger.debug('Sending runtime info @ {}:{}'.format(ip, port))
-                pkt = make_packet(
-                    PacketType.DISCOVER_REP,
-                    ip=self.ip,
-                    port=self.port,
-                    runtime_id=self.runtime_id
-                )
-                self.send_packet(pkt)
-
-            elif packet.type == PacketType.DISCOVER_REP:
-                # Save runtime data & listen for this runtime requests
-                self.runtimes[runtime_id] = (ip, port)
-                self.logger.info('Found peer @ {}:{}'.format(ip, port))
-
-            elif packet.type == PacketType.DISCOVER_THREAD_REQ:
-                # Check if I am responsible for this thread
-                thread_uid = packet['thread_uid']
-                if thread_uid in self.comms._fwd_table:
-                    pkt = make_packet(
-                        PacketType.DISCOVER_THREAD_REP,
-                        ip=self.ip,
-                        port=self.port,
-                        runtime_id=self.runtime_id,
-                        thread_uid=thread_uid,
-                        location=self.comms._fwd_table[thread_uid]
-                    )
-                    self.send_packet(pkt, addr=(ip, port))
-
-            elif packet.type == PacketType.DISCOVER_THREAD_REP:
-                thread_uid, location = packet['thread_uid'], packet['location']
-
-                self.comms.update_thread_location(thread_uid, location)
-
-                # Send ACK to sender
-                self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
-                self.send_reply(addr, PacketType.ACK)
+    def _add_batches(self, batched, batches):
+        for runtime_id, messages in batches.items():
+            batched.append( (runtime_id, make_packet(PacketType.THREAD_MESSAGES, messages=messages)) )
+        batches.clear()
 
-                self.comms._sem.release()
+    def send_request(self, runtime_id, packet):
+        """ Send a packet the runtime asked for, to runtime_id or over multicast if None """
+        # Add required fields to packet
+        packet['ip'] = self.ip
+        packet['port'] = self.port
+        packet['runtime_id'] = self.runtime_id
 
-            elif packet.type == PacketType.SHUTDOWN_REQ:
-                # Remove runtime entry
-                if runtime_id not in self.runtimes:
-                    self.logger.warning("Peer '{}:{}'[{}] not in my table".format(
-                        ip, port, runtime_id
-                    ))
-                    continue
+        if packet.type == PacketType.MIGRATE_THREAD:
+            self.do_migration(runtime_id, packet)
+            return
 
-                del self.runtimes[runtime_id]
+        # Send packet over network
+        if runtime_id:
+            addr = self.runtimes[runtime_id]
+            self.logger.debug('Sending packet "{}" to {}:{}'.format(
+                PacketType(packet.type).name, *addr
+            ))
+            self.send_packet(packet, addr=addr)
+            if packet.type == PacketType.THREAD_MESSAGES:
+                # a single ACK for the whole batch
+                self.comms.messages_acked(runtime_id, packet['messages'])
+        else:
+            self.logger.debug('Sending packet "{}" over multicast'.format(
+                PacketType(packet.type).name
+            ))
+            self.send_packet(packet)
+
+    def handle_packet(self, addr, packet):
+        """ Handle a packet that arrived, addr is None for multicast """
+        self.logger.debug('Got packet "{}" from {}'.format(
+            PacketType(packet.type).name, 'peer' if addr else 'multicast'
+        ))
+        self.logger.debug(packet)
+
+        ###### DEBUGGING #########
+        if packet.type == PacketType.PRINT:
+            self.print_runtimes()
+            return
 
-                # Send SHUTDOWN_ACK
-                self.logger.debug('Sending SHUTDOWN_ACK @ {}:{}'.format(ip, port))
+        # TODO: Split into functions
+        ip, port, runtime_id = packet['ip'], packet['port'], packet['runtime_id']
+
+        if packet.type == PacketType.DISCOVER_REQ:
+            # Save runtime data & listen for later requests
+            self.runtimes[runtime_id] = (ip, port)
+            self.logger.info('Found peer @ {}:{}'.format(ip, port))
+
+            # Send runtime info
+            self.logger.debug('Sending runtime info @ {}:{}'.format(ip, port))
+            pkt = make_packet(
+                PacketType.DISCOVER_REP,
+                ip=self.ip,
+                port=self.port,
+                runtime_id=self.runtime_id
+            )
+            self.send_packet(pkt)
+
+        elif packet.type == PacketType.DISCOVER_REP:
+            # Save runtime data & listen for this runtime requests
+            self.runtimes[runtime_id] = (ip, port)
+            self.logger.info('Found peer @ {}:{}'.format(ip, port))
+
+        elif packet.type == PacketType.DISCOVER_THREAD_REQ:
+            # Check if I am responsible for this thread
+            thread_uid = packet['thread_uid']
+            if thread_uid in self.comms._fwd_table:
                 pkt = make_packet(
-                    PacketType.SHUTDOWN_ACK,
+                    PacketType.DISCOVER_THREAD_REP,
                     ip=self.ip,
                     port=self.port,
-                    runtime_id=self.runtime_id
+                    runtime_id=self.runtime_id,
+                    thread_uid=thread_uid,
+                    location=self.comms._fwd_table[thread_uid]
                 )
                 self.send_packet(pkt, addr=(ip, port))
-                self.logger.info('Lost peer @ {}:{}'.format(ip, port))
-
-            elif packet.type == PacketType.SHUTDOWN_ACK:
-                if runtime_id not in self.runtimes:
-                    self.logger.warning("Peer '{}:{}'[{}] not in my table".format(
-                        ip, port, runtime_id
-                    ))
-                    continue
-
-                del self.runtimes[runtime_id]
-
-                # Send ACK to sender
-                self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
-                self.send_reply(addr, PacketType.ACK)
 
-                # Check if all runtimes have answered
-                if len(self.runtimes) <= 1:
-                    self.logger.info('Signaled all other runtimes!')
-                    self._terminate = True
-                    break
+        elif packet.type == PacketType.DISCOVER_THREAD_REP:
+            thread_uid, location = packet['thread_uid'], packet['location']
 
-            elif packet.type == PacketType.THREAD_MESSAGE:
-                # Check if this thread does not belong to this runtime
-                if (packet['recv'] not in self.comms._fwd_table or
-                    self.comms._fwd_table[ packet['recv'] ] != self.runtime_id):
-                        self.logger.debug('Replying RETRY @ {}:{}'.format(ip, port))
-                        self.send_reply(addr, PacketType.RETRY)
+            self.comms.update_thread_location(thread_uid, location)
 
-                # Signal that a new thread message has arrived
-                self.comms.add_thread_message(packet)
+            # Send ACK to sender
+            self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
+            self.send_reply(addr, PacketType.ACK)
 
-                # Send ACK to sender
-                self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
-                self.send_reply(addr, PacketType.ACK)
-
-            elif packet.type == PacketType.RUNTIME_STATUS_REQ:
-                # Signal that that the thread has changed state
-                self.comms.add_status_request(packet)
-
-                # Send ACK to sender
+        elif packet.type == PacketType.SHUTDOWN_REQ:
+            # Remove runtime entry
+            if runtime_id not in self.runtimes:
+                self.logger.warning("Peer '{}:{}'[{}] not in my table".format(
+                    ip, port, runtime_id
+                ))
+                return
+
+            del self.runtimes[runtime_id]
+
+            # Send SHUTDOWN_ACK
+            self.logger.debug('Sending SHUTDOWN_ACK @ {}:{}'.format(ip, port))
+            pkt = make_packet(
+                PacketType.SHUTDOWN_ACK,
+                ip=self.ip,
+                port=self.port,
+                runtime_id=self.runtime_id
+            )
+            self.send_packet(pkt, addr=(ip, port))
+            self.logger.info('Lost peer @ {}:{}'.format(ip, port))
+
+        elif packet.type == PacketType.SHUTDOWN_ACK:
+            # a peer shutting down too is gone already, it still waits for the ACK
+            self.runtimes.pop(runtime_id, None)
+
+            # Send ACK to sender
+            self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
+            self.send_reply(addr, PacketType.ACK)
+
+            # Check if all runtimes have answered
+            if len(self.runtimes) <= 1:
+                self.logger.info('Signaled all other runtimes!')
+                self._terminate = True
+
+        elif packet.type == PacketType.THREAD_MESSAGE:
+            # Check if this thread does not belong to this runtime
+            if (packet['recv'] not in self.comms._fwd_table or
+                self.comms._fwd_table[ packet['recv'] ] != self.runtime_id):
+                    self.logger.debug('Replying RETRY @ {}:{}'.format(ip, port))
+                    self.send_reply(addr, PacketType.RETRY)
+
+            # Signal that a new thread message has arrived
+            self.comms.add_thread_message(packet)
+
+            # Send ACK to sender
+            self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
+            self.send_reply(addr, PacketType.ACK)
+
+        elif packet.type == PacketType.THREAD_MESSAGES:
+            self.comms.add_thread_messages(packet['messages'])
+
+            # Send ACK to sender, for all of them
+            self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
+            self.send_reply(addr, PacketType.ACK)
+
+        elif packet.type == PacketType.RUNTIME_STATUS_REQ:
+            # Signal that that the thread has changed state
+            self.comms.add_status_request(packet)
+
+            # Send ACK to sender
+            self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
+            self.send_reply(addr, PacketType.ACK)
+
+        elif packet.type == PacketType.RUNTIME_PRINT_REQ:
+            # Signal that a new print request has arrived
+            self.comms.add_print_request(packet)
+
+            # Send ACK to sender
+            self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
+            self.send_reply(addr, PacketType.ACK)
+
+        elif packet.type == PacketType.MIGRATE_THREAD:
+            if self._shutdown_req: # Cannot accept more threads
+                self.logger.debug('Replying NACK @ {}:{}'.format(ip, port))
+                self.send_reply(addr, PacketType.NACK)
+            else:
                 self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
                 self.send_reply(addr, PacketType.ACK)
 
-            elif packet.type == PacketType.RUNTIME_PRINT_REQ:
-                # Signal that a new print request has arrived
-                self.comms.add_print_request(packet)
+            # Add new thread to runtime
+            packet['thread_uid'] = tuple(packet['thread_uid'])
+            self.comms.add_thread_migration(packet)
 
-                # Send ACK to sender
-                self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
-                self.send_reply(addr, PacketType.ACK)
+            # Broadcast MIGRATION_COMPLETED packet
+            mpacket = make_packet(
+                PacketType.MIGRATION_COMPLETED,
+                thread_uid=packet['thread_uid'],
+                ip=self.ip,
+                port=self.port,
+                runtime_id=self.runtime_id
+            )
+            self.send_packet(mpacket)
 
-            elif packet.type == PacketType.MIGRATE_THREAD:
-                if self._shutdown_req: # Cannot accept more threads
-                    self.logger.debug('Replying NACK @ {}:{}'.format(ip, port))
-                    self.send_reply(addr, PacketType.NACK)
-                else:
-                    self.logger.debug('Replying ACK @ {}:{}'.format(ip, port))
-                    self.send_reply(addr, PacketType.ACK)
-
-                # Add new thread to runtime
-                packet['thread_uid'] = tuple(packet['thread_uid'])
-                self.comms.add_thread_migration(packet)
-
-                # Broadcast MIGRATION_COMPLETED packet
-                mpacket = make_packet(
-                    PacketType.MIGRATION_COMPLETED,
-                    thread_uid=packet['thread_uid'],
-                    ip=self.ip,
-                    port=self.port,
-                    runtime_id=self.runtime_id
-                )
-                self.send_packet(mpacket)
+        elif packet.type == PacketType.MIGRATION_COMPLETED:
+            # Update thread location
+            thread_uid, new_location = packet['thread_uid'], packet['runtime_id']
+            self.comms.update_thread_location(thread_uid, new_location)
 
-            elif packet.type == PacketType.MIGRATION_COMPLETED:
-                # Update thread location
-                thread_uid, new_location = packet['thread_uid'], packet['runtime_id']
-                self.comms.update_thread_location(thread_uid, new_location)
+        elif packet.type == PacketType.RUNTIME_LOAD:
+            # A peer running the load balancer
+            self.comms.add_load_report(packet)
 
-        self.logger.debug('Cleaning up...')
-        self.cleanup()
 
     def do_migration(self, runtime_id, packet):
         if runtime_id:
@@ -321,10 +420,11 @@ class NetHandler:
             port=self.port,
             runtime_id=self.runtime_id
         )
-        self.comms._to_send.put((None, pkt))
+        self.comms.queue_packet(None, pkt)
 
     def cleanup(self):
         funcs = [
+            self._close_wakeup,
             self.mpub_sock.close,
             self.msub_sock.close,
             self.req_sock.close,
@@ -355,8 +455,7 @@ class NetHandler:
 
             # Await for ACK
             self.logger.debug('Waiting for ACK/WAIT from {}:{}'.format(ip, port))
-            rep_packet = self.req_sock.recv()
-            rep_packet = Packet.from_bytes(rep_packet)
+            rep_packet = self.await_reply()
             self.logger.debug('Got {}!'.format(PacketType(rep_packet.type).name))
 
             self.req_sock.disconnect(addr)
@@ -371,6 +470,18 @@ class NetHandler:
             self.msend_packets.add(packet)
 
 
+    def await_reply(self):
+        """ Wait for the reply of a peer to the REQ socket. Peers may be
+        waiting for our reply meanwhile, so serve them, all they need is
+        send_reply() """
+        while True:
+            avail_socks = dict( self.reply_poller.poll() )
+            if self.rep_sock in avail_socks:
+                addr, _, packet = self.rep_sock.recv_multipart()
+                self.handle_packet(addr, Packet.from_bytes(packet))
+            if self.req_sock in avail_socks:
+                return Packet.from_bytes(self.req_sock.recv())
+
     def send_reply(self, addr, rep_type):
         """ Reply to sender (@ addr) with ACK """
         rep_packet = make_packet(rep_type)
@@ -406,6 +517,10 @@ class NetHandler:
                         packet = Packet.from_bytes(packet)
                     elif sock is self.msub_sock: # SUB socket
                         addr, packet = None, sock.recv_pyobj()
+                    elif sock is self.wake_sock: # notify()
+                        while sock.poll(0):
+                            sock.recv()
+                        return None
                     else:
                         continue
 
@@ -21,12 +21,15 @@ class PacketType(IntEnum):
     SHUTDOWN_ACK = 0b00000101
 
     THREAD_MESSAGE =     0b00001000 # thread_uid, status
+    THREAD_MESSAGES =    0b00001010 # messages: [ recv, sender, msg ]
     RUNTIME_STATUS_REQ = 0b00011001 # thread_uid, status
     RUNTIME_PRINT_REQ  = 0b00011010 # thread_uid, msg
 
     MIGRATE_THREAD =      0b00100000 # thread_uid, thread
     MIGRATION_COMPLETED = 0b00100001 # thread_uid
 
+    RUNTIME_LOAD = 0b01000000 # load
+
     ACK   = 0b11111111
     RETRY = 0b11111110
     NACK  = 0b11111100
@@ -26,21 +26,17 @@ class Operation(object):
 
 @unique
 class OpCode(IntEnum):
-    LOAD_CONST   = 0
-    LOAD_VAR     = 1
-    STORE_VAR    = 2
-    LOAD_ARRAY   = 3
-    STORE_ARRAY  = 4
-    BUILD_VAR    = 5
-    BUILD_ARRAY  = 6
-    ROT_TWO      = 7
-    ARITHM       = 8
-    COMPARE_OP   = 9
-    JMP_IF_TRUE  = 10
-    JMP          = 11
-    SND          = 12
-    RCV          = 13
-    SLP          = 14
-    PRN          = 15
-    RET          = 16
-    NOP          = 17
+    LOAD_ARRAY   = 0
+    STORE_ARRAY  = 1
+    BUILD_VAR    = 2
+    BUILD_ARRAY  = 3
+    MOVE         = 4
+    ARITHM       = 5
+    CMP_JMP      = 6
+    JMP          = 7
+    SND          = 8
+    RCV          = 9
+    SLP          = 10
+    PRN          = 11
+    RET          = 12
+    NOP          = 13
@@ -2,19 +2,41 @@
 Simple Script bytecode obejct file representation
 """
 import pickle
+import hashlib
 
 from ..ss_exception import CodeObjectException
 
-MAGIC = 0xDA55C0DE
+MAGIC = 0xDA55C0DF # bumped with every instruction format change
 
 class SimpleScriptCodeObject(object):
+    """ A compiled SimpleScript program.
+
+    Code objects are immutable once built, so every thread running the same
+    source can share one. Per thread state lives in the interpreter.
+    """
     def __init__(self, instructions, consts, vars, arrays, labels, label_names):
-        self.instructions = instructions
-        self.co_vars = vars
-        self.co_consts = consts
-        self.co_arrays = arrays
-        self.co_labels = labels
+        self.instructions = tuple(instructions)
+        self.co_vars = tuple(vars)
+        self.co_consts = tuple(consts)
+        self.co_arrays = tuple(arrays)
+        self.co_labels = tuple(labels)
         self.co_label_names = label_names
+        self._digest = None
+
+    @property
+    def digest(self):
+        """ Content hash, equal code objects have equal digests """
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.to_bytes()).hexdigest()
+        return self._digest
+
+    def line_of(self, index):
+        """ Return the source line of the instruction at 'index'.
+        Only the first instruction of each statement carries its line """
+        for instruction in reversed(self.instructions[:index + 1]):
+            if instruction.line_no is not None:
+                return instruction.line_no
+        return None
 
     def to_bytes(self):
         code = (self.instructions,
@@ -1,5 +1,6 @@
 from .ss_bcode import  Operation, OpCode
 from .ss_code import SimpleScriptCodeObject
+from .ss_optimizer import optimize
 
 from ..parser.ss_ast import *
 from ..ss_exception import GeneratorException
@@ -23,6 +24,11 @@ BRANCH_CMP_OPS = {
 def invert_map(map):
     return { v:k for k,v in map.items() }
 
+def const_operand(index):
+    """ Constants live at the end of the register file, in reverse order,
+    so const 'index' is register -(index + 1) """
+    return -(index + 1)
+
 def list_from_mapping(map):
     inv = invert_map(map)
     return list( (inv[index] for index in range(len(inv))) )
@@ -31,6 +37,9 @@ def list_from_mapping(map):
 class SimpleScriptGenerator(object):
     """ Uses the same visitor pattern as ss_ast.NodeVisitor, but modified to
     build the bytecode version of the program simoultanously
+
+    The generated code is register based: visiting a value returns the
+    register (operand) that holds it, see const_operand()
     """
     def __init__(self):
         self.vars = { '$argc' : 0 }
@@ -41,6 +50,7 @@ class SimpleScriptGenerator(object):
         self.label_refs = list()
 
         self.next_line = 0
+        self.next_temp = 0
         self.instructions = []
 
     def add_instruction(self, *args):
@@ -56,8 +66,15 @@ class SimpleScriptGenerator(object):
         labels = []
         for index in self.label_refs:
             instruction = self.instructions[index]
+
+            # the label is the last item of a tuple argument
+            if isinstance(instruction.arg, tuple):
+                *operands, label = instruction.arg
+            else:
+                operands, label = None, instruction.arg
+
             try:
-                label_index = self.label_defs[instruction.arg]
+                label_index = self.label_defs[label]
 
                 try:
                     # more than one refs exist
@@ -67,22 +84,26 @@ class SimpleScriptGenerator(object):
                     labels.append(label_index)
                     index = len(labels) - 1
 
-                # replace the arg, with the table's index
-                instruction.arg = index
+                # replace the label, with the table's index
+                if operands is None:
+                    instruction.arg = index
+                else:
+                    instruction.arg = tuple(operands) + (index,)
             except KeyError:
                 # No such label
-                self.fail('Label "{}" not defined'.format(instruction.arg))
+                self.fail('Label "{}" not defined'.format(label))
 
         self.labels_table = labels
 
-    def generate(self, tree):
+    def generate(self, tree, level=0):
+        """ Generate the code object of a tree, optimized for 'level' """
         if not isinstance(tree, Program):
             raise ValueError('Bad tree')
         self.visit(tree)
 
         self._fix_labels()
 
-        return SimpleScriptCodeObject(
+        code = SimpleScriptCodeObject(
                 instructions=self.instructions,
                 consts=self.consts,
                 vars=list_from_mapping(self.vars),
@@ -90,6 +111,8 @@ class SimpleScriptGenerator(object):
                 labels=self.labels_table,
                 label_names=invert_map(self.label_defs))
 
+        return optimize(code, level)
+
     def visit(self, node):
         method = 'visit_' + node.__class__.__name__
         return getattr(self, method)(node)
@@ -104,24 +127,38 @@ class SimpleScriptGenerator(object):
         if node.label:
             self.label_defs[node.label.name] = next_index
 
+        # temporaries are local to a statement
+        self.next_temp = 0
         self.visit(node.op)
 
         self.instructions[next_index].line_no = node.coord-1
         self.next_line = node.coord - 1
 
+    def temp(self):
+        """ Returns a free temporary register """
+        name = '%{}'.format(self.next_temp)
+        self.next_temp += 1
+        if name not in self.vars:
+            self.vars[name] = len(self.vars)
+        return self.vars[name]
+
+    def temps(self):
+        return { index for name, index in self.vars.items() if name.startswith('%') }
+
+    def add_const(self, value):
+        try:
+            return self.consts.index(value)
+        except ValueError:
+            self.consts.append(value)
+            return len(self.consts) - 1
+
     def visit_VarAccess(self, node):
         if node.var not in self.vars:
             self.fail('Undefined variable: ' + node.var)
-        else:
-            self.add_instruction(OpCode.LOAD_VAR, self.vars[node.var])
+        return self.vars[node.var]
 
     def visit_Constant(self, node):
-        try:
-            index = self.consts.index(node.value)
-        except ValueError:
-            self.consts.append(node.value)
-            index = len(self.consts) - 1
-        self.add_instruction(OpCode.LOAD_CONST, index)
+        return const_operand(self.add_const(node.value))
 
     def visit_ArrayAccess(self, node):
         if node.array not in self.arrays:
@@ -129,54 +166,74 @@ class SimpleScriptGenerator(object):
 
         #visit child to load index
         name, child = node.children()[0]
-        self.visit(child)
+        index = self.visit(child)
 
-        self.add_instruction(OpCode.LOAD_ARRAY, self.arrays[node.array])
+        register = self.temp()
+        self.add_instruction(OpCode.LOAD_ARRAY, (register, self.arrays[node.array], index))
+        return register
 
     def build_var(self, node):
+        """ Returns the register of the var """
         if node.var not in self.vars:
             # Build if needed
             self.vars[node.var] = len(self.vars)
             self.add_instruction(OpCode.BUILD_VAR, len(self.vars) - 1)
 
-        self.add_instruction(OpCode.STORE_VAR, self.vars[node.var])
+        return self.vars[node.var]
 
     def build_array(self, node):
+        """ Returns the (array, index operand) of an array element """
         if node.array not in self.arrays:
             # Build if needed
             self.arrays[node.array] = len(self.arrays)
             self.add_instruction(OpCode.BUILD_ARRAY, len(self.arrays) - 1)
 
-        #same as access, but do a store instead
-        self.visit_ArrayAccess(node)
-        self.instructions.pop()
-        self.add_instruction(OpCode.STORE_ARRAY, self.arrays[node.array])
-
-    def build(self, node):
-        method = 'build_' + node.__class__.__name__[:-6].lower()
-        return getattr(self, method)(node)
+        name, child = node.children()[0]
+        return self.arrays[node.array], self.visit(child)
+
+    def store(self, node, emit):
+        """ Store into a var or an array element. 'emit' is called with
+        the destination register and should add the instruction writing it """
+        if isinstance(node, ArrayAccess):
+            register = self.temp()
+            emit(register)
+            array, index = self.build_array(node)
+            self.add_instruction(OpCode.STORE_ARRAY, (array, index, register))
+        else:
+            emit(self.build_var(node))
 
     def visit_SetOperation(self, node):
-        self.visit(node.var2)
-        #stack has our value
-
-        self.build(node.var1)
+        src = self.visit(node.var2)
+        last = self.instructions[-1] if self.instructions else None
+
+        if isinstance(node.var1, ArrayAccess):
+            array, index = self.build_array(node.var1)
+            self.add_instruction(OpCode.STORE_ARRAY, (array, index, src))
+            return
+
+        dst = self.build_var(node.var1)
+        if (src in self.temps() and last.opcode == OpCode.LOAD_ARRAY
+                and last.arg[0] == src):
+            # load straight into the var
+            last.arg = (dst,) + last.arg[1:]
+        else:
+            self.add_instruction(OpCode.MOVE, (dst, src))
 
     def visit_ArithmOperation(self, node):
-        self.visit(node.var2)
-        self.visit(node.var3)
+        var2 = self.visit(node.var2)
+        var3 = self.visit(node.var3)
 
-        self.add_instruction(OpCode.ARITHM, ARITHM_TABLE[node.op])
-
-        self.build(node.var1)
+        op = ARITHM_TABLE[node.op]
+        self.store(node.var1,
+                lambda dst: self.add_instruction(OpCode.ARITHM, (op, dst, var2, var3)))
 
     def visit_BranchOperation(self, node):
         if node.op != 'BRA':
-            self.visit(node.var1)
-            self.visit(node.var2)
+            var1 = self.visit(node.var1)
+            var2 = self.visit(node.var2)
 
-            self.add_instruction(OpCode.COMPARE_OP, BRANCH_CMP_OPS[node.op[1:]])
-            self.add_instruction(OpCode.JMP_IF_TRUE, node.label.name)
+            self.add_instruction(OpCode.CMP_JMP,
+                    (BRANCH_CMP_OPS[node.op[1:]], var1, var2, node.label.name))
         else:
             # jump always
             self.add_instruction(OpCode.JMP, node.label.name)
@@ -187,42 +244,23 @@ class SimpleScriptGenerator(object):
     def visit_NetOperation(self, node):
         # WARN: thread id is var1
         if node.op == 'SND':
-            self.visit(node.var1)
-            self.visit(node.var2)
-            self.add_instruction(OpCode.SND)
+            to = self.visit(node.var1)
+            what = self.visit(node.var2)
+            self.add_instruction(OpCode.SND, (to, what))
         else:
-            self.visit(node.var1)
-            self.add_instruction(OpCode.RCV)
-            self.build(node.var2)
+            sender = self.visit(node.var1)
+            self.store(node.var2,
+                    lambda dst: self.add_instruction(OpCode.RCV, (dst, sender)))
 
     def visit_SleepOperation(self, node):
-        self.visit(node.var1)
-        self.add_instruction(OpCode.SLP)
+        self.add_instruction(OpCode.SLP, self.visit(node.var1))
 
     def visit_PrintOperation(self, node):
-        try:
-            # avoid duplicate strings in consts
-            value = self.consts.index(node.formatter)
-        except ValueError:
-            self.consts.append(node.formatter)
-            value = len(self.consts) - 1
+        # avoid duplicate strings in consts
+        formatter = self.add_const(node.formatter)
 
-        try:
-            index = self.consts.index(value)
-        except ValueError:
-            self.consts.append(value)
-            index = len(self.consts) - 1
-
-        self.add_instruction(OpCode.LOAD_CONST, index)
-
-        vector = node.vect or [] # can be None
-        for name, child in node.children():
-            self.visit(child)
-
-        self.add_instruction(OpCode.PRN, len(vector))
+        vector = tuple( self.visit(child) for name, child in node.children() )
+        self.add_instruction(OpCode.PRN, (formatter, vector))
 
     def visit_Ret(self, node):
         self.add_instruction(OpCode.RET)
-
-
-
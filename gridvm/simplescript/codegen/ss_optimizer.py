@@ -0,0 +1,428 @@
+"""
+Simple Script bytecode optimizer
+"""
+import operator
+
+from .ss_bcode import Operation, OpCode
+from .ss_code import SimpleScriptCodeObject
+
+DEFAULT_LEVEL = 1
+MAX_ROUNDS = 8      # rounds of the passes, they feed each other
+
+# Level 1 only rewrites single instructions, level 2 also uses data flow
+LEVEL_1_PASSES = ( 'remove_nops', 'fold_constants', 'thread_jumps' )
+LEVEL_2_PASSES = LEVEL_1_PASSES + ( 'propagate_copies', 'eliminate_dead_stores',
+        'remove_unreachable' )
+
+# same semantics as the interpreter's tables
+ARITHM_FOLD_TABLE = [
+        operator.add,
+        operator.sub,
+        operator.mul,
+        operator.truediv,
+        operator.mod
+        ]
+
+COMP_FOLD_TABLE = [
+        operator.gt,
+        operator.ge,
+        operator.lt,
+        operator.le,
+        operator.eq
+        ]
+
+# ARITHM ops that can't raise for numbers, so dead ones can be dropped
+SAFE_ARITHM = { 0, 1, 2 }
+
+
+def optimize(code, level=DEFAULT_LEVEL):
+    """ Return an optimized copy of a code object, level 0 returns it as is """
+    if level <= 0:
+        return code
+    return SimpleScriptOptimizer(code, level).optimize()
+
+
+def reads(instruction):
+    """ Registers read by an instruction, including constants """
+    opcode, arg = instruction.opcode, instruction.arg
+    if opcode == OpCode.LOAD_ARRAY:
+        return (arg[2],)
+    elif opcode == OpCode.STORE_ARRAY:
+        return (arg[1], arg[2])
+    elif opcode == OpCode.MOVE:
+        return (arg[1],)
+    elif opcode == OpCode.ARITHM:
+        return (arg[2], arg[3])
+    elif opcode == OpCode.CMP_JMP:
+        return (arg[1], arg[2])
+    elif opcode == OpCode.SND:
+        return arg
+    elif opcode == OpCode.RCV:
+        return (arg[1],)
+    elif opcode == OpCode.SLP:
+        return (arg,)
+    elif opcode == OpCode.PRN:
+        return arg[1]
+    return ()
+
+def writes(instruction):
+    """ Register written by an instruction, or None """
+    opcode, arg = instruction.opcode, instruction.arg
+    if opcode in (OpCode.LOAD_ARRAY, OpCode.MOVE, OpCode.RCV):
+        return arg[0]
+    elif opcode == OpCode.ARITHM:
+        return arg[1]
+    return None
+
+def replace_reads(instruction, mapping):
+    """ Return the instruction with its read registers replaced """
+    opcode, arg = instruction.opcode, instruction.arg
+    get = lambda register: mapping.get(register, register)
+
+    if opcode == OpCode.LOAD_ARRAY:
+        arg = (arg[0], arg[1], get(arg[2]))
+    elif opcode == OpCode.STORE_ARRAY:
+        arg = (arg[0], get(arg[1]), get(arg[2]))
+    elif opcode == OpCode.MOVE:
+        arg = (arg[0], get(arg[1]))
+    elif opcode == OpCode.ARITHM:
+        arg = (arg[0], arg[1], get(arg[2]), get(arg[3]))
+    elif opcode == OpCode.CMP_JMP:
+        arg = (arg[0], get(arg[1]), get(arg[2]), arg[3])
+    elif opcode == OpCode.SND:
+        arg = (get(arg[0]), get(arg[1]))
+    elif opcode == OpCode.RCV:
+        arg = (arg[0], get(arg[1]))
+    elif opcode == OpCode.SLP:
+        arg = get(arg)
+    elif opcode == OpCode.PRN:
+        arg = (arg[0], tuple(get(register) for register in arg[1]))
+    else:
+        return instruction
+
+    return Operation(opcode, arg, instruction.line_no)
+
+
+class SimpleScriptOptimizer(object):
+    """ Runs the passes of a level over a code object.
+
+    Passes work on a list of instructions where jump targets are absolute
+    indexes instead of label table indexes. A removed instruction is replaced
+    by None, and the list is compacted once all passes are done.
+    """
+    def __init__(self, code, level):
+        self.code = code
+        self.passes = LEVEL_1_PASSES if level == 1 else LEVEL_2_PASSES
+        self.consts = list(code.co_consts)
+
+        # resolve labels
+        labels = code.co_labels
+        self.instructions = [ ]
+        for instruction in code.instructions:
+            opcode, arg = instruction.opcode, instruction.arg
+            if opcode == OpCode.JMP:
+                arg = labels[arg]
+            elif opcode == OpCode.CMP_JMP:
+                arg = arg[:-1] + (labels[arg[-1]],)
+            self.instructions.append(Operation(opcode, arg, instruction.line_no))
+
+    def optimize(self):
+        for round in range(MAX_ROUNDS):
+            changed = False
+            for name in self.passes:
+                changed |= getattr(self, name)()
+            if not changed:
+                break
+
+        return self._build()
+
+    ##### PASSES #####
+    # Each pass returns True if it changed something
+
+    def remove_nops(self):
+        """ BUILD_VAR does nothing at runtime """
+        changed = False
+        for index, instruction in self._live_instructions():
+            if instruction.opcode in (OpCode.BUILD_VAR, OpCode.NOP):
+                self._remove(index)
+                changed = True
+        return changed
+
+    def fold_constants(self):
+        changed = False
+        for index, instruction in self._live_instructions():
+            opcode, arg = instruction.opcode, instruction.arg
+            if opcode == OpCode.ARITHM:
+                op, dst, var1, var2 = arg
+                if not (self._is_number(var1) and self._is_number(var2)):
+                    continue
+                try:
+                    value = ARITHM_FOLD_TABLE[op](self._const(var1), self._const(var2))
+                except ZeroDivisionError:
+                    continue # leave it to fail at runtime
+                self._replace(index, OpCode.MOVE, (dst, self._add_const(value)))
+                changed = True
+
+            elif opcode == OpCode.CMP_JMP:
+                op, var1, var2, target = arg
+                if not (self._is_number(var1) and self._is_number(var2)):
+                    continue
+                if COMP_FOLD_TABLE[op](self._const(var1), self._const(var2)):
+                    self._replace(index, OpCode.JMP, target)
+                else:
+                    self._remove(index)
+                changed = True
+
+            elif opcode == OpCode.MOVE and arg[0] == arg[1]:
+                self._remove(index)
+                changed = True
+
+        return changed
+
+    def thread_jumps(self):
+        """ Jumps to unconditional jumps go straight to the final target,
+        jumps to the next instruction are removed """
+        changed = False
+        for index, instruction in self._live_instructions():
+            if instruction.opcode not in (OpCode.JMP, OpCode.CMP_JMP):
+                continue
+
+            target = self._target(instruction)
+            final = self._final_target(target)
+            if final != target:
+                self._retarget(index, final)
+                changed = True
+
+            if self._next(index) == final:
+                self._remove(index)
+                changed = True
+
+        return changed
+
+    def propagate_copies(self):
+        """ Reads of a copied register read the original while neither
+        is written, within a basic block """
+        changed = False
+        leaders = self._leaders()
+        copies = { }
+
+        for index, instruction in self._live_instructions():
+            if index in leaders:
+                copies = { }
+
+            if copies:
+                new = replace_reads(instruction, copies)
+                if new.arg != instruction.arg:
+                    self.instructions[index] = instruction = new
+                    changed = True
+
+            dst = writes(instruction)
+            if dst is not None:
+                copies = { copy: orig for copy, orig in copies.items()
+                        if dst not in (copy, orig) }
+                if instruction.opcode == OpCode.MOVE and instruction.arg[1] != dst:
+                    copies[dst] = instruction.arg[1]
+
+            if self._ends_block(instruction):
+                copies = { }
+
+        return changed
+
+    def eliminate_dead_stores(self):
+        """ Remove writes to registers that are never read afterwards """
+        changed = False
+        for index, live_out in self._liveness().items():
+            instruction = self.instructions[index]
+            dst = writes(instruction)
+            if dst is None or dst in live_out:
+                continue
+
+            opcode = instruction.opcode
+            if opcode == OpCode.MOVE or (opcode == OpCode.ARITHM
+                    and instruction.arg[0] in SAFE_ARITHM):
+                self._remove(index)
+                changed = True
+
+        return changed
+
+    def remove_unreachable(self):
+        changed = False
+        reachable = set()
+        pending = [ self._next(-1) ]
+        while pending:
+            index = pending.pop()
+            if index is None or index in reachable:
+                continue
+            reachable.add(index)
+            pending.extend(self._successors(index))
+
+        for index, instruction in self._live_instructions():
+            if index not in reachable:
+                self._remove(index)
+                changed = True
+
+        return changed
+
+    ##### ANALYSIS #####
+    def _live_instructions(self):
+        """ Yields the (index, instruction) pairs not removed yet, passes
+        may change the list while iterating """
+        for index in range(len(self.instructions)):
+            instruction = self.instructions[index]
+            if instruction is not None:
+                yield index, instruction
+
+    def _next(self, index):
+        """ Index of the first instruction after 'index', or None """
+        for index in range(index + 1, len(self.instructions)):
+            if self.instructions[index] is not None:
+                return index
+        return None
+
+    def _resolve(self, target):
+        """ A removed target falls through to the next instruction """
+        if target < len(self.instructions) and self.instructions[target] is not None:
+            return target
+        return self._next(target)
+
+    def _target(self, instruction):
+        if instruction.opcode == OpCode.JMP:
+            return self._resolve(instruction.arg)
+        return self._resolve(instruction.arg[-1])
+
+    def _final_target(self, target):
+        seen = set()
+        while target is not None and target not in seen:
+            seen.add(target)
+            instruction = self.instructions[target]
+            if instruction.opcode != OpCode.JMP:
+                break
+            target = self._target(instruction)
+        return target
+
+    def _successors(self, index):
+        instruction = self.instructions[index]
+        opcode = instruction.opcode
+        if opcode == OpCode.RET:
+            return [ ]
+        elif opcode == OpCode.JMP:
+            return [ self._target(instruction) ]
+        elif opcode == OpCode.CMP_JMP:
+            return [ self._target(instruction), self._next(index) ]
+        return [ self._next(index) ]
+
+    def _ends_block(self, instruction):
+        return instruction.opcode in (OpCode.JMP, OpCode.CMP_JMP, OpCode.RET)
+
+    def _leaders(self):
+        leaders = set()
+        for index, instruction in self._live_instructions():
+            if instruction.opcode in (OpCode.JMP, OpCode.CMP_JMP):
+                leaders.add(self._target(instruction))
+        return leaders
+
+    def _liveness(self):
+        """ Returns the registers live after each instruction """
+        live_in = { index: set() for index, _ in self._live_instructions() }
+        live_out = { index: set() for index in live_in }
+
+        changed = True
+        while changed:
+            changed = False
+            for index in reversed(list(live_in)):
+                out = set()
+                for successor in self._successors(index):
+                    if successor is not None:
+                        out |= live_in[successor]
+
+                instruction = self.instructions[index]
+                in_ = set(out)
+                dst = writes(instruction)
+                if dst is not None:
+                    in_.discard(dst)
+                in_.update(register for register in reads(instruction) if register >= 0)
+
+                if out != live_out[index] or in_ != live_in[index]:
+                    live_out[index], live_in[index] = out, in_
+                    changed = True
+
+        return live_out
+
+    ##### HELPERS #####
+    def _const(self, register):
+        return self.consts[-register - 1]
+
+    def _is_number(self, register):
+        return register < 0 and type(self._const(register)) in (int, float)
+
+    def _add_const(self, value):
+        for index, const in enumerate(self.consts):
+            if type(const) is type(value) and const == value:
+                break
+        else:
+            self.consts.append(value)
+            index = len(self.consts) - 1
+        return -(index + 1) # see ss_generator.const_operand
+
+    def _replace(self, index, opcode, arg):
+        self.instructions[index] = Operation(int(opcode), arg, self.instructions[index].line_no)
+
+    def _retarget(self, index, target):
+        instruction = self.instructions[index]
+        if instruction.opcode == OpCode.JMP:
+            self._replace(index, OpCode.JMP, target)
+        else:
+            self._replace(index, OpCode.CMP_JMP, instruction.arg[:-1] + (target,))
+
+    def _remove(self, index):
+        line_no = self.instructions[index].line_no
+        self.instructions[index] = None
+
+        # the line moves to the rest of the statement, if any
+        following = self._next(index)
+        if (line_no is not None and following is not None
+                and self.instructions[following].line_no is None):
+            instruction = self.instructions[following]
+            self.instructions[following] = Operation(instruction.opcode, instruction.arg, line_no)
+
+    def _build(self):
+        """ Compact the instructions and rebuild the label table """
+        # a removed instruction maps to the one that replaces it
+        new_index = { }
+        count = 0
+        for index, instruction in enumerate(self.instructions):
+            new_index[index] = count
+            if instruction is not None:
+                count += 1
+        new_index[len(self.instructions)] = count
+
+        instructions = [ ]
+        labels = [ ]
+        for instruction in self.instructions:
+            if instruction is None:
+                continue
+
+            opcode, arg = instruction.opcode, instruction.arg
+            if opcode in (OpCode.JMP, OpCode.CMP_JMP):
+                target = new_index[arg if opcode == OpCode.JMP else arg[-1]]
+                if target not in labels:
+                    labels.append(target)
+                label = labels.index(target)
+                arg = label if opcode == OpCode.JMP else arg[:-1] + (label,)
+
+            instructions.append(Operation(opcode, arg, instruction.line_no))
+
+        if count in labels or not instructions:
+            # something jumps past the end, keep running into RET's error
+            instructions.append(Operation(OpCode.NOP.value))
+
+        label_names = { new_index[index]: name
+                for index, name in self.code.co_label_names.items() }
+
+        return SimpleScriptCodeObject(
+                instructions=instructions,
+                consts=self.consts,
+                vars=self.code.co_vars,
+                arrays=self.code.co_arrays,
+                labels=labels,
+                label_names=label_names)
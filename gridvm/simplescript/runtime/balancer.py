@@ -0,0 +1,191 @@
+"""
+Moves threads from busy runtimes to idle ones
+"""
+import time
+from collections import deque
+
+from .inter import InterpreterStatus
+
+BALANCE_INTERVAL = 1.0      # seconds between two load reports
+LOAD_REPORT_TTL = 3.0       # seconds a peer's report stays valid
+QUEUED_PER_THREAD = 100     # pending messages that weigh as much as a runnable thread
+
+# Imbalance, in runnable threads per worker, that starts balancing and the
+# one that stops it. Balancing stops well before the loads are equal, so
+# the last move doesn't make the peer the busy one.
+START_IMBALANCE = 2.0
+STOP_IMBALANCE = 1.0
+
+MIGRATION_RATE = 0.5        # migrations per second, on average
+MIGRATION_BURST = 2         # migrations in a row, at most
+THREAD_COOLDOWN = 30.0      # seconds a thread stays put once it moved
+DECISION_HISTORY = 20
+
+
+class LoadBalancer(object):
+    """ Compares the load of a runtime with the load its peers report, and
+    migrates its runnable threads to the least loaded peer.
+
+    Every BALANCE_INTERVAL seconds the runtime multicasts its load, the
+    threads that can run, the instructions per second they ran and the
+    messages waiting to be received, and looks at the loads of its peers.
+    Only peers that balance too report their load, so threads only move
+    between them, and never to a peer at its capacity.
+
+    Balancing starts once the runtime has START_IMBALANCE more runnable
+    threads per worker than a peer, and goes on until the difference drops
+    to STOP_IMBALANCE. Migrations are capped to MIGRATION_RATE a second, and
+    a thread that moved stays put for THREAD_COOLDOWN seconds.
+    """
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.enabled = False
+        self.decisions = deque(maxlen=DECISION_HISTORY)    # (time, text)
+
+        self._balancing = False
+        self._next_tick = None
+        self._tokens = MIGRATION_BURST
+        self._ips = 0           # instructions per second, since the last tick
+        self._last_steps = 0
+        self._last_tick = None
+        self._moved = { }       # thread_uid -> when it moved
+        self._sent_at = { }     # runtime_id -> when we last migrated a thread to it
+
+    def start(self):
+        self.enabled = True
+        self._next_tick = time.time()
+
+    def stop(self):
+        self.enabled = False
+        self._balancing = False
+        self._next_tick = None
+
+    def next_tick(self):
+        """ When the balancer has to run next, or None if it's stopped """
+        return self._next_tick
+
+    def moved(self, thread_uid):
+        """ Called from Runtime when a thread arrives or leaves """
+        self._moved[thread_uid] = time.time()
+
+    def settled(self, thread_uid):
+        """ Whether a thread stayed put for THREAD_COOLDOWN seconds """
+        moved_at = self._moved.get(thread_uid)
+        return moved_at is None or time.time() - moved_at >= THREAD_COOLDOWN
+
+    def load(self):
+        """ The load of our runtime """
+        runtime = self.runtime
+        return {
+            'runnable': len(self._runnable_threads()),
+            'ips': self._ips,
+            'queued': runtime._comms.pending_messages(),
+            'workers': runtime._pool.count if runtime._pool else 1,
+            'threads': sum(len(threads) for threads in runtime._programs.values()),
+            'capacity': runtime.capacity,
+        }
+
+    @staticmethod
+    def score(load):
+        """ Runnable threads per worker, the ones the pending messages add up to included """
+        return (load['runnable'] + load['queued'] / QUEUED_PER_THREAD) / load['workers']
+
+    def tick(self):
+        """ Called from Runtime, reports our load and balances if it's time """
+        now = time.time()
+        if not self.enabled or now < self._next_tick:
+            return
+        self._next_tick = now + BALANCE_INTERVAL
+
+        steps = self.runtime.steps()
+        if self._last_tick is not None:
+            self._ips = int((steps - self._last_steps) / (now - self._last_tick))
+        self._last_steps, self._last_tick = steps, now
+
+        load = self.load()
+        comms = self.runtime._comms
+        comms.send_load_report(load)
+
+        self._tokens = min(MIGRATION_BURST, self._tokens + MIGRATION_RATE * BALANCE_INTERVAL)
+        for thread_uid, moved_at in list(self._moved.items()):
+            if now - moved_at >= THREAD_COOLDOWN:
+                del self._moved[thread_uid]
+
+        runtimes = comms.get_runtimes()
+        # a report from before our last migration to a peer doesn't count it
+        peers = { runtime_id: dict(peer_load)
+                for runtime_id, (received_at, peer_load) in comms.get_load_reports().items()
+                if runtime_id in runtimes and now - received_at < LOAD_REPORT_TTL
+                and received_at > self._sent_at.get(runtime_id, 0) and not self._full(peer_load) }
+        if not peers:
+            self._balancing = False
+            return
+
+        target = min(peers, key=lambda runtime_id: self.score(peers[runtime_id]))
+        imbalance = self.score(load) - self.score(peers[target])
+        if not self._balancing:
+            if imbalance < START_IMBALANCE or load['runnable'] <= load['workers']:
+                return
+            self._balancing = True
+            self._decide('Load {:.1f} vs {:.1f} on {}, balancing'.format(
+                self.score(load), self.score(peers[target]), target))
+
+        moves = iter([ thread for thread in self._runnable_threads()
+                if self.settled(thread.thread_uid) ])
+        while True:
+            if imbalance <= STOP_IMBALANCE or load['runnable'] <= load['workers']:
+                self._balancing = False
+                self._decide('Load {:.1f} vs {:.1f} on {}, balanced'.format(
+                    self.score(load), self.score(peers[target]), target))
+                break
+
+            thread = next(moves, None)
+            if thread is None or self._tokens < 1:
+                break # the rest on the next ticks
+
+            self._tokens -= 1
+            if not self._migrate(thread, target):
+                break
+
+            # until the next reports, assume the thread took its load along
+            load['runnable'] -= 1
+            peers[target]['runnable'] += 1
+            peers[target]['threads'] += 1
+            if self._full(peers[target]):
+                del peers[target]
+                if not peers:
+                    break
+            target = min(peers, key=lambda runtime_id: self.score(peers[runtime_id]))
+            imbalance = self.score(load) - self.score(peers[target])
+
+    @staticmethod
+    def _full(load):
+        return load.get('capacity') is not None and load['threads'] >= load['capacity']
+
+    def _runnable_threads(self):
+        return [ thread for threads in self.runtime._programs.values()
+                for thread in threads.values() if thread.status == InterpreterStatus.RUNNING ]
+
+    def _migrate(self, thread, runtime_id):
+        self.moved(thread.thread_uid)
+        self._sent_at[runtime_id] = time.time()
+        try:
+            migrated = self.runtime.migrate_thread(thread.program_id, thread.thread_id, runtime_id)
+        except KeyError:
+            # finished meanwhile
+            return True
+
+        self._decide('{} {}:{} to {}'.format('Migrated' if migrated else 'Failed to migrate',
+            thread.program_id, thread.thread_id, runtime_id))
+        return migrated
+
+    def _decide(self, text):
+        self.runtime.logger.info('Balancer: ' + text)
+        self.decisions.append( (time.time(), text) )
+
+    def status(self):
+        """ Returns (enabled, { runtime_id: load }, decisions), our load included """
+        loads = { runtime_id: load for runtime_id, (_, load)
+                in self.runtime._comms.get_load_reports().items() }
+        loads[self.runtime.id] = self.load()
+        return self.enabled, loads, list(self.decisions)
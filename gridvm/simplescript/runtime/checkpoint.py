@@ -0,0 +1,243 @@
+"""
+Periodic checkpoints of a runtime, to restart it where it left off
+"""
+import os
+import copy
+import time
+import pickle
+
+CHECKPOINT_INTERVAL = 10.0  # seconds between two checkpoints
+MAX_OVERHEAD = 0.05         # share of the time checkpoints may take
+COMPACT_RATIO = 0.5         # segments with less live data are rewritten
+PACK_PRESET = 0             # lzma preset of the thread packages, the fastest
+
+MANIFEST = 'manifest'
+SEGMENT = 'segment-{:08d}'
+
+
+def pending_by_thread(comms):
+    """ Returns { recv: { (recv, sender): [ messages ] } }, leaving them queued """
+    pending = { }
+    for (recv, sender), messages in comms.peek_messages().items():
+        if messages:
+            pending.setdefault(recv, { })[ (recv, sender) ] = messages
+    return pending
+
+def dirty_packages(threads, comms, written):
+    """ Pack the threads that changed since they were last written.
+
+    'written' maps thread_uid to what a thread looked like when written,
+    it is updated and forgets threads that are gone. A thread changes by
+    running, or by the status or pending messages the runtime gives it.
+
+    Returns { thread_uid: package blob } of the changed threads.
+    """
+    # runtime imports this module
+    from .runtime import ThreadPackage
+
+    pending = pending_by_thread(comms)
+    blobs = { }
+    for inter in threads:
+        messages = pending.get(inter.thread_uid, { })
+        signature = (inter, inter.steps, inter.status,
+                sum(len(queue) for queue in messages.values()))
+        if written.get(inter.thread_uid) != signature:
+            written[inter.thread_uid] = signature
+            blobs[inter.thread_uid] = ThreadPackage.from_inter(inter, messages).pack(PACK_PRESET)
+
+    alive = { inter.thread_uid for inter in threads }
+    for thread_uid in [ thread_uid for thread_uid in written if thread_uid not in alive ]:
+        del written[thread_uid]
+    return blobs
+
+def load_manifest(directory):
+    """ The manifest of the latest checkpoint in directory, or None """
+    try:
+        with open(os.path.join(directory, MANIFEST), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class Checkpointer(object):
+    """ Writes checkpoints of a runtime to a local directory.
+
+    A checkpoint is a manifest, that tells where the package of each thread
+    is, next to the status of the runtime's own programs and its forwarding
+    table. Threads that changed since the last checkpoint are appended to a
+    new segment file, the rest stay in the segments they were written to.
+    The manifest is replaced once its segment is on disk, so a crash while
+    checkpointing leaves the previous checkpoint whole. Segments left with
+    less than COMPACT_RATIO live data have their threads written again, and
+    segments no thread is in any more are removed.
+
+    The threads are packed between two rounds, so a checkpoint is a
+    consistent picture of the runtime, with shards the messages they were
+    passing are kept too (see ShardPool.snapshot). Messages on their way to
+    or from other runtimes are not. Checkpoints are spaced so they take at
+    most MAX_OVERHEAD of the time, whatever the interval.
+    """
+    def __init__(self, runtime, directory, interval=CHECKPOINT_INTERVAL):
+        self.runtime = runtime
+        self.directory = directory
+        self.interval = interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._seq = 0
+        self._threads = { }     # thread_uid -> (segment, offset, length)
+        self._segments = { }    # segment -> bytes written to it
+        self._written = { }     # see dirty_packages()
+        self._tables = None     # own programs and forwarding table last written
+
+        self._started = time.time()
+        self._next_checkpoint = self._started + interval
+        self.total_time = 0.0
+        self.last = None        # stats of the last checkpoint, see checkpoint()
+
+    def next_checkpoint(self):
+        return self._next_checkpoint
+
+    def tick(self):
+        """ Called from Runtime, checkpoints if it's time """
+        if time.time() >= self._next_checkpoint:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """ Write a checkpoint, returns its stats, or None if a shard was
+        too busy to take part """
+        # shards use this module
+        from .shard import ShardTimeout
+
+        runtime = self.runtime
+        started = time.time()
+
+        if runtime._pool:
+            try:
+                blobs, alive, in_flight = runtime._pool.snapshot()
+            except ShardTimeout:
+                runtime.logger.warning('A shard is busy, skipped the checkpoint')
+                self._next_checkpoint = time.time() + self.interval
+                return None
+        else:
+            threads = [ inter for threads in runtime._programs.values() for inter in threads.values() ]
+            blobs = dirty_packages(threads, runtime._comms, self._written)
+            alive = { inter.thread_uid for inter in threads }
+            in_flight = [ ]
+
+        threads = { thread_uid: entry for thread_uid, entry in self._threads.items()
+                if thread_uid in alive and thread_uid not in blobs }
+        live = { }
+        for segment, _, length in threads.values():
+            live[segment] = live.get(segment, 0) + length
+
+        # rewrite the threads of segments that are mostly garbage
+        compacted = 0
+        for thread_uid, (segment, offset, length) in list(threads.items()):
+            if live[segment] < self._segments[segment] * COMPACT_RATIO:
+                blobs[thread_uid] = self._read(segment, offset, length)
+                del threads[thread_uid]
+                compacted += 1
+
+        tables = (runtime._own_programs, runtime._comms.get_forwarding_table(),
+                runtime._scheduler.policy.weights, in_flight)
+        written = 0
+        if blobs or threads.keys() != self._threads.keys() or tables != self._tables:
+            self._seq += 1
+            if blobs:
+                segment = SEGMENT.format(self._seq)
+                written = self._write_segment(segment, blobs, threads)
+
+            self._write_manifest(threads, *tables)
+            self._threads = threads
+            self._tables = copy.deepcopy(tables)
+            self._collect()
+
+        elapsed = time.time() - started
+        self.total_time += elapsed
+        self._next_checkpoint = time.time() + max(self.interval, elapsed / MAX_OVERHEAD)
+        self.last = {
+            'seq': self._seq,
+            'time': started,
+            'seconds': elapsed,
+            'threads': len(threads),
+            'written': len(blobs) - compacted,
+            'compacted': compacted,
+            'bytes': written,
+            'overhead': self.total_time / max(time.time() - self._started, 1e-9),
+        }
+        if written:
+            runtime.logger.debug('Checkpoint {seq}: {written} of {threads} threads, '
+                    '{bytes} bytes in {seconds:.3f}s'.format(**self.last))
+        return self.last
+
+    def _write_segment(self, segment, blobs, threads):
+        offset = 0
+        with open(os.path.join(self.directory, segment), 'wb') as f:
+            for thread_uid, blob in blobs.items():
+                f.write(blob)
+                threads[thread_uid] = (segment, offset, len(blob))
+                offset += len(blob)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._segments[segment] = offset
+        return offset
+
+    def _write_manifest(self, threads, own_programs, fwd_table, weights, in_flight):
+        manifest = {
+            'runtime_id': self.runtime.id,
+            'seq': self._seq,
+            'time': time.time(),
+            'threads': threads,
+            'segments': { segment: self._segments[segment]
+                for segment in { entry[0] for entry in threads.values() } },
+            'own_programs': own_programs,
+            'fwd_table': fwd_table,
+            'weights': weights,
+            'in_flight': in_flight,
+        }
+
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(manifest, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def _read(self, segment, offset, length):
+        with open(os.path.join(self.directory, segment), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def _collect(self):
+        """ Remove the segments no thread is in, and what a crash left behind """
+        used = { entry[0] for entry in self._threads.values() }
+        for segment in list(self._segments):
+            if segment not in used:
+                del self._segments[segment]
+
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT.split('{')[0]) and name not in used:
+                os.remove(os.path.join(self.directory, name))
+
+    def restore(self, manifest):
+        """ Bring the threads and tables of a checkpoint back to the runtime """
+        runtime = self.runtime
+        self._seq = manifest['seq']
+        self._segments = dict(manifest['segments'])
+
+        for thread_uid, fwd_location in manifest['fwd_table'].items():
+            runtime._comms.update_thread_location(thread_uid, fwd_location)
+        for program_id, weight in manifest['weights'].items():
+            runtime.set_weight(program_id, weight)
+
+        for thread_uid, (segment, offset, length) in manifest['threads'].items():
+            runtime.unpack_thread(self._read(segment, offset, length))
+            runtime._comms.update_thread_location(thread_uid, runtime.id)
+        self._threads = dict(manifest['threads'])
+
+        for recv, sender, msg in manifest['in_flight']:
+            runtime._comms.send_message(recv, sender, msg)
+        runtime.restore_own_programs(manifest['own_programs'])
+        runtime.logger.info('Restored checkpoint {} of {} threads, taken {}'.format(
+            manifest['seq'], len(self._threads), time.ctime(manifest['time'])))
@@ -1,11 +1,20 @@
+import time
+import asyncio
 from queue import Queue, Empty
-from threading import Thread, Semaphore
+from collections import deque
+from threading import Thread, Semaphore, Event, get_ident
 
 from gridvm.network.nethandler import NetHandler
+from gridvm.network.asynchandler import AsyncNetHandler
 from gridvm.network.protocol.packet import PacketType
 from gridvm.network.protocol.packet import Packet
 from gridvm.network.protocol.packet import make_packet
 
+# A DISCOVER_THREAD_REQ nobody answered is sent again after this many
+# seconds, the messages to the thread are dropped after DISCOVER_RETRIES
+DISCOVER_TIMEOUT = 1.0
+DISCOVER_RETRIES = 5
+
 
 class EchoCommunication:
     def __init__(self, *args, **kwargs):
@@ -36,10 +45,19 @@ class EchoCommunication:
 class NetworkCommunication:
     def __init__(self, runtime_id, net_interface):
         self.runtime_id = runtime_id
-        self._messages = { }    # Messages that have arrived for threads
-        self._sent_messages = [ ] # Messages that have been sent over the network
+        self._messages = { }    # Messages that have arrived for threads, recv -> { sender -> deque }
+        self._inbound = deque() # (recv, sender, msg) from NetHandler, see _take_inbound()
+        # Messages sent over the network, until the peer ACKs them
+        self._in_flight = { }       # <recv, sender> -> <count>
+        self._in_flight_peers = { } # <runtime_id> -> <count>
+        self._acks = deque()        # (runtime_id, (recv, sender)) ACKed, from NetHandler
         self._fwd_table = { }   # Forwarding table <pid, tid> -> <runtime_id>
 
+        # Messages to threads of unknown location, see send_message()
+        self._held = { }            # <pid, tid> -> deque of (sender, msg), oldest first
+        self._resolving = { }       # <pid, tid> -> <retry_at, tries> of a DISCOVER_THREAD_REQ out
+        self._located = deque()     # thread_uids resolved, from NetHandler
+
         self._print_req = Queue()
         self._status_req = Queue()
         self._to_send = Queue() # Packets that should be send over network (runtime_id, packet)
@@ -48,8 +66,31 @@ class NetworkCommunication:
         self._sem = Semaphore(value=0)
         self._migrate_sucess = False
 
+        # called with (recv, sender) whenever a message is queued
+        self._message_listener = None
+        # called with thread_uid once its location is discovered, or given up
+        self._location_listener = None
+
+        # set whenever there is something new for the runtime to look at
+        self.wakeup = Event()
+
+        # Threads run by a shard of this runtime, see ShardPool. Their
+        # location is this runtime, with the shard as a sub-location
+        self._shards = { }      # <pid, tid> -> <shard>
+        self._shard_router = None
+
+        # Load of the peers that run a LoadBalancer
+        self._loads = { }       # <runtime_id> -> <received_at, load>
+
+        # Messages sent by or to local threads since PlacementAdvisor last
+        # looked, None unless it runs (see count_traffic)
+        self._traffic = None    # <sender, recv> -> <count>
+
+
+        self._start_nethandler(net_interface)
 
-        self.nethandler = NetHandler(self, runtime_id, net_interface)
+    def _start_nethandler(self, net_interface):
+        self.nethandler = NetHandler(self, self.runtime_id, net_interface)
 
         # Start NetHandler
         self.nethandler_thread = Thread(target=self.nethandler.start)
@@ -61,14 +102,16 @@ class NetworkCommunication:
         Parameters:
             -- thread_uid: (program_id, thread_id)
         """
+        if self._inbound:
+            self._take_inbound()
 
-        # Create queue if not exist
-        queue = self._messages.setdefault( (recv, sender), Queue())
-
-        try:
-            return queue.get(block=False)
-        except Empty:
-            return None
+        # channels are only created once a message arrives on them
+        channels = self._messages.get(recv)
+        if channels:
+            queue = channels.get(sender)
+            if queue:
+                return queue.popleft()
+        return None
 
 
     def receive_all_messages(self, thread_uid):
@@ -79,25 +122,37 @@ class NetworkCommunication:
         Returns:
             -- List of messages, or an empty list if no messages in buffer
         """
-        messages = { }
-
-        for (recv, sender) in self._messages:
-            #print( (recv, sender) , self._messages[(recv, sender)].empty() )
-            if recv == thread_uid:
-                messages[(recv, sender)] = [ ]
-
-                while True:
-                    msg = self.receive_message(sender, recv)
-                    #print(msg)
-                    if msg == None:
-                        break
-                    messages[(recv, sender)].append(msg)
-
-                if not messages[(recv, sender)]:
-                    del messages[(recv, sender)]
-
-        return messages
-
+        if self._inbound:
+            self._take_inbound()
+
+        # the thread leaves, so do its channels
+        self._forget_traffic(thread_uid)
+        channels = self._messages.pop(thread_uid, None)
+        if not channels:
+            return { }
+        return { (thread_uid, sender): list(queue) for sender, queue in channels.items() if queue }
+
+    def drop_channels(self, thread_uid):
+        """ Called from Runtime once a thread finished, along with whatever
+        was still pending for it """
+        if self._inbound:
+            self._take_inbound()
+        self._messages.pop(thread_uid, None)
+        self._forget_traffic(thread_uid)
+
+
+    def peek_messages(self):
+        """ Called from Checkpointer, returns { (recv, sender): [ messages ] }
+        of all the pending messages, without receiving them """
+        if self._inbound:
+            self._take_inbound()
+        return { (recv, sender): list(queue) for recv, channels in self._messages.items()
+                for sender, queue in channels.items() }
+
+    def pending_messages(self):
+        """ Called from Runtime, the number of messages waiting for local threads """
+        return len(self._inbound) + sum(len(queue) for channels in self._messages.values()
+                for queue in channels.values())
 
     def can_receive_message(self, sender, recv):
         """ Called from Runtime to check if a message is pending for a thread
@@ -105,17 +160,17 @@ class NetworkCommunication:
         Parameters:
             -- thread_uid: (program_id, thread_id)
         """
-        queue = self._messages.setdefault( (recv, sender), Queue())
-        if not queue.empty():
-            return True
+        if self._inbound:
+            self._take_inbound()
 
-        # Check if a message was sent over the network
-        if (recv, sender) in self._sent_messages:
-            #print('Found sent message: {} -> {}'.format(sender, recv))
-            self._sent_messages.remove( (recv, sender) )
+        channels = self._messages.get(recv)
+        if channels and channels.get(sender):
             return True
 
-        return False
+        # Check if a message is on its way over the network
+        if self._acks:
+            self._take_acks()
+        return (recv, sender) in self._in_flight
 
     def send_message(self, recv, sender, msg):
         """ Called from Runtime to send a message to another thread (same program)
@@ -123,13 +178,38 @@ class NetworkCommunication:
             Parameters:
                 -- thread_uid:  (program_id, thread_id)
                 -- msg:         message to send
+
+            Returns False if the location of recv is unknown. The message
+            is held until it is discovered, along with the later ones to recv,
+            messages to other threads go on (see check_discoveries)
         """
-        runtime_id = self._get_runtime_id(recv)
+        if recv in self._held or recv not in self._fwd_table:
+            return self._hold(recv, sender, msg)
+
+        self._send(recv, sender, msg)
+        return True
+
+    def _hold(self, recv, sender, msg):
+        held = self._held.get(recv)
+        if held is None:
+            held = self._held[recv] = deque()
+        held.append( (sender, msg) )
+
+        if recv in self._fwd_table:
+            # located, check_discoveries() sends it next
+            return True
+        if recv not in self._resolving:
+            self._discover(recv, 1)
+        return False
+
+    def _send(self, recv, sender, msg):
+        runtime_id = self._fwd_table[recv]
+        if self._traffic is not None:
+            self._count_message(sender, recv)
 
         if runtime_id == self.runtime_id:
             # Simply add to local message queue
-            queue = self._messages.setdefault((recv, sender), Queue())
-            queue.put(msg)
+            self._deliver(recv, sender, msg)
         else:
             packet = make_packet(
                 PacketType.THREAD_MESSAGE,
@@ -137,27 +217,168 @@ class NetworkCommunication:
                 sender=sender,
                 msg=msg
             )
-            self._to_send.put( (runtime_id, packet) )
-
-            # Add to sent_messages
-            #print('Add {}:{}'.format(recv, sender))
-            self._sent_messages.append( (recv, sender) )
+            self.queue_packet(runtime_id, packet)
+            self._count_in_flight(runtime_id, (recv, sender), 1)
+
+    def messages_acked(self, runtime_id, messages):
+        """ Called from NetHandler once runtime_id ACKed a batch of
+        (recv, sender, msg) messages, or once sending them failed """
+        self._acks.extend( (runtime_id, (recv, sender)) for recv, sender, _ in messages )
+
+    def _take_acks(self):
+        acks = self._acks
+        while acks:
+            runtime_id, channel = acks.popleft()
+            self._count_in_flight(runtime_id, channel, -1)
+
+    def _count_in_flight(self, runtime_id, channel, count):
+        """ Add count to the in-flight messages of a channel, and of the peer
+        unless None. Entries are dropped once they reach zero """
+        for table, key in ( (self._in_flight, channel), (self._in_flight_peers, runtime_id) ):
+            if key is None:
+                continue
+            total = table.get(key, 0) + count
+            if total:
+                table[key] = total
+            else:
+                del table[key]
+
+    def in_flight_messages(self):
+        """ Called from Runtime, returns { runtime_id: count } of the messages
+        sent to each peer it didn't ACK yet """
+        if self._acks:
+            self._take_acks()
+        return dict(self._in_flight_peers)
 
     def add_thread_message(self, packet):
         """ Called from NetHandler to add a new thread message which has arrived """
         sender, recv, msg = packet['sender'], packet['recv'], packet['msg']
 
-        # Add the message to the queue
-        queue = self._messages.setdefault( (recv, sender), Queue())
-        queue.put(msg)
+        # Hand the message over to the runtime thread
+        self._inbound.append( (recv, sender, msg) )
+        self._message_arrived(recv, sender)
+
+    def add_thread_messages(self, messages):
+        """ Called from NetHandler with the [ recv, sender, msg ] of a
+        THREAD_MESSAGES batch, oldest first """
+        arrived = { }   # the channels to notify about, in order
+        for recv, sender, msg in messages:
+            recv, sender = tuple(recv), tuple(sender)
+            self._inbound.append( (recv, sender, msg) )
+            arrived[ (recv, sender) ] = True
+
+        for recv, sender in arrived:
+            self._message_arrived(recv, sender)
+
+    def _deliver(self, recv, sender, msg):
+        """ Queue a message for a local thread, from the runtime thread """
+        shard = self._shards.get(recv)
+        if shard is not None:
+            self._shard_router(shard, recv, sender, msg)
+            return
+
+        if self._inbound:
+            # they were sent before this one
+            self._take_inbound()
+        self._channel(recv, sender).append(msg)
+        self._message_arrived(recv, sender)
+
+    def deliver_inbound(self):
+        """ Called from Runtime, for the messages no local thread asked for """
+        if self._inbound:
+            self._take_inbound()
+
+    def _take_inbound(self):
+        """ Move the messages NetHandler handed over to their channels, the
+        ones to threads that moved away meanwhile are sent after them """
+        inbound = self._inbound
+        fwd_table = self._fwd_table
+        while inbound:
+            recv, sender, msg = inbound.popleft()
+            location = fwd_table.get(recv)
+            if location is not None and location != self.runtime_id:
+                self.send_message(recv, sender, msg)
+                continue
+
+            if self._traffic is not None:
+                self._count_message(sender, recv)
+            shard = self._shards.get(recv)
+            if shard is not None:
+                self._shard_router(shard, recv, sender, msg)
+            else:
+                self._channel(recv, sender).append(msg)
+
+    def _channel(self, recv, sender):
+        """ The queue of a channel, created on the first message """
+        channels = self._messages.get(recv)
+        if channels is None:
+            channels = self._messages[recv] = { }
+        queue = channels.get(sender)
+        if queue is None:
+            queue = channels[sender] = deque()
+        return queue
+
+    def _count_message(self, sender, recv):
+        pair = (sender, recv)
+        self._traffic[pair] = self._traffic.get(pair, 0) + 1
+
+    def _forget_traffic(self, thread_uid):
+        if self._traffic:
+            for pair in [ pair for pair in self._traffic if thread_uid in pair ]:
+                del self._traffic[pair]
+
+    def count_traffic(self, enabled):
+        """ Called from PlacementAdvisor, messages are only counted while it runs """
+        if not enabled:
+            self._traffic = None
+        elif self._traffic is None:
+            self._traffic = { }
+
+    def add_traffic(self, traffic):
+        """ Called from ShardPool with the messages its shards passed
+        between themselves, { (sender, recv): count } """
+        if self._traffic is None:
+            return
+        for pair, count in traffic.items():
+            self._traffic[pair] = self._traffic.get(pair, 0) + count
+
+    def take_traffic(self):
+        """ Called from PlacementAdvisor, returns the message counts since
+        the last call, { (sender, recv): count } """
+        if self._traffic is None:
+            return { }
+        traffic, self._traffic = self._traffic, { }
+        return traffic
+
+    def get_forwarding_table(self):
+        """ Called from Checkpointer, returns { thread_uid: runtime_id } """
+        return dict(self._fwd_table)
+
+    def get_thread_location(self, thread_uid):
+        """ The runtime_id of a thread, or None if unknown """
+        return self._fwd_table.get(thread_uid)
+
+    def set_message_listener(self, listener):
+        """ Called from Runtime to get notified of every queued message,
+        listener(recv, sender) may be called from the NetHandler thread """
+        self._message_listener = listener
+
+    def set_location_listener(self, listener):
+        """ Called from Runtime to get notified once the location of a thread
+        it sent to is discovered or given up, listener(thread_uid) """
+        self._location_listener = listener
+
+    def _message_arrived(self, recv, sender):
+        if self._message_listener is not None:
+            self._message_listener(recv, sender)
+        if not self.wakeup.is_set():
+            self.wakeup.set()
 
     def restore_messages(self, thread_uid, messages):
         """ Called from runtime to restore pending messages """
-        #print(messages)
         for (recv, sender) in messages:
-            queue = self._messages.setdefault( (recv, sender), Queue())
-            for msg in messages[(recv, sender)]:
-                queue.put(msg)
+            # they were sent before any that arrived since
+            self._channel(recv, sender).extendleft(reversed(messages[(recv, sender)]))
 
 
     def get_print_requests(self):
@@ -184,12 +405,13 @@ class NetworkCommunication:
                 thread_uid=thread_uid,
                 msg=msg
             )
-            self._to_send.put( (orig_runtime_id, packet) )
+            self.queue_packet(orig_runtime_id, packet)
 
     def add_print_request(self, packet):
         """ Called from NetHandler to add a print request which has arrived """
         thread_uid, msg = packet['thread_uid'], packet['msg']
         self._print_req.put( (thread_uid, msg))
+        self.wakeup.set()
 
 
 
@@ -219,12 +441,13 @@ class NetworkCommunication:
                 status=new_status,
                 waiting_from=waiting_from
             )
-            self._to_send.put( (orig_runtime_id, packet) )
+            self.queue_packet(orig_runtime_id, packet)
 
     def add_status_request(self, packet):
         """ Called from NetHandler to add a thread status request which has arrived """
         thread_uid, status, waiting_from = packet['thread_uid'], packet['status'], packet['waiting_from']
         self._status_req.put( (thread_uid, (status, waiting_from)) )
+        self.wakeup.set()
 
 
 
@@ -248,7 +471,7 @@ class NetworkCommunication:
             thread_uid=thread_uid,
             payload=thread_package
         )
-        self._to_send.put( (new_location, packet) )
+        self.queue_packet(new_location, packet)
 
         # Wait for ACK
         self._sem.acquire()
@@ -273,6 +496,7 @@ class NetworkCommunication:
         self._migration_req.put(thread_blob)
 
         self.update_thread_location(thread_uid, self.runtime_id)
+        self.wakeup.set()
 
 
     def update_thread_location(self, thread_uid, new_location):
@@ -285,10 +509,103 @@ class NetworkCommunication:
         """
         self._fwd_table[thread_uid] = new_location
 
+        if thread_uid in self._resolving:
+            # Runtime sends what was held for it, see check_discoveries()
+            self._located.append(thread_uid)
+            if not self.wakeup.is_set():
+                self.wakeup.set()
+
+    def _discover(self, thread_uid, tries):
+        """ Ask the peers where a thread is, a single request per thread is out """
+        self._resolving[thread_uid] = (time.time() + DISCOVER_TIMEOUT, tries)
+        packet = make_packet(
+            PacketType.DISCOVER_THREAD_REQ,
+            thread_uid=thread_uid
+        )
+        self.queue_packet(None, packet)
+
+    def check_discoveries(self):
+        """ Called from Runtime, sends what was held for the threads located
+        since and asks again for the ones nobody answered.
+
+        Returns the thread_uids given up after DISCOVER_RETRIES, the messages
+        sent to them are dropped
+        """
+        resolved, lost = [ ], [ ]
+        while self._located:
+            thread_uid = self._located.popleft()
+            if self._resolving.pop(thread_uid, None) is not None:
+                resolved.append(thread_uid)
+
+        now = time.time()
+        for thread_uid, (retry_at, tries) in list(self._resolving.items()):
+            if now < retry_at:
+                continue
+            if tries < DISCOVER_RETRIES:
+                self._discover(thread_uid, tries + 1)
+                continue
+
+            del self._resolving[thread_uid]
+            lost.append(thread_uid)
+
+        for thread_uid in resolved:
+            for sender, msg in self._held.pop(thread_uid, ( )):
+                self._send(thread_uid, sender, msg)
+        for thread_uid in lost:
+            self._held.pop(thread_uid, None)
+
+        if resolved or lost:
+            if self._location_listener is not None:
+                for thread_uid in resolved + lost:
+                    self._location_listener(thread_uid)
+        return lost
+
+    def next_discovery(self):
+        """ When check_discoveries() has to ask again, or None """
+        if self._located:
+            return time.time()
+        return min( (retry_at for retry_at, _ in self._resolving.values()), default=None)
+
+    def is_resolving(self, thread_uid):
+        """ Whether the location of a thread is being discovered """
+        return thread_uid in self._resolving
+
+    def set_shard_router(self, router):
+        """ Called from ShardPool, router(shard, recv, sender, msg) gets
+        the messages of sharded threads """
+        self._shard_router = router
+
+    def update_shard_location(self, thread_uid, shard):
+        """ Called from ShardPool when a thread is placed on a shard,
+        or taken off one if shard is None """
+        if shard is None:
+            self._shards.pop(thread_uid, None)
+        else:
+            self._shards[thread_uid] = shard
+
+    def send_load_report(self, load):
+        """ Called from LoadBalancer to tell the peers about our load """
+        packet = make_packet(PacketType.RUNTIME_LOAD, load=load)
+        self.queue_packet(None, packet)
+
+    def add_load_report(self, packet):
+        """ Called from NetHandler once a RUNTIME_LOAD packet has arrived """
+        if packet['runtime_id'] != self.runtime_id:
+            self._loads[ packet['runtime_id'] ] = (time.time(), packet['load'])
+
+    def get_load_reports(self):
+        """ Called from LoadBalancer, returns { runtime_id: (received_at, load) } """
+        return dict(self._loads)
+
     def get_to_send_requests(self):
         """ Called from NetHandler """
         return self._get_list( self._to_send )
 
+    def queue_packet(self, runtime_id, packet):
+        """ Have NetHandler send a packet to runtime_id, or over multicast if None """
+        self._to_send.put( (runtime_id, packet) )
+        self.nethandler.notify()
+
     def get_runtimes(self):
         return self.nethandler.runtimes
 
@@ -306,16 +623,92 @@ class NetworkCommunication:
 
         return list
 
-    def _get_runtime_id(self, thread_uid):
-        """ Return the id of the runtime that currently runs this thread """
-        if thread_uid not in self._fwd_table:
-            packet = make_packet(
-                PacketType.DISCOVER_THREAD_REQ,
-                thread_uid=thread_uid
-            )
-            self._to_send.put( (None, packet) )
 
-            # Wait for DISCOVER_THREAD_REP
-            self._sem.acquire()
+class LoopEvent(object):
+    """ The wakeup Event of a runtime running on an event loop, set() may
+    be called from any thread, wait() is a coroutine of the loop """
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._event = None
+        self._set = False   # until bound to the loop
+
+    def bind(self, loop):
+        """ Called from the loop """
+        self._loop, self._thread = loop, get_ident()
+        self._event = asyncio.Event()
+        if self._set:
+            self._event.set()
+
+    def set(self):
+        if self._loop is None:
+            self._set = True
+        elif get_ident() == self._thread:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    def clear(self):
+        if self._loop is None:
+            self._set = False
+        else:
+            self._event.clear()
+
+    def is_set(self):
+        return self._set if self._loop is None else self._event.is_set()
+
+    async def wait(self, timeout=None):
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self._event.is_set()
+
+class AsyncNetworkCommunication(NetworkCommunication):
+    """ NetworkCommunication of a runtime that shares an event loop with
+    its NetHandler, see Runtime.run.
+
+    Nothing blocks the loop: a migration returns once the thread is handed
+    to the NetHandler, and a thread the peers refused comes back like a
+    migrated one.
+    """
+    def _start_nethandler(self, net_interface):
+        self.wakeup = LoopEvent()
+        self.nethandler = AsyncNetHandler(self, self.runtime_id, net_interface)
+        self._nethandler_task = None
+
+    def start(self):
+        """ Called from Runtime once its loop runs """
+        self.wakeup.bind(asyncio.get_event_loop())
+        self._nethandler_task = asyncio.ensure_future(self.nethandler.run())
+
+    async def closed(self):
+        """ Called from Runtime, returns once the NetHandler has shut down """
+        await self._nethandler_task
+
+    def migrate_thread(self, thread_uid, thread_package, new_location):
+        if new_location == self.runtime_id:
+            return False
+
+        packet = make_packet(
+            PacketType.MIGRATE_THREAD,
+            thread_uid=thread_uid,
+            payload=thread_package
+        )
+        self.queue_packet(new_location, packet)
+        return True
+
+    def migrate_thread_completed(self, result, packet, location):
+        """ Called from AsyncNetHandler once a peer took the thread, or all refused it """
+        if not result:
+            # back to the runtime, like a thread that migrated here
+            self.add_thread_migration(packet)
+            return
+
+        thread_uid = packet['thread_uid']
+        self.update_thread_location(thread_uid, location)
 
-        return self._fwd_table[thread_uid]
+        # sent to it while it was on its way
+        for (recv, sender), messages in self.receive_all_messages(thread_uid).items():
+            for msg in messages:
+                self.send_message(recv, sender, msg)
@@ -0,0 +1,179 @@
+"""
+Deadlock detection on the wait-for graph of a program
+"""
+import itertools
+
+
+class _Node(object):
+    """ A thread in the link-cut tree of a WaitForGraph """
+    __slots__ = ('key', 'left', 'right', 'parent')
+
+    def __init__(self, key):
+        self.key = key
+        self.left = None
+        self.right = None
+        self.parent = None  # splay tree parent, or path parent at the splay root
+
+    def is_root(self):
+        """ Whether it is the root of its splay tree """
+        parent = self.parent
+        return parent is None or (parent.left is not self and parent.right is not self)
+
+
+def _rotate(node):
+    parent = node.parent
+    grand = parent.parent
+    if not parent.is_root():
+        if grand.left is parent:
+            grand.left = node
+        else:
+            grand.right = node
+
+    if parent.left is node:
+        parent.left = node.right
+        if node.right is not None:
+            node.right.parent = parent
+        node.right = parent
+    else:
+        parent.right = node.left
+        if node.left is not None:
+            node.left.parent = parent
+        node.left = parent
+
+    parent.parent = node
+    node.parent = grand
+
+def _splay(node):
+    while not node.is_root():
+        parent = node.parent
+        if not parent.is_root():
+            grand = parent.parent
+            if (grand.left is parent) == (parent.left is node):
+                _rotate(parent)
+            else:
+                _rotate(node)
+        _rotate(node)
+
+def _access(node):
+    """ Make the path from the root of its tree to node preferred, node ends
+    up at the root of its splay tree with no deeper nodes on the right """
+    last = None
+    current = node
+    while current is not None:
+        _splay(current)
+        current.right = last
+        last = current
+        current = current.parent
+    _splay(node)
+
+def _find_root(node):
+    _access(node)
+    while node.left is not None:
+        node = node.left
+    _splay(node)
+    return node
+
+def _link(child, parent):
+    """ child must be the root of its tree """
+    _access(child)
+    child.parent = parent
+
+def _cut(child):
+    _access(child)
+    if child.left is not None:
+        child.left.parent = None
+        child.left = None
+
+
+class WaitForGraph(object):
+    """ Which thread each blocked thread of a program receives from.
+
+    Every thread waits for at most one other, so as long as there are no
+    cycles the graph is a forest, rooted at the threads that don't wait.
+    It's kept as a link-cut tree, where adding or removing an edge and
+    finding the root of a thread cost O(log n) amortized. An edge closes a
+    cycle exactly when the root of the thread it points to is the waiting
+    thread itself. Such edges are kept aside, until an edge of their cycle
+    is removed.
+    """
+    def __init__(self):
+        self._nodes = { }       # thread_id -> _Node, threads with edges
+        self._waiting_for = { } # thread_id -> thread_id it receives from
+        self._waiters = { }     # thread_id -> set of threads receiving from it
+        self._closing = { }     # thread_id -> thread_id, edges that closed a cycle
+        self._serials = { }     # thread_id -> serial of its edge
+        self._serial = itertools.count()
+
+    def __len__(self):
+        return len(self._waiting_for)
+
+    def waiting_for(self, thread_id):
+        return self._waiting_for.get(thread_id)
+
+    def serial(self, thread_id):
+        """ Tells apart the edges a thread adds over time """
+        return self._serials.get(thread_id)
+
+    def waiters(self, thread_id):
+        return self._waiters.get(thread_id, ())
+
+    def _node(self, thread_id):
+        node = self._nodes.get(thread_id)
+        if node is None:
+            node = self._nodes[thread_id] = _Node(thread_id)
+        return node
+
+    def _discard(self, thread_id):
+        """ Forget the node of a thread left without edges """
+        if thread_id not in self._waiting_for and thread_id not in self._waiters:
+            self._nodes.pop(thread_id, None)
+
+    def add_edge(self, waiter, sender):
+        """ waiter blocked receiving from sender. Returns the cycle this
+        closes as a list of thread ids starting from waiter, or None """
+        self.remove_edge(waiter)
+        self._waiting_for[waiter] = sender
+        self._serials[waiter] = next(self._serial)
+        self._waiters.setdefault(sender, set()).add(waiter)
+
+        node = self._node(waiter)
+        if _find_root(self._node(sender)) is node:
+            self._closing[waiter] = sender
+            return self.cycle(waiter)
+
+        _link(node, self._nodes[sender])
+        return None
+
+    def remove_edge(self, waiter):
+        """ waiter isn't blocked any more """
+        sender = self._waiting_for.pop(waiter, None)
+        if sender is None:
+            return
+        del self._serials[waiter]
+
+        waiters = self._waiters[sender]
+        waiters.discard(waiter)
+        if not waiters:
+            del self._waiters[sender]
+
+        if self._closing.pop(waiter, None) is None:
+            _cut(self._nodes[waiter])
+
+            # cycles through this edge are broken, their closing edges fit now
+            for closing_waiter, closing_sender in list(self._closing.items()):
+                node = self._nodes[closing_waiter]
+                if _find_root(self._nodes[closing_sender]) is not node:
+                    del self._closing[closing_waiter]
+                    _link(node, self._nodes[closing_sender])
+
+        self._discard(waiter)
+        self._discard(sender)
+
+    def cycle(self, thread_id):
+        """ The cycle through thread_id, following the edges """
+        cycle = [ thread_id ]
+        current = self._waiting_for[thread_id]
+        while current != thread_id:
+            cycle.append(current)
+            current = self._waiting_for[current]
+        return cycle
@@ -1,10 +1,14 @@
 import time
-import collections
+from time import perf_counter
+import operator
+import weakref
 from pathlib import Path
 from enum import IntEnum, unique
 
-from ..codegen.ss_bcode import OpCode, Operation
+from ..codegen.ss_bcode import OpCode
 from ..ss_exception import StatusChange
+from .jit import JIT_THRESHOLD, find_leaders, compile_block
+from .ss_array import SimpleScriptArray
 
 @unique
 class InterpreterStatus(IntEnum):
@@ -13,33 +17,42 @@ class InterpreterStatus(IntEnum):
     BLOCKED = 2,
     STOPPED = 3,
     FINISHED = 4,
-    CRASHED = 5
+    CRASHED = 5,
+    RESOLVING = 6
 
 MAGIC = 0xC0DE10CC
 
+DEFAULT_BUDGET = 1000       # instructions per slice
+TIME_CHECK_INTERVAL = 64    # instructions between two quantum checks
+
 ARITHM_OP_TABLE =  [
-        lambda x, y: x + y,
-        lambda x, y: x - y,
-        lambda x, y: x * y,
-        lambda x, y: x / y,
-        lambda x, y: x % y
+        operator.add,
+        operator.sub,
+        operator.mul,
+        operator.truediv,
+        operator.mod
         ]
 
 COMP_OP_TABLE = [
-        lambda x, y: x > y,
-        lambda x, y: x >= y,
-        lambda x, y: x < y,
-        lambda x, y: x <= y,
-        lambda x, y: x == y
+        operator.gt,
+        operator.ge,
+        operator.lt,
+        operator.le,
+        operator.eq
         ]
 
 class SimpleScriptInterpreter(object):
-    def __init__(self, runtime_id, program_id, thread_id, code, communication):
+    # a runtime may hold a lot of threads, and the dispatch table is shared
+    # (see threaded()), so an interpreter is little more than its registers
+    __slots__ = ('_pc', 'code', '_vars', '_arrays', '_comms', '_status',
+            'program_id', 'thread_id', 'runtime_id', 'thread_uid',
+            'wake_up_at', 'waiting_from', 'steps', '_jit', '_ops')
+
+    def __init__(self, runtime_id, program_id, thread_id, code, communication, jit=True):
         self._pc = 0
         self.code = code
-        self._vars = dict()
-        self._arrays = dict()
-        self._stack = collections.deque()
+        self._vars = self._new_registers(code)
+        self._arrays = [ None ] * len(code.co_arrays)   # None until built
         self._comms = communication
         self._status = InterpreterStatus.STOPPED
         self.program_id = program_id
@@ -50,27 +63,12 @@ class SimpleScriptInterpreter(object):
         self.wake_up_at = 0.0
         self.waiting_from = None
 
-        self.__map = [
-                self._load_const,
-                self._load_var,
-                self._store_var,
-                self._load_array,
-                self._store_array,
-                self._build_var,
-                self._build_array,
-                self._rot_two,
-                self._arithm,
-                self._compare_op,
-                self._jmp_if_true,
-                self._jmp,
-                self._snd,
-                self._rcv,
-                self._slp,
-                self._prn,
-                self._ret,
-                self._nop
-        ]
+        # instructions executed, a compiled block counts as one
+        self.steps = 0
 
+        # threaded form of the code, shared with the other threads running it
+        self._jit = jit
+        self._ops = threaded(code, jit)
 
     @property
     def status(self):
@@ -80,99 +78,156 @@ class SimpleScriptInterpreter(object):
     def status(self, value):
         self._status = value
 
+    def set_profile(self, profile):
+        """ Run the profiled form of the code from 'profile', or the
+        normal one if None. Either way the dispatch loop is the same """
+        if profile is None:
+            self._ops = threaded(self.code, self._jit)
+        else:
+            self._ops = profile.threaded(self.code)
+
+    @staticmethod
+    def _new_registers(code):
+        """ The register file holds the vars followed by the constants in
+        reverse order, so negative operands address constants """
+        return [ None ] * len(code.co_vars) + list(reversed(code.co_consts))
+
     def save_state(self):
+        # constants come with the code
         return  (self._pc,
-                self._vars,
+                self._vars[:len(self.code.co_vars)],
                 self._arrays,
-                self._stack,
                 self._status.value,
                 self.wake_up_at,
                 self.waiting_from)
 
     def load_state(self, state):
-        (self._pc,self._vars, self._arrays,
-                self._stack, status_code, self.wake_up_at, self.waiting_from) = state
+        (self._pc, vars, self._arrays,
+                status_code, self.wake_up_at, self.waiting_from) = state
+        self._vars = self._new_registers(self.code)
+        self._vars[:len(vars)] = vars
         self._status = InterpreterStatus(status_code)
 
     def print_state(self):
-        print('stack:')
-        print(self._stack)
         print('consts:')
         for i, var in enumerate(self.code.co_consts):
             print(i, var)
         print('vars memory dump: ')
-        for index, value in self._vars.items():
+        for index, name in enumerate(self.code.co_vars):
             # print var_name, value
-            print(self.code.co_vars[index], value)
+            print(name, self._vars[index])
         print('arrays memory dump: ')
-        for index, value in self._arrays.items():
+        for index, value in enumerate(self._arrays):
             # print var_name, value
-            print(self.code.co_arrays[index], value)
+            if value is not None:
+                print(self.code.co_arrays[index], value)
 
     def start(self, argv):
-        self._arrays[0] = argv
+        self._arrays[0] = SimpleScriptArray(argv)
         self._vars[0] = len(argv)
         self._status = InterpreterStatus.RUNNING
 
     def exec_next(self):
+            """ Execute a single instruction. Raises StatusChange if the
+            status of the thread changed, prefer exec_slice() """
             try:
-                instruction = self.code.instructions[self._pc]
+                handler, arg = self._ops[self._pc]
             except IndexError:
                 raise RuntimeError("Program finished without calling RET!")
 
             try:
-                self.__map[instruction.opcode](instruction.arg)
-            except StatusChange:
-                if self._status != InterpreterStatus.BLOCKED:
-                    self._pc += 1
-                raise # propagate
+                status = handler(self, arg)
             except Exception as ex:
-                error_msg =  'Execution failed!\n'
-                error_msg += 'Instruction: {}\n'.format(str(self.code.instructions[self._pc]))
-                error_msg += 'Reason: {} - {}\n'.format(ex.__class__.__name__, str(ex))
+                self._fail(ex)
 
-                print('State dump: ')
-                self.print_state()
+            self._pc += 1
+            if status is not None:
+                raise StatusChange(self.runtime_id, self.program_id, self.thread_id, status)
+
+    def exec_slice(self, budget=DEFAULT_BUDGET, quantum=None):
+        """ Execute up to 'budget' instructions in a tight loop. If 'quantum'
+        is given, the slice also ends once 'quantum' seconds have passed.
+
+        Returns the status of the thread when the slice is over:
+            RUNNING  -- budget or quantum expired
+            BLOCKED, SLEEPING, RESOLVING, FINISHED -- the thread changed its status
+        """
+        if quantum is None:
+            return self._exec_steps(budget)
+
+        deadline = time.time() + quantum
+        while budget > 0:
+            steps = min(budget, TIME_CHECK_INTERVAL)
+            status = self._exec_steps(steps)
+            if status != InterpreterStatus.RUNNING or time.time() >= deadline:
+                return status
+            budget -= steps
+
+        return InterpreterStatus.RUNNING
+
+    def _exec_steps(self, steps):
+        """ Execute at most 'steps' instructions, returns the new status.
+        A compiled block counts as a single instruction.
+
+        Instructions return None, or the new status of the thread when they
+        change it (see the status register, self._status) """
+        ops = self._ops
+        try:
+            for step in range(steps):
+                handler, arg = ops[self._pc]
+                status = handler(self, arg)
+                self._pc += 1
+                if status is not None:
+                    self.steps += step + 1
+                    return status
+        except Exception as ex:
+            if self._pc >= len(ops):
+                raise RuntimeError("Program finished without calling RET!")
+            self._fail(ex)
 
-                raise RuntimeError(error_msg)
+        self.steps += steps
+        return InterpreterStatus.RUNNING
 
-            self._pc += 1
+    def _fail(self, ex):
+        error_msg =  'Execution failed!\n'
+        error_msg += 'Line: {}\n'.format(self.code.line_of(self._pc))
+        error_msg += 'Instruction: {}\n'.format(str(self.code.instructions[self._pc]))
+        error_msg += 'Reason: {} - {}\n'.format(ex.__class__.__name__, str(ex))
 
-    ##### INSTRUCTIONS #####
-    def _load_const(self, arg):
-        self._stack.append(self.code.co_consts[arg])
+        print('State dump: ')
+        self.print_state()
 
-    def _load_var(self, arg):
-        self._stack.append(self._vars[arg])
+        raise RuntimeError(error_msg)
 
+    ##### INSTRUCTIONS #####
+    # Instructions operate on the decoded operands, see decode()
     def _build_var(self, arg):
         pass
 
-    def _store_var(self, arg):
-        self._vars[arg] = self._stack.pop()
+    def _move(self, arg):
+        dst, src = arg
+        regs = self._vars
+        regs[dst] = regs[src]
 
     def _build_array(self, arg):
-        self._arrays[arg] = {}
-        # build only once
-        # replace instruction with nop
-        self.code.instructions[self._pc] = Operation(OpCode.NOP.value)
+        # build only once, the code is shared so this is tracked per thread
+        if self._arrays[arg] is None:
+            self._arrays[arg] = SimpleScriptArray()
 
     def _store_array(self, arg):
-        index = self._stack.pop()
-        self._arrays[arg][index] = self._stack.pop()
+        array, index, src = arg
+        regs = self._vars
+        self._arrays[array][regs[index]] = regs[src]
 
     def _load_array(self, arg):
-        index = self._stack.pop()
-        self._stack.append(self._arrays[arg][index])
+        dst, array, index = arg
+        regs = self._vars
+        regs[dst] = self._arrays[array][regs[index]]
 
     def _prn(self, arg):
-        vect = []
-
-        for i in range(arg):
-            vect.append(self._stack.pop())
-
-        format = self.code.co_consts[self._stack.pop()]
-        to_print = format +  ', '.join(str(arg) for arg in reversed(vect))
+        format, vector = arg
+        regs = self._vars
+        to_print = format +  ', '.join(str(regs[register]) for register in vector)
 
         self._comms.send_print_request(
             self.runtime_id,
@@ -181,53 +236,149 @@ class SimpleScriptInterpreter(object):
         )
 
     def _arithm(self, arg):
-        var2 = self._stack.pop()
-        var1 = self._stack.pop()
-        self._stack.append(ARITHM_OP_TABLE[arg](var1, var2))
-
-    def _compare_op(self, arg):
-        var2 = self._stack.pop()
-        var1 = self._stack.pop()
-        self._stack.append(COMP_OP_TABLE[arg](var1, var2))
-
-    def _jmp(self, arg):
-        new_index = self.code.co_labels[arg]
-        self._pc = new_index - 1 # we want the next instruction to be new index
-
-    def _jmp_if_true(self, arg):
-        if self._stack.pop():
-            # we want the next instruction to be new index
-            self._pc = self.code.co_labels[arg] -1
-
-    def _rcv(self, arg=None):
-        who = self._stack.pop()
+        op, dst, var1, var2 = arg
+        regs = self._vars
+        regs[dst] = op(regs[var1], regs[var2])
+
+    def _cmp_jmp(self, arg):
+        op, var1, var2, target = arg
+        regs = self._vars
+        if op(regs[var1], regs[var2]):
+            # we want the next instruction to be target
+            self._pc = target - 1
+
+    def _jmp(self, target):
+        self._pc = target - 1 # we want the next instruction to be target
+
+    ##### JIT #####
+    def _count_block(self, counter):
+        """ Wraps the first instruction of a basic block, counter is a
+        [hits, op] pair shared by all the threads running the code """
+        counter[0] += 1
+        op = counter[1]
+
+        if counter[0] == JIT_THRESHOLD:
+            # stop profiling, from now on run the compiled block if any
+            pc = self._pc
+            block = compile_block(self.code, pc)
+            self._ops[pc] = (SimpleScriptInterpreter._exec_block, block) if block else op
+
+        handler, arg = op
+        return handler(self, arg)
+
+    def _profiled(self, arg):
+        """ Wraps every instruction of a profiled threaded form """
+        handler, arg, stats = arg
+        start = perf_counter()
+        status = handler(self, arg)
+        stats[1] += perf_counter() - start
+        stats[0] += 1
+        return status
+
+    def _exec_block(self, block):
+        self._pc = block(self) - 1 # we want the next instruction to be the returned pc
+
+    def _rcv(self, arg):
+        dst, sender = arg
+        who = self._vars[sender]
         msg = self._comms.receive_message( (self.program_id, who), (self.program_id, self.thread_id) )
         if msg == None:
-            # re-insert address in stack
-            self._stack.append(who)
-
-            # save who we are waiting from and propagate
+            # save who we are waiting from and stay on this
+            # instruction, it is executed again once we wake up
             self.waiting_from = (self.program_id, who)
+            self._pc -= 1
             self._status = InterpreterStatus.BLOCKED
-            raise StatusChange(self.runtime_id, self.program_id, self.thread_id, self._status)
-        self._stack.append(msg)
-
-    def _snd(self, arg=None):
-        send_what = self._stack.pop()
-        send_to = self._stack.pop()
-        self._comms.send_message( (self.program_id, send_to), (self.program_id, self.thread_id) , send_what)
+            return self._status
+        self._vars[dst] = msg
+
+    def _snd(self, arg):
+        send_to, send_what = arg
+        regs = self._vars
+        recv = (self.program_id, regs[send_to])
+        if not self._comms.send_message(recv, (self.program_id, self.thread_id) , regs[send_what]):
+            # the message is held until the location of recv is discovered,
+            # wait for it like RCV does for a message
+            self.waiting_from = recv
+            self._status = InterpreterStatus.RESOLVING
+            return self._status
 
     def _slp(self, arg):
-        self.wake_up_at = time.time() + self._stack.pop()
+        self.wake_up_at = time.time() + self._vars[arg]
         self._status = InterpreterStatus.SLEEPING
-        raise StatusChange(self.runtime_id, self.program_id, self.thread_id, self._status)
+        return self._status
 
     def _nop(self, arg):
         pass
 
-    def _rot_two(self, arg):
-        pass
-
     def _ret(self, arg=None):
         self._status = InterpreterStatus.FINISHED
-        raise StatusChange(self.runtime_id, self.program_id, self.thread_id, self._status)
+        return self._status
+
+
+HANDLERS = {
+        OpCode.LOAD_ARRAY:  SimpleScriptInterpreter._load_array,
+        OpCode.STORE_ARRAY: SimpleScriptInterpreter._store_array,
+        OpCode.BUILD_VAR:   SimpleScriptInterpreter._build_var,
+        OpCode.BUILD_ARRAY: SimpleScriptInterpreter._build_array,
+        OpCode.MOVE:        SimpleScriptInterpreter._move,
+        OpCode.ARITHM:      SimpleScriptInterpreter._arithm,
+        OpCode.CMP_JMP:     SimpleScriptInterpreter._cmp_jmp,
+        OpCode.JMP:         SimpleScriptInterpreter._jmp,
+        OpCode.SND:         SimpleScriptInterpreter._snd,
+        OpCode.RCV:         SimpleScriptInterpreter._rcv,
+        OpCode.SLP:         SimpleScriptInterpreter._slp,
+        OpCode.PRN:         SimpleScriptInterpreter._prn,
+        OpCode.RET:         SimpleScriptInterpreter._ret,
+        OpCode.NOP:         SimpleScriptInterpreter._nop,
+}
+
+def decode_operand(code, opcode, arg):
+    """ Resolve the operand of an instruction for its handler """
+    if opcode == OpCode.JMP:
+        return code.co_labels[arg]
+    elif opcode == OpCode.ARITHM:
+        op, dst, var1, var2 = arg
+        return (ARITHM_OP_TABLE[op], dst, var1, var2)
+    elif opcode == OpCode.CMP_JMP:
+        op, var1, var2, label = arg
+        return (COMP_OP_TABLE[op], var1, var2, code.co_labels[label])
+    elif opcode == OpCode.PRN:
+        format, vector = arg
+        return (code.co_consts[format], vector)
+    return arg
+
+def decode(code):
+    """ Decode a code object into its threaded form.
+
+    The threaded form is a flat list of (handler, operand) pairs, one for each
+    instruction of the code object, so a pc is valid for both. Handlers are
+    the (unbound) instruction methods of SimpleScriptInterpreter, label
+    indexes are resolved to absolute pcs and operators and format strings
+    are inlined.
+    """
+    ops = [ ]
+    for instruction in code.instructions:
+        opcode = OpCode(instruction.opcode)
+        ops.append( (HANDLERS[opcode], decode_operand(code, opcode, instruction.arg)) )
+
+    return ops
+
+# threaded forms of the loaded code objects, see threaded()
+_threaded_cache = weakref.WeakKeyDictionary()
+
+def threaded(code, jit=True):
+    """ Return the threaded form of a code object, shared by all the
+    interpreters running it so hot blocks are compiled only once.
+
+    With jit, the first instruction of each basic block is wrapped to count
+    its entries, see SimpleScriptInterpreter._count_block
+    """
+    forms = _threaded_cache.setdefault(code, { })
+    if jit not in forms:
+        ops = decode(code)
+        if jit:
+            for index in find_leaders(code):
+                ops[index] = (SimpleScriptInterpreter._count_block, [0, ops[index]])
+        forms[jit] = ops
+
+    return forms[jit]
@@ -0,0 +1,168 @@
+"""
+Compiles hot basic blocks of a SimpleScript code object into python functions
+"""
+from ..codegen.ss_bcode import OpCode
+from .ss_array import SimpleScriptArray
+
+JIT_THRESHOLD = 500     # entries of a block before it gets compiled
+MAX_BLOCK_SIZE = 256    # instructions
+MIN_BLOCK_SIZE = 2      # instructions, smaller blocks are not worth a call
+
+# A block always stops before these, so the interpreter executes them and the
+# runtime keeps control of blocking, sleeping and migration
+BLOCK_TERMINATORS = {
+        OpCode.SND,
+        OpCode.RCV,
+        OpCode.SLP,
+        OpCode.PRN,
+        OpCode.RET,
+}
+
+NO_OPS = { OpCode.BUILD_VAR, OpCode.NOP }
+
+ARITHM_SYMBOLS = [ '+', '-', '*', '/', '%' ]
+COMP_SYMBOLS = [ '>', '>=', '<', '<=', '==' ]
+
+
+def find_leaders(code):
+    """ Return the indexes where a basic block may start: jump targets
+    and instructions that follow a block terminator """
+    leaders = set(code.co_labels)
+    for index, instruction in enumerate(code.instructions):
+        if instruction.opcode in BLOCK_TERMINATORS:
+            leaders.add(index + 1)
+
+    return { index for index in leaders if index < len(code.instructions) }
+
+def compile_block(code, start):
+    """ Compile the basic block starting at 'start' into a function.
+
+    The function takes the interpreter, runs the whole block with vars and
+    arrays held in locals, writes them back and returns the next pc. Returns
+    None if the block is too small to be worth compiling.
+    """
+    return BlockCompiler(code, start).compile()
+
+
+class BlockCompiler(object):
+    def __init__(self, code, start):
+        self.code = code
+        self.start = start
+
+        self.body = [ ]
+        self.loaded = set()     # vars read before being written in the block
+        self.written = [ ]      # vars written in the block, in order
+        self.arrays = set()
+
+    def compile(self):
+        size = self._translate()
+        if size < MIN_BLOCK_SIZE:
+            return None
+
+        prologue = [
+            'def block(inter):',
+            '    V = inter._vars',
+            '    A = inter._arrays',
+        ]
+
+        source = '\n'.join(prologue + self.body) + '\n'
+        namespace = { 'SimpleScriptArray': SimpleScriptArray }
+        exec(compile(source, '<ssjit:{}>'.format(self.start), 'exec'), namespace)
+
+        block = namespace['block']
+        block.source = source
+        return block
+
+    def _translate(self):
+        """ Translate instructions into the body, returns the block size """
+        instructions = self.code.instructions
+        targets = set(self.code.co_labels)
+
+        index = self.start
+        while index < len(instructions) and index - self.start < MAX_BLOCK_SIZE:
+            if index != self.start and index in targets:
+                break # another block starts here
+
+            instruction = instructions[index]
+            opcode = OpCode(instruction.opcode)
+            if opcode in BLOCK_TERMINATORS:
+                break
+
+            index += 1
+            if not self._translate_one(opcode, instruction.arg):
+                # unconditional jump, the block is over
+                return index - self.start
+
+        self._exit(index)
+        return index - self.start
+
+    def _translate_one(self, opcode, arg):
+        """ Emit the code for an instruction. Returns False if the
+        instruction ends the block """
+        labels = self.code.co_labels
+
+        if opcode in NO_OPS:
+            pass
+        elif opcode == OpCode.BUILD_ARRAY:
+            self._emit('if A[{0}] is None: A[{0}] = SimpleScriptArray()'.format(arg))
+        elif opcode == OpCode.MOVE:
+            dst, src = arg
+            self._store(dst, self._operand(src))
+        elif opcode == OpCode.LOAD_ARRAY:
+            dst, array, index = arg
+            self._store(dst, '{}[{}]'.format(self._array(array), self._operand(index)))
+        elif opcode == OpCode.STORE_ARRAY:
+            array, index, src = arg
+            self._emit('{}[{}] = {}'.format(
+                self._array(array), self._operand(index), self._operand(src)))
+        elif opcode == OpCode.ARITHM:
+            op, dst, var1, var2 = arg
+            self._store(dst, self._op(var1, ARITHM_SYMBOLS[op], var2))
+        elif opcode == OpCode.CMP_JMP:
+            op, var1, var2, label = arg
+            self._emit('if {}:'.format(self._op(var1, COMP_SYMBOLS[op], var2)))
+            self._exit(labels[label], indent=2)
+        elif opcode == OpCode.JMP:
+            self._exit(labels[arg])
+            return False
+        else:
+            raise ValueError('Cannot compile {}'.format(opcode.name))
+
+        return True
+
+    ##### HELPERS #####
+    def _emit(self, line, indent=1):
+        self.body.append('    ' * indent + line)
+
+    def _op(self, var1, symbol, var2):
+        return '({} {} {})'.format(self._operand(var1), symbol, self._operand(var2))
+
+    def _operand(self, register):
+        if register < 0:
+            # constants are inlined
+            return repr(self.code.co_consts[-register - 1])
+        return self._var(register)
+
+    def _var(self, index):
+        if index not in self.written and index not in self.loaded:
+            # load on first use, an earlier exit may not need it
+            self.loaded.add(index)
+            self._emit('v{0} = V[{0}]'.format(index))
+        return 'v{}'.format(index)
+
+    def _store(self, index, expr):
+        if index not in self.written:
+            self.written.append(index)
+        self._emit('v{} = {}'.format(index, expr))
+
+    def _array(self, index):
+        if index not in self.arrays:
+            self.arrays.add(index)
+            self._emit('a{0} = A[{0}]'.format(index))
+        return 'a{}'.format(index)
+
+    def _exit(self, target, indent=1):
+        """ Write back vars and leave the block """
+        for index in self.written:
+            self._emit('V[{0}] = v{0}'.format(index), indent)
+        self._emit('return {}'.format(target), indent)
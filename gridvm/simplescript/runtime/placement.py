@@ -0,0 +1,160 @@
+"""
+Moves threads that talk a lot to the runtime of the threads they talk to
+"""
+import time
+
+from .inter import InterpreterStatus
+
+ADVISE_INTERVAL = 2.0       # seconds between two rounds of advice
+TRAFFIC_DECAY = 0.5         # weight of the past traffic, once a round
+MIN_GAIN = 10               # messages a move must save, per round
+MOVES_PER_ROUND = 4
+
+
+class PlacementAdvisor(object):
+    """ Co-locates threads that exchange many messages.
+
+    While it runs, NetworkCommunication counts the messages of each
+    (sender, recv) pair going through this runtime. Every ADVISE_INTERVAL seconds the advisor
+    weighs, for each local thread, its traffic with the threads of every
+    runtime, and proposes to move it where it would save the most network
+    messages, by at least MIN_GAIN. Once started, it also performs them.
+    While it's stopped it can propose without moving anything, see propose().
+
+    A runtime takes threads up to its capacity, as its load reports tell
+    (see LoadBalancer), so there are no moves to peers that don't report.
+    So that two runtimes don't swap the two ends of a pair, moves towards a
+    runtime with a larger id wait a round, and happen if the move still
+    makes sense once the larger one moved its own threads.
+    """
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.enabled = False
+        self.proposing = False  # counting messages while stopped, see propose()
+        self.proposals = [ ]    # (thread_uid, runtime_id, gain, verdict), of the last round
+
+        self._traffic = { }     # (sender, recv) -> decayed message count
+        self._deferred = { }    # thread_uid -> runtime_id, moves up waiting a round
+        self._next_round = None
+
+    def start(self):
+        self.enabled = True
+        self._next_round = time.time()
+        self.runtime._comms.count_traffic(True)
+
+    def stop(self):
+        self.enabled = False
+        self.proposing = False
+        self.proposals = [ ]
+        self._next_round = None
+        self._traffic = { }
+        self.runtime._comms.count_traffic(False)
+
+    def next_round(self):
+        """ When the advisor has to run next, or None if it's stopped """
+        return self._next_round
+
+    def tick(self):
+        """ Called from Runtime, advises and moves threads if it's time """
+        now = time.time()
+        if not self.enabled or now < self._next_round:
+            return
+        self._next_round = now + ADVISE_INTERVAL
+
+        runtime = self.runtime
+        if not runtime._balancer.enabled:
+            # the peers need our capacity
+            runtime._comms.send_load_report(runtime._balancer.load())
+
+        self._count_traffic()
+        self.proposals = self._advise()
+
+    def _count_traffic(self):
+        for pair in self._traffic:
+            self._traffic[pair] *= TRAFFIC_DECAY
+        for pair, count in self.runtime._comms.take_traffic().items():
+            self._traffic[pair] = self._traffic.get(pair, 0) + count
+        self._traffic = { pair: count for pair, count in self._traffic.items() if count >= 1 }
+
+    def _advise(self):
+        runtime = self.runtime
+        comms = runtime._comms
+        local = { thread.thread_uid: thread for threads in runtime._programs.values()
+                for thread in threads.values() if thread.status != InterpreterStatus.FINISHED }
+
+        # thread_uid -> { runtime_id: messages with its threads }
+        affinity = { }
+        for (sender, recv), count in self._traffic.items():
+            for thread_uid, partner in ( (sender, recv), (recv, sender) ):
+                if thread_uid in local and thread_uid != partner:
+                    location = runtime.id if partner in local else comms.get_thread_location(partner)
+                    if location is not None:
+                        weights = affinity.setdefault(thread_uid, { })
+                        weights[location] = weights.get(location, 0) + count
+
+        candidates = [ ]
+        for thread_uid, weights in affinity.items():
+            here = weights.get(runtime.id, 0)
+            target = max(weights, key=weights.get)
+            gain = weights[target] - here
+            if target != runtime.id and gain >= MIN_GAIN:
+                candidates.append( (gain, thread_uid, target) )
+        candidates.sort(reverse=True)
+
+        runtimes = comms.get_runtimes()
+        loads = { runtime_id: dict(load) for runtime_id, (_, load)
+                in comms.get_load_reports().items() if runtime_id in runtimes }
+
+        proposals = [ ]
+        moves = 0
+        deferred, self._deferred = self._deferred, { }
+        for gain, thread_uid, target in candidates:
+            load = loads.get(target)
+            if load is None:
+                verdict = 'no load report'
+            elif load.get('capacity') is not None and load['threads'] >= load['capacity']:
+                verdict = 'full'
+            elif not self.enabled:
+                verdict = 'proposed'
+            elif not runtime._balancer.settled(thread_uid) or moves >= MOVES_PER_ROUND:
+                verdict = 'later'
+            elif target > runtime.id and deferred.get(thread_uid) != target:
+                self._deferred[thread_uid] = target
+                verdict = 'next round'
+            else:
+                moves += 1
+                verdict = 'moved' if self._migrate(local[thread_uid], target) else 'failed'
+                if verdict == 'moved':
+                    load['threads'] += 1
+
+            proposals.append( (thread_uid, target, int(gain), verdict) )
+            if verdict in ('moved', 'failed'):
+                runtime.logger.info('Placement: {} {}:{} to {}, saves {} messages'.format(
+                    'Moved' if verdict == 'moved' else 'Failed to move',
+                    *thread_uid, target, int(gain)))
+
+        return proposals
+
+    def _migrate(self, thread, runtime_id):
+        self.runtime._balancer.moved(thread.thread_uid)
+        try:
+            return self.runtime.migrate_thread(thread.program_id, thread.thread_id, runtime_id)
+        except KeyError:
+            # finished meanwhile
+            return False
+
+    def propose(self):
+        """ Advise without moving anything, while it's stopped. Messages are
+        counted from the first call on, until stop(), so the first proposals
+        come with the next call """
+        if self.enabled:
+            return
+        if not self.proposing:
+            self.proposing = True
+            self.runtime._comms.count_traffic(True)
+        self._count_traffic()
+        self.proposals = self._advise()
+
+    def status(self):
+        """ Returns (enabled, proposals) """
+        return self.enabled, list(self.proposals)
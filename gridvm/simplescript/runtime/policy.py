@@ -0,0 +1,135 @@
+"""
+Scheduling policies, they decide which of the ready threads run in a round
+"""
+import heapq
+from collections import deque
+
+DEFAULT_WEIGHT = 1
+SLICE_DECAY = 0.8   # weight of the past in the average slice length
+
+
+class SchedulingPolicy(object):
+    """ Base of the scheduling policies used by Scheduler.
+
+    A policy holds the ready threads. Scheduler pushes threads as they get
+    ready and asks for the threads of the next round, then accounts the cpu
+    time each thread took back to the policy.
+    """
+    def __init__(self):
+        self.weights = { }      # program_id -> weight
+        self.cpu_time = { }     # program_id -> seconds
+
+    def set_weight(self, program_id, weight):
+        if weight <= 0:
+            raise ValueError('Weight must be positive')
+        self.weights[program_id] = weight
+
+    def push(self, inter):
+        """ A thread got ready """
+        raise NotImplementedError
+
+    def next_round(self, is_valid):
+        """ Returns the threads to run next and forgets them. Threads for
+        which is_valid() is False were unscheduled and are dropped """
+        raise NotImplementedError
+
+    def account(self, inter, seconds):
+        """ A thread ran for 'seconds' """
+        self.cpu_time[inter.program_id] = self.cpu_time.get(inter.program_id, 0.0) + seconds
+
+    def cpu_share(self, cpu_time=None):
+        """ Returns { program_id: (weight, seconds, share) } """
+        cpu_time = self.cpu_time if cpu_time is None else cpu_time
+        total = sum(cpu_time.values()) or 1.0
+        return { program_id: (self.weights.get(program_id, DEFAULT_WEIGHT), seconds, seconds / total)
+                for program_id, seconds in cpu_time.items() }
+
+
+class RoundRobinPolicy(SchedulingPolicy):
+    """ Every ready thread runs once a round, in the order they got ready """
+    def __init__(self):
+        super().__init__()
+        self._ready = deque()
+
+    def __len__(self):
+        return len(self._ready)
+
+    def push(self, inter):
+        self._ready.append(inter)
+
+    def next_round(self, is_valid):
+        run_list = [ inter for inter in self._ready if is_valid(inter) ]
+        self._ready.clear()
+        return run_list
+
+
+class FairSharePolicy(SchedulingPolicy):
+    """ Weighted fair share between programs, whatever their thread count.
+
+    Each program has a virtual runtime, the cpu time its threads took
+    divided by its weight, and the program with the lowest one runs next.
+    A round picks threads in that order, expecting each to take the average
+    slice of its program, and ends once the next program has no ready thread
+    left, so it can't be overtaken. Threads of a program run round-robin.
+    """
+    def __init__(self):
+        super().__init__()
+        self._queues = { }      # program_id -> deque of ready threads
+        self._vruntime = { }    # program_id -> virtual seconds
+        self._slice = { }       # program_id -> average slice, seconds
+        self._picked = set()    # programs of the last round
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def push(self, inter):
+        program_id = inter.program_id
+        queue = self._queues.setdefault(program_id, deque())
+        if not queue and program_id not in self._picked:
+            # a program that was idle doesn't get to catch up
+            floor = min((self._vruntime[ready] for ready, queue in self._queues.items() if queue),
+                    default=self._vruntime.get(program_id, 0.0))
+            self._vruntime[program_id] = max(self._vruntime.get(program_id, floor), floor)
+        queue.append(inter)
+
+    def next_round(self, is_valid):
+        order = [ (self._vruntime[program_id], program_id) for program_id in self._queues ]
+        heapq.heapify(order)
+
+        run_list = [ ]
+        while order:
+            vruntime, program_id = heapq.heappop(order)
+            queue = self._queues[program_id]
+            while queue and not is_valid(queue[0]):
+                queue.popleft()
+
+            if not queue:
+                if run_list:
+                    break # it would run next, don't let the others overtake it
+                continue
+
+            run_list.append(queue.popleft())
+            expected = self._slice.get(program_id, 0.0) / self.weights.get(program_id, DEFAULT_WEIGHT)
+            heapq.heappush(order, (vruntime + expected, program_id))
+
+        # forget the programs with nothing ready or running
+        self._picked = { inter.program_id for inter in run_list }
+        for program_id in [ program_id for program_id, queue in self._queues.items()
+                if not queue and program_id not in self._picked ]:
+            del self._queues[program_id]
+
+        return run_list
+
+    def account(self, inter, seconds):
+        super().account(inter, seconds)
+        program_id = inter.program_id
+        weight = self.weights.get(program_id, DEFAULT_WEIGHT)
+        self._vruntime[program_id] = self._vruntime.get(program_id, 0.0) + seconds / weight
+        self._slice[program_id] = (SLICE_DECAY * self._slice.get(program_id, seconds)
+                + (1 - SLICE_DECAY) * seconds)
+
+
+POLICIES = {
+        'round_robin':  RoundRobinPolicy,
+        'fair':         FairSharePolicy,
+}
@@ -0,0 +1,82 @@
+"""
+Per opcode and per line profiling of SimpleScript programs
+"""
+from ..codegen.ss_bcode import OpCode
+from .inter import SimpleScriptInterpreter, decode
+from .source import source_name
+
+
+class Profile(object):
+    """ Execution counts and time of the instructions run by the threads of
+    a program.
+
+    Interpreters being profiled run a profiled threaded form of their code,
+    where every instruction is wrapped to account for itself, see
+    SimpleScriptInterpreter.set_profile(). The form is shared by all the
+    threads of the program running the same code, so they all add to it.
+    """
+    def __init__(self, program_id):
+        self.program_id = program_id
+        self._forms = { }   # code object -> profiled threaded form
+        self._stats = { }   # code object -> [count, seconds] of each instruction
+
+    def threaded(self, code):
+        """ Return the profiled threaded form of a code object """
+        if code not in self._forms:
+            # not jitted, a compiled block would hide its lines
+            stats = [ [0, 0.0] for _ in code.instructions ]
+            self._forms[code] = [ (SimpleScriptInterpreter._profiled, (handler, arg, stats[pc]))
+                    for pc, (handler, arg) in enumerate(decode(code)) ]
+            self._stats[code] = stats
+
+        return self._forms[code]
+
+    def _records(self):
+        """ Yields (source, line, opcode, count, seconds) for every instruction run """
+        for code, stats in self._stats.items():
+            name = source_name(code)
+            line = None
+            for instruction, (count, seconds) in zip(code.instructions, stats):
+                if instruction.line_no is not None:
+                    line = instruction.line_no
+                if count:
+                    yield name, line, OpCode(instruction.opcode), count, seconds
+
+    def by_opcode(self):
+        """ Returns { opcode: [count, seconds] } """
+        totals = { }
+        for _, _, opcode, count, seconds in self._records():
+            total = totals.setdefault(opcode, [0, 0.0])
+            total[0] += count
+            total[1] += seconds
+        return totals
+
+    def by_line(self):
+        """ Returns { (source, line): [count, seconds] } """
+        totals = { }
+        for name, line, _, count, seconds in self._records():
+            total = totals.setdefault( (name, line), [0, 0.0])
+            total[0] += count
+            total[1] += seconds
+        return totals
+
+    def hot_lines(self, limit=None):
+        """ Returns (source, line, count, seconds) tuples, the most
+        expensive first """
+        lines = [ (name, line, count, seconds)
+                for (name, line), (count, seconds) in self.by_line().items() ]
+        lines.sort(key=lambda item: item[3], reverse=True)
+        return lines[:limit]
+
+    def collapsed(self):
+        """ Returns the profile in the collapsed stack format of flamegraph
+        tools, one 'program;source:line;opcode microseconds' line per
+        instruction kind of each line """
+        totals = { }
+        for name, line, opcode, count, seconds in self._records():
+            stack = '{};{}:{};{}'.format(self.program_id, name,
+                    '?' if line is None else line, opcode.name)
+            totals[stack] = totals.get(stack, 0.0) + seconds
+
+        return ''.join('{} {}\n'.format(stack, int(seconds * 1e6))
+                for stack, seconds in sorted(totals.items()))
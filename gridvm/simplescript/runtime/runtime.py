@@ -1,18 +1,35 @@
 import pickle
 import lzma
 import time
-import itertools
+import asyncio
+from time import perf_counter
 
 from datetime import datetime
 from enum import IntEnum, unique
 from queue import Queue, Empty
 
 from gridvm.logger import get_logger
-from .communication import NetworkCommunication, EchoCommunication
-from .inter import SimpleScriptInterpreter, InterpreterStatus
-from .source import ProgramInfo, generic_load
+from .communication import NetworkCommunication, AsyncNetworkCommunication, EchoCommunication
+from .inter import SimpleScriptInterpreter, InterpreterStatus, DEFAULT_BUDGET
+from .source import ProgramInfo, generic_load, intern_code
+from .profiler import Profile
+from .scheduler import Scheduler
+from .policy import POLICIES
+from .deadlock import WaitForGraph
+from .balancer import LoadBalancer
+from .placement import PlacementAdvisor
+from .checkpoint import Checkpointer, CHECKPOINT_INTERVAL, load_manifest
+from .shard import ShardPool, ShardTimeout
 from .utils import fast_hash
-from ..ss_exception import StatusChange
+from ..codegen.ss_optimizer import DEFAULT_LEVEL
+
+# Shards and peer runtimes report status changes asynchronously (a peer
+# ACKs a message before its thread reports it is running again), so a
+# deadlock is only reported once its threads stay that way for this long (seconds)
+DEADLOCK_GRACE = 0.5
+
+# On an event loop, the network gets its turn at least this often (seconds)
+LOOP_SLICE = 0.005
 
 @unique
 class LocalRequest(IntEnum):
@@ -21,15 +38,51 @@ class LocalRequest(IntEnum):
     MIGRATE = 2
     AUTO_BALANCE = 3
     SHUTDOWN = 4
+    PROFILE = 5
+    PROFILE_REPORT = 6
+    PROFILE_EXPORT = 7
+    MOVE_TO_SHARD = 8
+    SET_WEIGHT = 9
+    CPU_SHARE = 10
+    COLOCATE = 11
+    CHECKPOINT = 12
+    IN_FLIGHT = 13
+
+LOOPS = {
+    'threads': NetworkCommunication,
+    'asyncio': AsyncNetworkCommunication,
+}
 
 class Runtime(object):
-    def __init__(self, interface, bind_addres=None, mcast_address=None):
+    def __init__(self, interface, bind_addres=None, mcast_address=None,
+            quantum=DEFAULT_BUDGET, time_quantum=None, optimize=DEFAULT_LEVEL, shards=0,
+            policy='round_robin', capacity=None, checkpoint_dir=None,
+            checkpoint_interval=CHECKPOINT_INTERVAL, restore=False, loop='threads'):
+        # A restored runtime takes the place of the one that checkpointed
+        manifest = None
+        if restore:
+            manifest = load_manifest(checkpoint_dir)
+            if manifest is None:
+                raise FileNotFoundError('No checkpoint in {}'.format(checkpoint_dir))
+
         # Generate unique id for each runtime (even in same pc)
-        self.id = fast_hash( datetime.now().isoformat(), length=4)
+        self.id = manifest['runtime_id'] if manifest else fast_hash( datetime.now().isoformat(), length=4)
         self.logger = get_logger('{}:Runtime'.format(self.id))
 
         self.running = True
 
+        # Each thread runs for up to 'quantum' instructions (or 'time_quantum'
+        # seconds) before the next one gets its turn
+        self.quantum = quantum
+        self.time_quantum = time_quantum
+
+        # optimization level of the code loaded from sources
+        self.optimize = optimize
+
+        # program_id -> Profile, while profiling is on
+        self.profiling = False
+        self._profiles = dict()
+
         self._programs = dict()
         self._remote_programs = dict()
         self._own_programs = dict()
@@ -37,8 +90,38 @@ class Runtime(object):
         self._request_q = Queue()
         self._request_rep = Queue()
 
+        # 'threads' runs the network on a thread of its own, 'asyncio' runs
+        # it along with the threads on one event loop, see _run_async()
+        if loop not in LOOPS:
+            raise ValueError('Unknown loop: {}'.format(loop))
+        self.loop = loop
+
         #self._comms = EchoCommunication(interface)
-        self._comms = NetworkCommunication(self.id, interface)
+        self._comms = LOOPS[loop](self.id, interface)
+        # which of the ready threads run in a round, see POLICIES
+        self._scheduler = Scheduler(self._comms, POLICIES[policy]())
+
+        # with shards, threads run on a pool of worker processes instead
+        self._pool = ShardPool(self, shards, quantum, time_quantum, policy) if shards else None
+        self._deadlock_suspects = dict() # (program_id, edges) -> (when to report it, serials)
+
+        # program_id -> WaitForGraph, of own programs
+        self._wait_for = dict()
+
+        # instructions the threads ran here, see LoadBalancer
+        self._steps = 0
+        self._balancer = LoadBalancer(self)
+
+        # peers move threads here only while it runs fewer, None for no limit
+        self.capacity = capacity
+        self._advisor = PlacementAdvisor(self)
+
+        # periodic checkpoints to restart from, see Checkpointer
+        self._checkpointer = None
+        if checkpoint_dir is not None:
+            self._checkpointer = Checkpointer(self, checkpoint_dir, checkpoint_interval)
+            if manifest is not None:
+                self._checkpointer.restore(manifest)
 
     def load_program(self, filename):
         """ Load a program description  from a .mtss file """
@@ -46,19 +129,28 @@ class Runtime(object):
         self.logger.debug('Loading program "{}"...'.format(filename))
         info = ProgramInfo(filename)
         program_thread_info = info.parse()
+        if info.weight is not None:
+            self.set_weight(info.program_id, info.weight)
 
+        # threads of a program mostly run the same few sources
+        codes = dict()
         for thread_info in program_thread_info:
             self.logger.debug('Creating thread [{}]:{}...'.format(
                 thread_info.program_id,
                 thread_info.thread_id
             ))
-            self.create_thread(thread_info)
+            code = codes.get(thread_info.source_file)
+            if code is None:
+                code = codes[thread_info.source_file] = generic_load(
+                        thread_info.source_file, optimize=self.optimize)
+            self.create_thread(thread_info, code)
 
         self.logger.info('Program loaded successfully!')
 
-    def create_thread(self, thread_info):
+    def create_thread(self, thread_info, code=None):
         """ Create a thread from ThreadInfo"""
-        code = generic_load(thread_info.source_file)
+        if code is None:
+            code = generic_load(thread_info.source_file, optimize=self.optimize)
 
         interpreter = SimpleScriptInterpreter(
                 runtime_id=self.id,
@@ -70,6 +162,11 @@ class Runtime(object):
 
         # initialise the interpreter with argv
         interpreter.start(thread_info.args)
+        if self._pool:
+            package = ThreadPackage.from_inter(interpreter, { })
+            interpreter = self._pool.place(package.pack(), package)
+        else:
+            self._set_profile(interpreter)
 
         # add to programs
         program_node = self._programs.setdefault(thread_info.program_id, dict())
@@ -77,18 +174,34 @@ class Runtime(object):
 
         # add to own programs(status + waiting from only)
         program_node = self._own_programs.setdefault(thread_info.program_id, dict())
-        program_node[thread_info.thread_id] = (interpreter.status, None)
+        program_node[thread_info.thread_id] = own_status(interpreter.status)
+        self._wait_for.setdefault(thread_info.program_id, WaitForGraph())
 
         # let comms know we have a new thread
-        self._comms.update_thread_location(
-                (thread_info.program_id, thread_info.thread_id),
-                self.id )
+        self._comms.update_thread_location(interpreter.thread_uid, self.id)
+
+        if not self._pool:
+            self._scheduler.add(interpreter)
 
 
     def pack_thread(self, program_id, thread_id):
         """ Pack a thread with it's state and code, into a transferable blob"""
         # remove the interpreter from the threads' tree
         inter = self._programs[program_id].pop(thread_id)
+        self._scheduler.remove(inter)
+
+        if self._pool:
+            try:
+                package = ThreadPackage.unpack(self._pool.pack(inter.thread_uid))
+            except KeyError:
+                self._programs[program_id][thread_id] = inter
+                raise
+
+            # the ones that arrived here once it left its shard come last
+            messages = self._comms.receive_all_messages(inter.thread_uid)
+            for channel, queue in messages.items():
+                package.pending_msgs.setdefault(channel, [ ]).extend(queue)
+            return package.pack()
 
         # get all messages for this thread from comms
         messages = self._comms.receive_all_messages( (inter.program_id, inter.thread_id) )
@@ -96,16 +209,22 @@ class Runtime(object):
 
         return ThreadPackage.from_inter(inter, messages).pack()
 
-    def unpack_thread(self, blob):
-        """ Create a thread from a package """
+    def unpack_thread(self, blob, shard=None):
+        """ Create a thread from a package, on 'shard' if running with shards """
         #self.total_threads += 1
         package = ThreadPackage.unpack(blob)
+        self._balancer.moved( (package.program_id, package.thread_id) )
+
+        if self._pool:
+            program_node = self._programs.setdefault(package.program_id, dict())
+            program_node[package.thread_id] = self._pool.place(blob, package, shard)
+            return
 
         interpreter = SimpleScriptInterpreter(
                 thread_id=package.thread_id,
                 program_id=package.program_id,
                 runtime_id=package.runtime_id,
-                code=package.code,
+                code=intern_code(package.code),
                 communication=self._comms
         )
 
@@ -115,15 +234,19 @@ class Runtime(object):
 
         # load stack, memory etc
         interpreter.load_state(package.state)
+        self._set_profile(interpreter)
 
 
         # add thread to programs
         program_node = self._programs.setdefault(package.program_id, dict())
         program_node[package.thread_id] = interpreter
 
+        self._scheduler.add(interpreter)
+
 
     def shutdown(self):
         self.running = False
+        self._comms.wakeup.set()
 
         # Send all foreign threads away
         for program_id in self._programs:
@@ -139,80 +262,162 @@ class Runtime(object):
         """ Called when a Thread fails """
         self.update_status(failed_inter.thread_uid, failed_inter.runtime_id, InterpreterStatus.CRASHED)
 
+        for inter in self._programs[failed_inter.program_id].values():
+            self._scheduler.remove(inter)
         del self._programs[failed_inter.program_id]
 
         if failed_inter.program_id in self._own_programs:
             del self._own_programs[failed_inter.program_id]
+            del self._wait_for[failed_inter.program_id]
 
     def _get_next_round(self):
-        """ Generate a run list and yield threads in a round-robin fashion """
+        """ Generate a run list of the threads that can run, in a round-robin fashion """
         self.check_for_requests()
 
         run_list = [ ]
         while not run_list and self.running:
-            for inter in itertools.chain(*( child.values() for child in self._programs.values())):
-                status = inter.status
-                if status == InterpreterStatus.RUNNING:
-                    run_list.append(inter)
-                elif (status == InterpreterStatus.SLEEPING and time.time() >= inter.wake_up_at):
-                    self.update_status(inter.thread_uid, inter.runtime_id, InterpreterStatus.RUNNING)
-                    run_list.append(inter)
-
-                elif (status == InterpreterStatus.BLOCKED and
-                        self._comms.can_receive_message(inter.waiting_from, inter.thread_uid) ):
-                    self.update_status(inter.thread_uid, inter.runtime_id, InterpreterStatus.RUNNING)
-                    run_list.append(inter)
+            run_list = self._next_round()
 
             if not run_list:
-                #self.logger.debug('Sleeping for 100ms ...')
-                time.sleep(1)
+                self._wait_for_work()
                 self.check_for_requests()
 
         return run_list
 
-    def run(self):
-        # if we get an empty list, either everyone is blocked, or they are all finished
-        list = self._get_next_round()
-        while list:
-            for inter in list:
-                inter = list.pop()
-
-                try:
-                    #print('running', inter.program_id, inter.thread_id)
-                    inter.exec_next()
-                except StatusChange as sc:
-                    # interpreter changed the status of this thread
-                    """
-                    self._comms.send_status_request(
-                            sc.runtime_id,
-                            (sc.program_id, sc.thread_id),
-                            sc.status)
-                    """
-                    if sc.status == InterpreterStatus.BLOCKED:
-                        self.update_status(
-                            inter.thread_uid,
-                            sc.runtime_id,
-                            sc.status,
-                            waiting_from=inter.waiting_from
-                        )
-                    else:
-                        self.update_status(inter.thread_uid, sc.runtime_id, sc.status)
+    async def _get_next_round_async(self):
+        """ _get_next_round(), waiting on the event loop """
+        self.check_for_requests()
 
+        run_list = [ ]
+        while not run_list and self.running:
+            run_list = self._next_round()
 
-                except Exception as ex:
-                    self.logger.error('Thread failed')
-                    self.logger.error(str(ex))
+            if not run_list:
+                await self._comms.wakeup.wait(self._wait_timeout())
+                self._comms.wakeup.clear()
+                self.check_for_requests()
 
-                    self.on_thread_fail(inter)
+        return run_list
+
+    def _next_round(self):
+        for inter in self._scheduler.wake_up():
+            self.update_status(inter.thread_uid, inter.runtime_id, InterpreterStatus.RUNNING)
+        return self._scheduler.next_round()
+
+    def _wait_for_work(self):
+        """ Block until comms or the shell have something new for us,
+        or the first sleeping thread has to wake up """
+        wakeup = self._comms.wakeup
+        wakeup.wait(self._wait_timeout())
+        # anything signalled from now on is handled by the caller
+        wakeup.clear()
+
+    def _wait_timeout(self):
+        deadlines = [ deadline for deadline in (self._scheduler.next_deadline(),
+            self._balancer.next_tick(), self._advisor.next_round(),
+            self._checkpointer.next_checkpoint() if self._checkpointer else None,
+            self._comms.next_discovery(),
+            *(report_at for report_at, _ in self._deadlock_suspects.values()))
+            if deadline is not None ]
+        return max(0, min(deadlines) - time.time()) if deadlines else None
+
+    def run(self):
+        if self.loop == 'asyncio':
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self._run_async())
+            finally:
+                loop.close()
+            return
 
-                    self.shutdown()
-                    raise
+        # if we get an empty list, either everyone is blocked, or they are all finished
+        run_list = self._get_next_round()
+        while run_list:
+            for inter in run_list:
+                self._run_slice(inter)
+            run_list = self._get_next_round()
+
+        self.logger.info('Exiting...')
 
-            list = self._get_next_round()
+    async def _run_async(self):
+        """ run() as a task of an event loop, the NetHandler's tasks handle
+        packets in between the slices of the threads """
+        self._comms.start()
+
+        run_list = await self._get_next_round_async()
+        while run_list:
+            yield_at = perf_counter() + LOOP_SLICE
+            for inter in run_list:
+                self._run_slice(inter)
+                if perf_counter() >= yield_at:
+                    await asyncio.sleep(0)
+                    yield_at = perf_counter() + LOOP_SLICE
+            run_list = await self._get_next_round_async()
 
         self.logger.info('Exiting...')
+        await self._comms.closed()
+
+    def _run_slice(self, inter):
+        try:
+            #print('running', inter.program_id, inter.thread_id)
+            started, steps = perf_counter(), inter.steps
+            status = inter.exec_slice(self.quantum, self.time_quantum)
+            self._scheduler.account(inter, perf_counter() - started)
+            self._steps += inter.steps - steps
+        except Exception as ex:
+            self.logger.error('Thread failed')
+            self.logger.error(str(ex))
+
+            self.on_thread_fail(inter)
+
+            self.shutdown()
+            raise
+
+        if status == InterpreterStatus.RUNNING:
+            # quantum expired
+            self._scheduler.add(inter)
+            return
+
+        # interpreter changed the status of this thread
+        if status == InterpreterStatus.BLOCKED:
+            self.update_status(
+                inter.thread_uid,
+                inter.runtime_id,
+                status,
+                waiting_from=inter.waiting_from
+            )
+        else:
+            self.update_status(inter.thread_uid, inter.runtime_id, status)
+
+        self._scheduler.add(inter)
 
     def check_for_requests(self):
+        # Check for what the shards sent
+        if self._pool:
+            self._pool.dispatch()
+
+        if self._deadlock_suspects:
+            now = time.time()
+            for (program_id, edges), (report_at, serials) in list(self._deadlock_suspects.items()):
+                if now >= report_at:
+                    # report it if none of its threads changed its status since
+                    del self._deadlock_suspects[ (program_id, edges) ]
+                    if self._is_deadlock(program_id, edges, serials):
+                        self._log_deadlock(program_id, edges)
+
+        if self.running:
+            self._balancer.tick()
+            self._advisor.tick()
+            if self._checkpointer:
+                self._checkpointer.tick()
+
+        # Messages that arrived for threads no longer here
+        self._comms.deliver_inbound()
+
+        # Send what waited for threads located since
+        for thread_uid in self._comms.check_discoveries():
+            self.logger.error('Could not locate thread {}, dropped the messages sent to it'.format(thread_uid))
+
         # Check for migrations sent over the network
         for thread_blob in self._comms.get_migrated_threads():
             self.unpack_thread(thread_blob)
@@ -220,7 +425,13 @@ class Runtime(object):
         # Check for status requests
         for update in self._comms.get_status_requests():
             ( (program_id, thread_id), (status, waiting_from) ) = update
-            self._own_programs[program_id][thread_id] = (status, waiting_from)
+            if program_id not in self._own_programs:
+                continue
+            if status == InterpreterStatus.FINISHED:
+                self._own_programs[program_id].pop(thread_id, None)
+            else:
+                self._own_programs[program_id][thread_id] = own_status(status, waiting_from)
+            self.sanity_check(program_id, thread_id)
 
         # Check for print requests
         for thread_uid, msg in self._comms.get_print_requests():
@@ -234,16 +445,77 @@ class Runtime(object):
                     try:
                         self.migrate_thread(*arg)
                         self._request_rep.put( (True, None) )
+                    except ShardTimeout:
+                        self._request_rep.put( (False, 'Its shard is busy, try again') )
                     except KeyError:
                         self._request_rep.put( (False, 'No such thread') )
                 elif req == LocalRequest.LIST_PROGRAMS:
                     self._request_rep.put( self.get_thread_names() )
                 elif req == LocalRequest.LIST_RUNTIMES:
                     self._request_rep.put( self._comms.get_runtimes() )
+                elif req == LocalRequest.IN_FLIGHT:
+                    self._request_rep.put( self._comms.in_flight_messages() )
+                elif req == LocalRequest.MOVE_TO_SHARD:
+                    try:
+                        self.move_thread(*arg)
+                        self._request_rep.put( (True, None) )
+                    except ShardTimeout:
+                        self._request_rep.put( (False, 'Its shard is busy, try again') )
+                    except KeyError:
+                        self._request_rep.put( (False, 'No such thread') )
+                    except (IndexError, TypeError):
+                        self._request_rep.put( (False, 'No such shard') )
+                elif req == LocalRequest.PROFILE:
+                    try:
+                        self.set_profiling(arg)
+                        self._request_rep.put( (True, None) )
+                    except ValueError as ex:
+                        self._request_rep.put( (False, str(ex)) )
+                elif req == LocalRequest.PROFILE_REPORT:
+                    self._request_rep.put( [ (program_id, profile.hot_lines(arg))
+                        for program_id, profile in self._profiles.items() ] )
+                elif req == LocalRequest.PROFILE_EXPORT:
+                    self._request_rep.put( ''.join(profile.collapsed()
+                        for profile in self._profiles.values()) )
+                elif req == LocalRequest.SET_WEIGHT:
+                    try:
+                        self.set_weight(*arg)
+                        self._request_rep.put( (True, None) )
+                    except ValueError as ex:
+                        self._request_rep.put( (False, str(ex)) )
+                elif req == LocalRequest.CPU_SHARE:
+                    self._request_rep.put( self.cpu_share() )
+                elif req == LocalRequest.AUTO_BALANCE:
+                    if arg == 'on':
+                        self._balancer.start()
+                    elif arg == 'off':
+                        self._balancer.stop()
+                    self._request_rep.put( self._balancer.status() )
+                elif req == LocalRequest.COLOCATE:
+                    if arg == 'on':
+                        self._advisor.start()
+                    elif arg == 'off':
+                        self._advisor.stop()
+                    else:
+                        self._advisor.propose()
+                    self._request_rep.put( self._advisor.status() )
+                elif req == LocalRequest.CHECKPOINT:
+                    if self._checkpointer is None:
+                        self._request_rep.put( (False, 'Checkpoints are off') )
+                    elif arg == 'now':
+                        stats = self._checkpointer.checkpoint()
+                        if stats is None:
+                            self._request_rep.put( (False, 'A shard is busy, try again') )
+                        else:
+                            self._request_rep.put( (True, stats) )
+                    else:
+                        self._request_rep.put( (True, self._checkpointer.last) )
         except Empty:
             pass
 
         if not self.running:
+            if self._pool:
+                self._pool.shutdown()
             self._comms.shutdown()
 
     def get_local_result(self):
@@ -261,45 +533,81 @@ class Runtime(object):
 
         return (programs, program_threads)
 
-    def sanity_check(self, program_id):
-        total_threads = len(self._own_programs[program_id])
-        finished_threads = sum( status == InterpreterStatus.FINISHED
-                                for status, _ in self._own_programs[program_id].values() )
-        blocked_threads = 0
-        local_threads = 0
-        for thread_id, (status, waiting_from) in self._own_programs[program_id].items():
-            #print('{}: ({}, {})'.format(thread_id, status, waiting_from))
-            if thread_id not in self._programs[program_id]:
-                continue
-
-            # Only local programs
-            if (status == InterpreterStatus.BLOCKED and
-                    not self._comms.can_receive_message(waiting_from, (program_id, thread_id)) ):
-                blocked_threads += 1
-
-            local_threads += 1
-
-        if finished_threads == total_threads:
+    def sanity_check(self, program_id, thread_id):
+        """ Look for a deadlock after the status of a thread changed, it only
+        touches the edge of the wait-for graph the thread owns """
+        threads = self._own_programs[program_id]
+        if not threads:
+            # finished threads are forgotten
             self.logger.info('Program {} finished.'.format(program_id))
-            del self._programs[program_id]
-
-            if program_id in self._own_programs:
-                del self._own_programs[program_id]
-
-        elif blocked_threads == local_threads:
-            #print( self._own_programs[program_id] )
-
-            for thread_id, (status, waiting_from) in self._own_programs[program_id].items():
-                if thread_id in self._programs[program_id]:
-                    continue
-
-                # Only migrated programs
-                if status != InterpreterStatus.BLOCKED:
-                    return
-                elif self._comms.can_receive_message(waiting_from, (program_id, thread_id)):
-                    return
-
-            self.logger.error('Program {} is in a DEADLOCK'.format(program_id))
+            self._programs.pop(program_id, None)
+            del self._own_programs[program_id]
+            del self._wait_for[program_id]
+            return
+
+        graph = self._wait_for[program_id]
+        if thread_id not in threads:
+            # finished, whoever waits for it waits forever
+            graph.remove_edge(thread_id)
+            for waiter in list(graph.waiters(thread_id)):
+                self._report_deadlock(program_id, ( (waiter, thread_id), ))
+            return
+
+        status, waiting_from = threads[thread_id]
+        if status != InterpreterStatus.BLOCKED:
+            graph.remove_edge(thread_id)
+            return
+
+        sender = waiting_from[1]
+        cycle = graph.add_edge(thread_id, sender)
+        if cycle is not None:
+            self._report_deadlock(program_id, tuple(zip(cycle, cycle[1:] + cycle[:1])))
+        elif sender not in threads:
+            self._report_deadlock(program_id, ( (thread_id, sender), ))
+
+    def _is_deadlock(self, program_id, edges, serials=None):
+        """ Whether every (waiter, sender) edge still holds, with no message
+        on its way. With serials, the edges must be the very same ones """
+        graph = self._wait_for.get(program_id)
+        if graph is None:
+            return False
+
+        for index, (waiter, sender) in enumerate(edges):
+            if graph.waiting_for(waiter) != sender:
+                return False
+            if serials is not None and graph.serial(waiter) != serials[index]:
+                return False
+            if self._comms.can_receive_message( (program_id, sender), (program_id, waiter) ):
+                return False
+        return True
+
+    def _report_deadlock(self, program_id, edges):
+        if not self._is_deadlock(program_id, edges):
+            return
+
+        if self._pool or any( self._comms.get_thread_location( (program_id, waiter) ) != self.id
+                for waiter, _ in edges ):
+            # a message may still be on its way, see DEADLOCK_GRACE
+            graph = self._wait_for[program_id]
+            self._deadlock_suspects[ (program_id, edges) ] = (time.time() + DEADLOCK_GRACE,
+                    [ graph.serial(waiter) for waiter, _ in edges ])
+            return
+
+        self._log_deadlock(program_id, edges)
+
+    def _log_deadlock(self, program_id, edges):
+        threads = [ str(waiter) for waiter, _ in edges ]
+        last = edges[-1][1]
+        threads.append(str(last) if last in self._own_programs[program_id] else '{} (finished)'.format(last))
+        self.logger.error('Program {} is in a DEADLOCK: {}'.format(program_id, ' -> '.join(threads)))
+
+    def restore_own_programs(self, own_programs):
+        """ Called from Checkpointer, the wait-for graphs are built anew """
+        for program_id, threads in own_programs.items():
+            self._own_programs[program_id] = dict(threads)
+            self._wait_for[program_id] = WaitForGraph()
+            for thread_id in threads:
+                self.sanity_check(program_id, thread_id)
 
     def update_status(self, thread_uid, runtime_id, new_status, waiting_from=None):
         """ Update status, if this is not our thread notify
@@ -311,7 +619,7 @@ class Runtime(object):
 
         program_id, thread_id = thread_uid
         if program_id in self._own_programs:
-            self._own_programs[program_id][thread_id] = (new_status, waiting_from)
+            self._own_programs[program_id][thread_id] = own_status(new_status, waiting_from)
         else:
             self.logger.debug('Notify runtime: {}'.format(runtime_id))
             self._comms.send_status_request(
@@ -328,16 +636,61 @@ class Runtime(object):
             # delete finished thread
             self.logger.debug("{}.{} finished".format(program_id, thread_id))
             del self._programs[program_id][thread_id]
+            self._comms.drop_channels(thread_uid)
 
             if program_id in self._own_programs:
                 del self._own_programs[program_id][thread_id]
 
         if program_id in self._own_programs:
-            self.sanity_check(program_id)
+            self.sanity_check(program_id, thread_id)
+
+    def set_profiling(self, enabled):
+        """ Turn profiling of all threads on or off. Turning it on starts
+        new profiles, the last ones are kept for reports until then """
+        if self._pool:
+            raise ValueError('Profiling is not available with shards')
+
+        self.profiling = enabled
+        if enabled:
+            self._profiles = dict()
+
+        for threads in self._programs.values():
+            for inter in threads.values():
+                self._set_profile(inter)
+
+    def _set_profile(self, inter):
+        if not self.profiling:
+            inter.set_profile(None)
+            return
+
+        if inter.program_id not in self._profiles:
+            self._profiles[inter.program_id] = Profile(inter.program_id)
+        inter.set_profile(self._profiles[inter.program_id])
+
+    def set_weight(self, program_id, weight):
+        """ Set the cpu share of a program under the fair policy, relative
+        to the weights of the others """
+        self._scheduler.policy.set_weight(program_id, weight)
+        if self._pool:
+            self._pool.set_weight(program_id, weight)
+
+    def cpu_share(self):
+        """ Returns { program_id: (weight, seconds, share) } of the cpu time
+        the threads of each program took so far """
+        if self._pool:
+            return self._scheduler.policy.cpu_share(self._pool.cpu_time())
+        return self._scheduler.policy.cpu_share()
+
+    def steps(self):
+        """ Instructions the threads ran here so far """
+        if self._pool:
+            return self._steps + self._pool.steps()
+        return self._steps
 
     def add_local_request(self, type, arg=None):
         """ Called from the shell to serve a request """
         self._request_q.put( (type, arg) )
+        self._comms.wakeup.set()
 
     def migrate_thread(self, program_id, thread_id, runtime_id):
         """ Start the migration process for thread_uid to runtime_id """
@@ -355,6 +708,25 @@ class Runtime(object):
             self.logger.warning('Migration failed')
         else:
             self.logger.info('Migration completed!')
+        return success
+
+
+    def move_thread(self, program_id, thread_id, shard):
+        """ Move a thread to another shard of this runtime """
+        if not self._pool or not 0 <= shard < self._pool.count:
+            raise IndexError(shard)
+
+        self.unpack_thread(self.pack_thread(program_id, thread_id), shard)
+
+
+# (status, None) entries of _own_programs, shared by all threads not blocked
+_unblocked = { status: (status, None) for status in InterpreterStatus }
+
+def own_status(status, waiting_from=None):
+    """ The (status, waiting_from) entry of a thread in _own_programs """
+    if waiting_from is None:
+        return _unblocked[status]
+    return (status, waiting_from)
 
 
 class ThreadPackage(object):
@@ -381,12 +753,13 @@ class ThreadPackage(object):
                 messages
                 )
 
-    def pack(self):
-        """ Pack into network-friendly transferable binary blob """
+    def pack(self, preset=None):
+        """ Pack into network-friendly transferable binary blob, 'preset'
+        trades size for speed, see lzma """
         package = (self.runtime_id, self.program_id,
                 self.thread_id, self.code, self.state, self.pending_msgs)
         dump = pickle.dumps(package, pickle.HIGHEST_PROTOCOL)
-        return lzma.compress(dump)
+        return lzma.compress(dump, preset=preset)
 
     @classmethod
     def unpack(cls, blob):
@@ -0,0 +1,131 @@
+"""
+Keeps track of which threads of a runtime can run
+"""
+import time
+import heapq
+import itertools
+from collections import deque
+
+from .inter import InterpreterStatus
+from .policy import RoundRobinPolicy
+
+
+class Scheduler(object):
+    """ Event driven scheduler, a round only costs as much as the threads
+    that can run in it.
+
+    Threads live in exactly one of:
+        -- the scheduling policy, while RUNNING
+        -- the sleep heap, keyed by wake_up_at, while SLEEPING
+        -- the wait map, keyed by the (recv, sender) channel they wait on,
+           while BLOCKED
+        -- the resolve map, keyed by the thread they sent to, while
+           RESOLVING its location
+
+    Message arrivals are reported by NetworkCommunication through
+    message_arrived(), possibly from the NetHandler thread, and only wake
+    the thread waiting on that channel.
+
+    Which of the ready threads run in a round is up to the policy, see
+    SchedulingPolicy.
+    """
+    def __init__(self, comms, policy=None):
+        self._comms = comms
+        self.policy = RoundRobinPolicy() if policy is None else policy
+        self._threads = { }     # thread_uid -> interpreter, all scheduled threads
+        self._sleeping = [ ]    # heap of (wake_up_at, seq, interpreter)
+        self._waiting = { }     # (recv, sender) -> interpreter
+        self._arrivals = deque() # channels with new messages, thread safe
+        self._resolving = { }   # thread_uid -> [ interpreters that sent to it ]
+        self._located = deque() # thread_uids no longer resolving
+        self._seq = itertools.count()   # keeps heap entries comparable
+
+        comms.set_message_listener(self.message_arrived)
+        comms.set_location_listener(self.thread_located)
+
+    def __len__(self):
+        return len(self._threads)
+
+    def add(self, inter):
+        """ Schedule a thread according to its status """
+        self._threads[inter.thread_uid] = inter
+
+        status = inter.status
+        if status == InterpreterStatus.RUNNING:
+            self.policy.push(inter)
+        elif status == InterpreterStatus.SLEEPING:
+            heapq.heappush(self._sleeping, (inter.wake_up_at, next(self._seq), inter))
+        elif status == InterpreterStatus.BLOCKED:
+            channel = (inter.thread_uid, inter.waiting_from)
+            self._waiting[channel] = inter
+            if self._comms.can_receive_message(inter.waiting_from, inter.thread_uid):
+                # arrived before we got to park it, wake it up on the next round
+                self._arrivals.append(channel)
+        elif status == InterpreterStatus.RESOLVING:
+            self._resolving.setdefault(inter.waiting_from, [ ]).append(inter)
+            if not self._comms.is_resolving(inter.waiting_from):
+                # located before we got to park it, or somewhere else
+                self._located.append(inter.waiting_from)
+        else:
+            # finished, crashed or stopped threads don't run again
+            del self._threads[inter.thread_uid]
+
+    def remove(self, inter):
+        """ Unschedule a thread, ready and sleeping entries are dropped lazily """
+        if self._threads.get(inter.thread_uid) is not inter:
+            return
+
+        del self._threads[inter.thread_uid]
+        channel = (inter.thread_uid, inter.waiting_from)
+        if self._waiting.get(channel) is inter:
+            del self._waiting[channel]
+
+    def message_arrived(self, recv, sender):
+        """ Called from NetworkCommunication when a message is queued """
+        self._arrivals.append( (recv, sender) )
+
+    def thread_located(self, thread_uid):
+        """ Called from NetworkCommunication once the location of a thread
+        is discovered, or given up """
+        self._located.append(thread_uid)
+
+    def wake_up(self, now=None):
+        """ Move the threads whose sleep expired or whose message arrived
+        to the ready queue, returns them """
+        woken = [ ]
+
+        while self._arrivals:
+            inter = self._waiting.pop(self._arrivals.popleft(), None)
+            if inter is not None:
+                woken.append(inter)
+
+        while self._located:
+            for inter in self._resolving.pop(self._located.popleft(), ( )):
+                if (self._threads.get(inter.thread_uid) is inter
+                        and inter.status == InterpreterStatus.RESOLVING):
+                    woken.append(inter)
+
+        if self._sleeping:
+            now = time.time() if now is None else now
+            while self._sleeping and self._sleeping[0][0] <= now:
+                wake_up_at, _, inter = heapq.heappop(self._sleeping)
+                if (self._threads.get(inter.thread_uid) is inter
+                        and inter.status == InterpreterStatus.SLEEPING
+                        and inter.wake_up_at == wake_up_at):
+                    woken.append(inter)
+
+        for inter in woken:
+            self.policy.push(inter)
+        return woken
+
+    def next_round(self):
+        """ Returns the threads to run this round, as the policy picks them """
+        return self.policy.next_round(lambda inter: self._threads.get(inter.thread_uid) is inter)
+
+    def account(self, inter, seconds):
+        """ A thread ran for 'seconds' """
+        self.policy.account(inter, seconds)
+
+    def next_deadline(self):
+        """ The earliest wake_up_at of the sleeping threads, or None """
+        return self._sleeping[0][0] if self._sleeping else None
@@ -0,0 +1,578 @@
+"""
+Runs the threads of a runtime on a pool of worker processes (shards)
+"""
+import time
+import multiprocessing
+from collections import deque
+from time import perf_counter
+from queue import Queue, Empty
+from threading import Thread
+
+from .inter import SimpleScriptInterpreter, InterpreterStatus
+from .scheduler import Scheduler
+from .policy import POLICIES
+from .source import intern_code
+from .checkpoint import dirty_packages
+
+PACK_TIMEOUT = 10   # seconds to wait for a shard to pack a thread
+CPU_REPORT_INTERVAL = 1.0   # seconds between the cpu time reports of a shard
+
+
+class ShardTimeout(KeyError):
+    """ A shard did not answer within PACK_TIMEOUT. It keeps running the
+    thread it was to pack, or the snapshot it was to take part in is dropped """
+
+
+class ShardThread(object):
+    """ Stands for a thread run by a shard, in the threads' tree of the runtime """
+    def __init__(self, program_id, thread_id, runtime_id, status, shard):
+        self.program_id = program_id
+        self.thread_id = thread_id
+        self.thread_uid = (program_id, thread_id)
+        self.runtime_id = runtime_id
+        self.status = status
+        self.shard = shard
+
+
+class ShardPool(object):
+    """ The runtime side of sharded execution.
+
+    Each shard is a process running the threads placed on it with its own
+    scheduler. Shards exchange messages between their threads directly,
+    through the multiprocessing queue every shard reads (its inbox), and
+    send everything else to the runtime: status changes, prints and messages
+    for threads they don't know of. For NetworkCommunication a sharded
+    thread is local, with its shard as a sub-location.
+
+    Threads move between shards as ThreadPackages, without touching the
+    network. Messages still in flight to the old shard are forwarded through
+    the runtime, so they may overtake newer ones while a thread moves.
+    """
+    def __init__(self, runtime, count, quantum, time_quantum=None, policy='round_robin'):
+        self.runtime = runtime
+        self.count = count
+        self.threads = { }      # thread_uid -> ShardThread
+        self._cpu_time = [ { } for _ in range(count) ]  # program_id -> seconds, of each shard
+        self._steps = [ 0 ] * count     # instructions run, of each shard
+        self._snapshots = 0
+        self._full = False      # the next snapshot packs every thread, see snapshot()
+        self._late = { }        # thread_uid -> shard, of the packs that timed out
+
+        self._outbox = multiprocessing.Queue()      # shards -> runtime
+        self._replies = multiprocessing.Queue()     # packed threads
+        self._inboxes = [ multiprocessing.Queue() for _ in range(count) ]
+        self._events = Queue()
+
+        self._processes = [ ]
+        for index in range(count):
+            process = multiprocessing.Process(
+                    target=shard_main,
+                    args=(index, self._inboxes, self._outbox, self._replies,
+                        quantum, time_quantum, policy),
+                    daemon=True)
+            process.start()
+            self._processes.append(process)
+
+        # hand events over to the runtime thread, and wake it up
+        self._pump_thread = Thread(target=self._pump, daemon=True)
+        self._pump_thread.start()
+
+        runtime._comms.set_shard_router(self.route_message)
+
+    def _pump(self):
+        while True:
+            event = self._outbox.get()
+            if event is None:
+                break
+            self._events.put(event)
+            self.runtime._comms.wakeup.set()
+
+    def place(self, blob, package, shard=None):
+        """ Run a packed thread on a shard, the least loaded if not given """
+        if shard is None:
+            loads = [ 0 ] * self.count
+            for thread in self.threads.values():
+                loads[thread.shard] += 1
+            shard = loads.index(min(loads))
+
+        thread_uid = (package.program_id, package.thread_id)
+        thread = ShardThread(package.program_id, package.thread_id, package.runtime_id,
+                InterpreterStatus(package.state[3]), shard)
+        self.threads[thread_uid] = thread
+
+        self._inboxes[shard].put( ('thread', blob) )
+        self._set_location(thread_uid, shard)
+        return thread
+
+    def pack(self, thread_uid):
+        """ Take a thread off its shard, returns its package blob """
+        if thread_uid in self._late:
+            self._take_late()
+            if thread_uid in self._late:
+                raise ShardTimeout(thread_uid)
+
+        thread = self.threads.pop(thread_uid)
+        self._set_location(thread_uid, None)
+        self._inboxes[thread.shard].put( ('pack', thread_uid) )
+
+        try:
+            uid, blob = self._reply()
+        except Empty:
+            # busy shard, the thread goes back once it packs it
+            self._late[thread_uid] = thread.shard
+            self.threads[thread_uid] = thread
+            self._set_location(thread_uid, thread.shard)
+            raise ShardTimeout(thread_uid)
+
+        if blob is None:
+            # finished before it got packed, its status is on the way
+            self.threads[thread_uid] = thread
+            raise KeyError(thread_uid)
+        return blob
+
+    def _reply(self, block=True, snapshot=None):
+        """ The next reply of the shards, late ones of pack() put their thread
+        back. Replies to snapshots other than 'snapshot' are dropped """
+        while True:
+            reply = self._replies.get(block, timeout=PACK_TIMEOUT)
+            if len(reply) == 4:
+                if reply[0] == snapshot:
+                    return reply
+                continue
+            if reply[0] in self._late:
+                thread_uid, blob = reply
+                shard = self._late.pop(thread_uid)
+                if blob is not None:
+                    self._inboxes[shard].put( ('thread', blob) )
+                continue
+            return reply
+
+    def _take_late(self):
+        """ Handle the late replies that arrived by now """
+        try:
+            self._reply(block=False)
+        except Empty:
+            pass
+
+    def drop_program(self, program_id):
+        for thread_uid in [ uid for uid in self.threads if uid[0] == program_id ]:
+            del self.threads[thread_uid]
+            self._set_location(thread_uid, None)
+
+        for inbox in self._inboxes:
+            inbox.put( ('drop', program_id) )
+
+    def set_weight(self, program_id, weight):
+        for inbox in self._inboxes:
+            inbox.put( ('weight', program_id, weight) )
+
+    def cpu_time(self):
+        """ Returns { program_id: seconds } of all shards, as last reported """
+        total = { }
+        for cpu_time in self._cpu_time:
+            for program_id, seconds in cpu_time.items():
+                total[program_id] = total.get(program_id, 0.0) + seconds
+        return total
+
+    def steps(self):
+        """ Instructions all shards ran, as last reported """
+        return sum(self._steps)
+
+    def snapshot(self):
+        """ Called from Checkpointer. Returns ({ thread_uid: blob } of the
+        threads that changed since the last snapshot, the uids of all the
+        threads, [ (recv, sender, msg) ] of the messages in flight).
+
+        Every shard packs its threads and sends a marker to the runtime and
+        to the other shards, the messages a shard or the runtime gets before
+        the marker of their sender are in flight (a Chandy-Lamport snapshot).
+        The request for the snapshot is the marker of the runtime.
+
+        Raises ShardTimeout if a shard doesn't take part within PACK_TIMEOUT.
+        The shards that did count their threads as written, so the next
+        snapshot packs them all again. What is left of the dropped snapshot
+        is told apart by its number.
+        """
+        self._snapshots += 1
+        for inbox in self._inboxes:
+            inbox.put( ('snapshot', self._full, self._snapshots) )
+
+        try:
+            snapshot = self._collect_snapshot()
+        except Empty:
+            self._full = True
+            raise ShardTimeout(self._snapshots)
+
+        self._full = False
+        return snapshot
+
+    def _collect_snapshot(self):
+        in_flight = [ ]
+        waiting = set(range(self.count))
+        while waiting:
+            event = self._events.get(timeout=PACK_TIMEOUT)
+            if event[0] == 'marker':
+                if event[-1] == self._snapshots:
+                    waiting.discard(event[1])
+                continue
+            if event[0] == 'message' and event[4] in waiting:
+                in_flight.append(event[1:4])
+            self._handle(event)
+
+        blobs, alive = { }, set()
+        for _ in range(self.count):
+            _, shard_blobs, shard_alive, shard_in_flight = self._reply(snapshot=self._snapshots)
+            if shard_blobs is None:
+                # the shard gave up waiting for the others
+                raise Empty()
+            blobs.update(shard_blobs)
+            alive.update(shard_alive)
+            in_flight.extend(shard_in_flight)
+        return blobs, alive, in_flight
+
+    def route_message(self, shard, recv, sender, msg):
+        """ Called from NetworkCommunication for messages to sharded threads """
+        self._inboxes[shard].put( ('message', recv, sender, msg) )
+
+    def _set_location(self, thread_uid, shard):
+        self.runtime._comms.update_shard_location(thread_uid, shard)
+        for inbox in self._inboxes:
+            inbox.put( ('location', thread_uid, shard) )
+
+    def dispatch(self):
+        """ Called from Runtime to handle what the shards sent """
+        while True:
+            try:
+                event = self._events.get(block=False)
+            except Empty:
+                break
+            self._handle(event)
+
+    def _handle(self, event):
+        runtime = self.runtime
+        comms = runtime._comms
+
+        kind = event[0]
+        if kind == 'status':
+            _, thread_uid, runtime_id, status, waiting_from = event
+            thread = self.threads.get(thread_uid)
+            if thread is None:
+                return # moved away meanwhile
+            if status == InterpreterStatus.FINISHED:
+                del self.threads[thread_uid]
+            runtime.update_status(thread_uid, runtime_id, status, waiting_from)
+        elif kind == 'message':
+            recv, sender, msg = event[1:4]
+            comms.send_message(recv, sender, msg)
+        elif kind == 'print':
+            _, runtime_id, thread_uid, msg = event
+            comms.send_print_request(runtime_id, thread_uid, msg)
+        elif kind == 'failed':
+            _, thread_uid, error = event
+            runtime.logger.error('Thread failed')
+            runtime.logger.error(error)
+            thread = self.threads.get(thread_uid)
+            if thread is not None:
+                self.drop_program(thread.program_id)
+                runtime.on_thread_fail(thread)
+        elif kind == 'cpu':
+            _, index, cpu_time, steps, traffic = event
+            self._cpu_time[index] = cpu_time
+            self._steps[index] = steps
+            comms.add_traffic(traffic)
+
+    def shutdown(self):
+        for inbox in self._inboxes:
+            inbox.put( ('shutdown',) )
+        for process in self._processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+        if self._processes:
+            self._outbox.put(None)
+        self._processes = [ ]
+
+
+class ShardCommunication(object):
+    """ The communication of the threads of a shard, it offers the interpreters
+    the same interface NetworkCommunication does """
+    def __init__(self, index, inboxes, outbox):
+        self.index = index
+        self._inboxes = inboxes
+        self._outbox = outbox
+
+        self._messages = { }    # recv -> { sender -> deque of messages, oldest first }
+        self._locations = { }   # thread_uid -> shard, of every sharded thread
+        self._message_listener = None
+        self._traffic = { }     # (sender, recv) -> messages passed without the runtime
+
+    def set_message_listener(self, listener):
+        self._message_listener = listener
+
+    def set_location_listener(self, listener):
+        pass # the runtime resolves the threads shards send to
+
+    def is_resolving(self, thread_uid):
+        return False
+
+    def update_location(self, thread_uid, shard):
+        if shard is None:
+            self._locations.pop(thread_uid, None)
+        else:
+            self._locations[thread_uid] = shard
+
+    def receive_message(self, sender, recv):
+        queue = self._messages.get(recv, { }).get(sender)
+        if queue:
+            return queue.popleft()
+        return None
+
+    def can_receive_message(self, sender, recv):
+        return bool(self._messages.get(recv, { }).get(sender))
+
+    def receive_all_messages(self, thread_uid):
+        channels = self._messages.pop(thread_uid, { })
+        return { (thread_uid, sender): list(queue) for sender, queue in channels.items() if queue }
+
+    def drop_channels(self, thread_uid):
+        self._messages.pop(thread_uid, None)
+
+    def restore_messages(self, thread_uid, messages):
+        for (recv, sender), queue in messages.items():
+            for msg in queue:
+                self.add_message(recv, sender, msg)
+
+    def add_message(self, recv, sender, msg):
+        self._messages.setdefault(recv, { }).setdefault(sender, deque()).append(msg)
+        if self._message_listener is not None:
+            self._message_listener(recv, sender)
+
+    def send_message(self, recv, sender, msg):
+        shard = self._locations.get(recv)
+        if shard is not None:
+            pair = (sender, recv)
+            self._traffic[pair] = self._traffic.get(pair, 0) + 1
+
+        if shard == self.index:
+            self.add_message(recv, sender, msg)
+        elif shard is not None:
+            self._inboxes[shard].put( ('message', recv, sender, msg, self.index) )
+        else:
+            # another runtime, or a shard we haven't heard of yet
+            self._outbox.put( ('message', recv, sender, msg, self.index) )
+        return True
+
+    def take_traffic(self):
+        traffic, self._traffic = self._traffic, { }
+        return traffic
+
+    def peek_messages(self):
+        return { (recv, sender): list(queue) for recv, channels in self._messages.items()
+                for sender, queue in channels.items() }
+
+    def send_print_request(self, orig_runtime_id, thread_uid, msg):
+        self._outbox.put( ('print', orig_runtime_id, thread_uid, msg) )
+
+    def send_to_runtime(self, event):
+        self._outbox.put(event)
+
+    def send_status(self, inter):
+        waiting_from = inter.waiting_from if inter.status == InterpreterStatus.BLOCKED else None
+        self._outbox.put( ('status', inter.thread_uid, inter.runtime_id, inter.status, waiting_from) )
+
+
+class ShardWorker(object):
+    """ Runs the threads placed on a shard, see ShardPool """
+    def __init__(self, index, inboxes, outbox, replies, quantum, time_quantum, policy):
+        self.index = index
+        self.quantum = quantum
+        self.time_quantum = time_quantum
+        self.running = True
+
+        self._inbox = inboxes[index]
+        self._replies = replies
+        self._comms = ShardCommunication(index, inboxes, outbox)
+        self._scheduler = Scheduler(self._comms, POLICIES[policy]())
+        self._threads = { }     # thread_uid -> interpreter
+        self._next_report = 0
+        self._ran = False       # since the last cpu time report
+        self._steps = 0
+
+        self._inboxes = inboxes
+        self._snapshot = 0      # of the last snapshot taken
+        self._written = { }     # see dirty_packages()
+
+    def run(self):
+        while self.running:
+            self._handle_events(block=False)
+            self._report_cpu()
+
+            for inter in self._scheduler.wake_up():
+                inter.status = InterpreterStatus.RUNNING
+                self._comms.send_status(inter)
+
+            run_list = self._scheduler.next_round()
+            if not run_list:
+                self._handle_events(block=True)
+                continue
+
+            for inter in run_list:
+                if self._threads.get(inter.thread_uid) is not inter:
+                    continue # packed or dropped during this round
+
+                try:
+                    started, steps = perf_counter(), inter.steps
+                    status = inter.exec_slice(self.quantum, self.time_quantum)
+                    self._scheduler.account(inter, perf_counter() - started)
+                    self._steps += inter.steps - steps
+                    self._ran = True
+                except Exception as ex:
+                    self._comms.send_to_runtime( ('failed', inter.thread_uid, str(ex)) )
+                    self._drop(inter)
+                    continue
+
+                if status != InterpreterStatus.RUNNING:
+                    self._comms.send_status(inter)
+                    if status == InterpreterStatus.FINISHED:
+                        del self._threads[inter.thread_uid]
+                        self._comms.drop_channels(inter.thread_uid)
+
+                self._scheduler.add(inter)
+
+    def _report_cpu(self):
+        if self._ran and time.time() >= self._next_report:
+            self._ran = False
+            self._next_report = time.time() + CPU_REPORT_INTERVAL
+            self._comms.send_to_runtime( ('cpu', self.index, dict(self._scheduler.policy.cpu_time),
+                self._steps, self._comms.take_traffic()) )
+
+    def _handle_events(self, block):
+        timeout = None
+        if block:
+            deadlines = [ deadline for deadline in (self._scheduler.next_deadline(),
+                self._next_report if self._ran else None) if deadline is not None ]
+            timeout = max(0, min(deadlines) - time.time()) if deadlines else None
+
+        while True:
+            try:
+                event = self._inbox.get(block=block, timeout=timeout)
+            except Empty:
+                return
+            self._handle(event)
+            block = False
+
+    def _handle(self, event):
+        kind = event[0]
+        if kind == 'message':
+            recv, sender, msg = event[1:4]
+            if recv in self._threads:
+                self._comms.add_message(recv, sender, msg)
+            else:
+                # moved away, the runtime knows where
+                self._comms.send_to_runtime( ('message', recv, sender, msg, self.index) )
+        elif kind == 'location':
+            _, thread_uid, shard = event
+            self._comms.update_location(thread_uid, shard)
+        elif kind == 'thread':
+            self._unpack(event[1])
+        elif kind == 'pack':
+            thread_uid = event[1]
+            inter = self._threads.get(thread_uid)
+            if inter is None:
+                # finished meanwhile
+                self._replies.put( (thread_uid, None) )
+                return
+            self._drop(inter)
+            messages = self._comms.receive_all_messages(thread_uid)
+            self._replies.put( (thread_uid, thread_package().from_inter(inter, messages).pack()) )
+        elif kind == 'drop':
+            for inter in [ inter for inter in self._threads.values() if inter.program_id == event[1] ]:
+                self._drop(inter)
+        elif kind in ('snapshot', 'marker'):
+            # whichever comes first, see ShardPool.snapshot()
+            if event[-1] > self._snapshot:
+                self._take_snapshot(event)
+        elif kind == 'weight':
+            _, program_id, weight = event
+            self._scheduler.policy.set_weight(program_id, weight)
+        elif kind == 'shutdown':
+            self.running = False
+
+    def _take_snapshot(self, first):
+        self._snapshot = first[-1]
+        full = first[-2]
+        if full:
+            # the last snapshot was dropped, with what got packed for it
+            self._written.clear()
+        threads = list(self._threads.values())
+        blobs = dirty_packages(threads, self._comms, self._written)
+
+        marker = ('marker', self.index, full, self._snapshot)
+        for index, inbox in enumerate(self._inboxes):
+            if index != self.index:
+                inbox.put(marker)
+        self._comms.send_to_runtime(marker)
+
+        # record what the others sent before their snapshot, None is the runtime
+        alive = { inter.thread_uid for inter in threads }
+        in_flight = [ ]
+        waiting = set(range(len(self._inboxes))) - { self.index }
+        waiting.add(None)
+        waiting.discard(first[1] if first[0] == 'marker' else None)
+        while waiting:
+            try:
+                event = self._inbox.get(timeout=PACK_TIMEOUT)
+            except Empty:
+                # a shard is busy or gone, the runtime drops this snapshot
+                self._replies.put( (self._snapshot, None, None, None) )
+                return
+
+            kind = event[0]
+            if kind in ('snapshot', 'marker') and event[-1] == self._snapshot:
+                waiting.discard(event[1] if kind == 'marker' else None)
+                continue
+
+            if kind == 'thread' and None in waiting:
+                inter = self._unpack(event[1])
+                blobs[inter.thread_uid] = event[1]
+                alive.add(inter.thread_uid)
+                continue
+
+            source = event[4] if kind == 'message' and len(event) == 5 else None
+            if kind == 'message' and source in waiting:
+                in_flight.append(event[1:4])
+            self._handle(event)
+
+        self._replies.put( (self._snapshot, blobs, alive, in_flight) )
+
+    def _unpack(self, blob):
+        package = thread_package().unpack(blob)
+        inter = SimpleScriptInterpreter(
+                thread_id=package.thread_id,
+                program_id=package.program_id,
+                runtime_id=package.runtime_id,
+                code=intern_code(package.code),
+                communication=self._comms
+        )
+        self._comms.restore_messages( (package.program_id, package.thread_id), package.pending_msgs)
+        inter.load_state(package.state)
+
+        self._threads[inter.thread_uid] = inter
+        self._comms.update_location(inter.thread_uid, self.index)
+        self._scheduler.add(inter)
+        return inter
+
+    def _drop(self, inter):
+        del self._threads[inter.thread_uid]
+        self._scheduler.remove(inter)
+
+
+def thread_package():
+    # runtime imports this module
+    from .runtime import ThreadPackage
+    return ThreadPackage
+
+def shard_main(index, inboxes, outbox, replies, quantum, time_quantum, policy):
+    """ Entry point of a shard process """
+    ShardWorker(index, inboxes, outbox, replies, quantum, time_quantum, policy).run()
@@ -1,25 +1,59 @@
 import time
+import weakref
 from pathlib import Path
 
 from ..parser.ss_parser import SimpleScriptParser
 from ..codegen.ss_generator import SimpleScriptGenerator
 from ..codegen.ss_code import SimpleScriptCodeObject
+from ..codegen.ss_optimizer import DEFAULT_LEVEL
 from ..codegen.ss_bcode import OpCode, Operation
+from ..ss_exception import CodeObjectException
 from .utils import fast_hash
 
 SKIP_OBJECT_FILE_SIZE = 600
 
+# Code objects are immutable, so all the threads running the same source share one.
+_loaded = weakref.WeakValueDictionary()     # (path, mtime, options) -> code object
+_interned = weakref.WeakValueDictionary()   # digest -> code object
+_names = weakref.WeakKeyDictionary()        # code object -> source file name
+
 def generic_load(filename, **kwargs):
+    """ Load a source or code object file, reusing the code object already
+    loaded for it unless the file has been modified since """
     filepath = Path(filename).resolve()
+    key = (str(filepath), filepath.stat().st_mtime, tuple(sorted(kwargs.items())))
+
+    code = _loaded.get(key)
+    if code is not None:
+        return code
+
     if filepath.suffix == '.ssc':
-        return load_code_object_file(filename, **kwargs)
+        # already compiled, the optimization level was chosen back then
+        code = load_code_object_file(filename)
     elif filepath.suffix == '.ss':
-        return load_source(filename, **kwargs)
+        code = load_source(filename, **kwargs)
+    else:
+        return None
+
+    code = intern_code(code)
+    _loaded[key] = code
+    _names.setdefault(code, filepath.name)
+    return code
+
+def intern_code(code):
+    """ Return the shared code object equal to 'code', used for code that
+    didn't come from a file, like the code of migrated threads """
+    return _interned.setdefault(code.digest, code)
+
+def source_name(code):
+    """ Name of the file a code object was loaded from, code that came
+    from elsewhere is named after its digest """
+    return _names.get(code) or code.digest[:8]
 
 def load_code_object_file(filename):
     return SimpleScriptCodeObject.from_file(filename, decompress=True)
 
-def _just_load(source_file):
+def _just_load(source_file, optimize):
     with source_file.open('r') as f:
         source = f.read()
 
@@ -29,46 +63,42 @@ def _just_load(source_file):
 
     # generate bytecode
     gen = SimpleScriptGenerator()
-    return gen.generate(tree)
+    return gen.generate(tree, optimize)
 
-def load_source(filename, dump_to_objet_file=True):
+def load_source(filename, dump_to_objet_file=True, optimize=DEFAULT_LEVEL):
     source_file = Path(filename).resolve()
     stat = source_file.stat()
     source_ts = stat.st_mtime
 
     if not dump_to_objet_file or stat.st_size < SKIP_OBJECT_FILE_SIZE:
         # don't dump to object file
-        return _just_load(source_file)
+        return _just_load(source_file, optimize)
 
-    # myprogram.ss -> .myprogram.ssc
+    # myprogram.ss -> .myprogram.O1.ssc, one per optimization level
     name = source_file.stem
-    code_object = source_file.parent / ('.' + name + '.ssc')
+    code_object = source_file.parent / '.{}.O{}.ssc'.format(name, optimize)
 
     if code_object.is_file() and code_object.stat().st_mtime > source_ts:
         # code object file must exist and be newer than source to be up to date
-        return load_code_object(str(code_object))
-    else:
-        # outdated or non-existant code object
-        print('Building bytecode')
-        with source_file.open('r') as f:
-            source = f.read()
+        try:
+            return load_code_object_file(str(code_object))
+        except (ValueError, CodeObjectException):
+            # built with an older instruction format, rebuild
+            pass
 
-        # parse source into tree
-        parser = SimpleScriptParser()
-        tree = parser.parse(source)
+    # outdated or non-existant code object
+    print('Building bytecode')
+    code = _just_load(source_file, optimize)
 
-        # generate bytecode
-        gen = SimpleScriptGenerator()
-        code = gen.generate(tree)
-
-        # save for future use
-        code.to_file(str(code_object), compress=True)
-        return code
+    # save for future use
+    code.to_file(str(code_object), compress=True)
+    return code
 
 
 
 MT_TAG = "#SIMPLESCRIPT_MULTITHREADED"
 T_TAG = "#THREAD"
+WEIGHT_OPTION = "weight="
 class ThreadInfo(object):
     def __init__(self, program_id, thread_id, source_file, args):
         self.source_file = source_file
@@ -84,6 +114,10 @@ class ProgramInfo(object):
             str(self._name),
             fast_hash(str(time.time()), length=4)
         )
+        self.program_id = self._program_id
+        self._sources = dict()  # source file of a thread line -> its path, checked once
+        # share of the cpu under the fair scheduling policy, None for the default
+        self.weight = None
 
     def parse(self):
         threads = list()
@@ -92,6 +126,12 @@ class ProgramInfo(object):
             if first_line[0] != MT_TAG:
                 raise ValueError('Bad file')
             total_threads = int(first_line[1])
+            for option in first_line[2:]:
+                if not option.startswith(WEIGHT_OPTION):
+                    raise ValueError('Unknown option: ' + option)
+                self.weight = float(option[len(WEIGHT_OPTION):])
+                if self.weight <= 0:
+                    raise ValueError('Weight must be positive')
             for i in range(total_threads):
                 #FIXME: Filename may contain spaces....
                 line_parts = f.readline().rstrip('\n').split()
@@ -104,11 +144,14 @@ class ProgramInfo(object):
         if parts[0] != T_TAG:
             raise ValueError('Thread tag not matching')
 
-        filepath = self._filepath.parent / parts[1].replace('"', '')
-        if not filepath.is_file():
-            raise ValueError("File doesn't exist: " + str(filepath))
+        filepath = self._sources.get(parts[1])
+        if filepath is None:
+            filepath = self._filepath.parent / parts[1].replace('"', '')
+            if not filepath.is_file():
+                raise ValueError("File doesn't exist: " + str(filepath))
+            filepath = self._sources[parts[1]] = str(filepath)
 
         for arg in parts[2:]:
             args.append(int(arg))
 
-        return ThreadInfo(self._program_id, thread_no, str(filepath), args)
+        return ThreadInfo(self._program_id, thread_no, filepath, args)
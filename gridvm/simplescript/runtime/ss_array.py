@@ -0,0 +1,98 @@
+"""
+SimpleScript array representation
+"""
+from array import array
+
+
+def _dense_index(index):
+    """ Return index as a position in a dense array, or None if it can't be one """
+    if type(index) is not int:
+        if isinstance(index, float) and index.is_integer():
+            # like a dict, 2.0 addresses the same element as 2
+            return int(index)
+        return None
+    return index if index >= 0 else None
+
+def _restore_dense(buff):
+    items = array('q')
+    items.frombytes(buff)
+    return SimpleScriptArray(items)
+
+
+class SimpleScriptArray(object):
+    """ An adaptive SimpleScript array, it behaves like the dict it replaces.
+
+    Elements are kept in a contiguous array('q') while the indexes in use are
+    0..n-1 and all values are 64 bit ints. Other values switch it to a list,
+    and any other index to a sparse dict.
+    """
+    __slots__ = ('_items',)
+
+    def __init__(self, values=()):
+        if isinstance(values, (dict, array)):
+            self._items = values
+            return
+
+        try:
+            self._items = array('q', values)
+        except (TypeError, OverflowError):
+            self._items = list(values)
+
+    def __getitem__(self, index):
+        items = self._items
+        if type(items) is dict:
+            return items[index]
+
+        position = _dense_index(index)
+        if position is None or position >= len(items):
+            raise KeyError(index)
+        return items[position]
+
+    def __setitem__(self, index, value):
+        items = self._items
+        if type(items) is dict:
+            items[index] = value
+            return
+
+        position = _dense_index(index)
+        if position is None or position > len(items):
+            # not dense anymore
+            self._items = dict(enumerate(items))
+            self._items[index] = value
+            return
+
+        try:
+            if position == len(items):
+                items.append(value)
+            else:
+                items[position] = value
+        except (TypeError, OverflowError):
+            # not a 64 bit int, box the elements
+            self._items = list(items)
+            self._items[position:position + 1] = [ value ]
+
+    def __contains__(self, index):
+        items = self._items
+        if type(items) is dict:
+            return index in items
+
+        position = _dense_index(index)
+        return position is not None and position < len(items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def items(self):
+        if type(self._items) is dict:
+            return self._items.items()
+        return enumerate(self._items)
+
+    def __reduce__(self):
+        items = self._items
+        if type(items) is array:
+            # raw machine values, no per item pickling
+            return (_restore_dense, (items.tobytes(),))
+        return (SimpleScriptArray, (items,))
+
+    def __repr__(self):
+        return '{' + ', '.join('{}: {}'.format(*item) for item in self.items()) + '}'
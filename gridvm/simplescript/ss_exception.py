@@ -8,6 +8,8 @@ def reverse_find(haystack, needle, index):
 
 
 class StatusChange(Exception):
+    """ Raised by SimpleScriptInterpreter.exec_next() only, the
+    interpreter reports status changes through return values """
     def __init__(self,runtime_id, program_id, thread_id, status):
         self.runtime_id = runtime_id
         self.program_id = program_id
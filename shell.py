@@ -10,7 +10,10 @@ from threading import Thread
 import logging
 logging.disable(logging.WARN)
 
-from gridvm.simplescript.runtime.runtime import Runtime, LocalRequest
+from gridvm.simplescript.runtime.runtime import Runtime, LocalRequest, LOOPS
+from gridvm.simplescript.runtime.policy import POLICIES
+from gridvm.simplescript.runtime.checkpoint import CHECKPOINT_INTERVAL
+from gridvm.simplescript.codegen.ss_optimizer import DEFAULT_LEVEL
 #                      YO DWAG, WE HEARD YOU LIKE RUNTIMES
 
 import blessings
@@ -30,8 +33,16 @@ COMMANDS['this'] = [ ]
 COMMANDS['list_runtimes'] = [ ]
 COMMANDS['list_programs'] = [ ]
 COMMANDS['shutdown'] = [ ]
-COMMANDS['auto_balance'] = [ ]
+COMMANDS['auto_balance'] = [ ('state', 'status') ]
 COMMANDS['migrate'] = [ ('program_id', REQUIRED), ('thread_id', REQUIRED), ('runtime_id', REQUIRED) ]
+COMMANDS['shard_migrate'] = [ ('program_id', REQUIRED), ('thread_id', REQUIRED), ('shard', REQUIRED) ]
+COMMANDS['profile'] = [ ('state', 'on') ]
+COMMANDS['hot_lines'] = [ ('limit', 10) ]
+COMMANDS['profile_dump'] = [ ('filename', 'profile.folded') ]
+COMMANDS['colocate'] = [ ('state', 'status') ]
+COMMANDS['weight'] = [ ('program_id', REQUIRED), ('weight', REQUIRED) ]
+COMMANDS['cpu_share'] = [ ]
+COMMANDS['checkpoint'] = [ ('state', 'status') ]
 COMMANDS['clear'] = []
 COMMANDS['help'] = [ ('command', None) ]
 COMMANDS['version'] = []
@@ -43,7 +54,15 @@ DESCRIPTIONS = {
     'list_runtimes': 'List all runtimes',
     'list_programs': 'List programs for this runtime',
     'migrate': 'Migrate a thread to another runtime',
-    'auto_balance': 'Autopmatic thread balancing',
+    'auto_balance': 'Turn automatic thread balancing on or off, or show its status',
+    'shard_migrate': 'Move a thread to another shard of this runtime',
+    'profile': 'Turn profiling of SimpleScript threads on or off',
+    'hot_lines': 'Show the most expensive lines of each profiled program',
+    'profile_dump': 'Save the profile as collapsed stacks, for flamegraphs',
+    'colocate': 'Turn co-location of chatty threads on or off, or show its proposals',
+    'weight': 'Set the cpu share of a program, with the fair policy',
+    'cpu_share': 'Show the cpu time each program took',
+    'checkpoint': 'Take a checkpoint now, or show the last one',
     'shutdown': 'Shut this runtime down',
     'version': "Display version information",
     'exit': "Exit",
@@ -96,13 +115,16 @@ def this():
 def list_runtimes():
     global runtime, runtime_ips
     update_runtimes()
+    runtime.add_local_request(LocalRequest.IN_FLIGHT)
+    in_flight = runtime.get_local_result()
     # clear local runtimes
     runtimes = []
     for i, (runtime_id, address) in enumerate(runtime_ips.items()):
         if runtime_id == runtime.id:
             pinfo('Runtime {}:[{}] >>ME<< @ {}:{}'.format(i, runtime_id, *address))
         else:
-            pinfo('Runtime {}:[{}] @ {}:{}'.format(i, runtime_id, *address))
+            pinfo('Runtime {}:[{}] @ {}:{}, {} messages in flight'.format(
+                i, runtime_id, *address, in_flight.get(runtime_id, 0)))
         runtimes.append(runtime_id)
 
     return True
@@ -136,6 +158,158 @@ def migrate(program_id, thread_id, runtime_id):
 
     return result
 
+def shard_migrate(program_id, thread_id, shard):
+    global runtime, programs, threads
+    program_id = int(program_id)
+    thread_id = int(thread_id)
+    shard = int(shard)
+
+    update_programs()
+    try:
+        dest_program = programs[program_id]
+        dest_thread = threads[program_id][thread_id]
+    except IndexError:
+        perror('No such thread {}:{}'.format(program_id, thread_id))
+        return False
+
+    runtime.add_local_request(LocalRequest.MOVE_TO_SHARD, (dest_program, dest_thread, shard))
+    result, msg = runtime.get_local_result()
+    if msg:
+        perror(msg)
+
+    return result
+
+def profile(state):
+    global runtime
+    if state not in ('on', 'off'):
+        perror('State must be "on" or "off"')
+        return False
+
+    runtime.add_local_request(LocalRequest.PROFILE, state == 'on')
+    result, msg = runtime.get_local_result()
+    if msg:
+        perror(msg)
+
+    return result
+
+def hot_lines(limit):
+    global runtime
+    runtime.add_local_request(LocalRequest.PROFILE_REPORT, int(limit))
+    report = runtime.get_local_result()
+    if not report:
+        perror('No profile, try "profile on"')
+        return False
+
+    for program_id, lines in report:
+        pinfo('Program {}:'.format(program_id))
+        pinfo('   Time(ms) |      Count | Line')
+        for source, line, count, seconds in lines:
+            pinfo('{:11.3f} | {:10d} | {}:{}'.format(seconds * 1000, count, source, line))
+
+    return True
+
+def profile_dump(filename):
+    global runtime
+    runtime.add_local_request(LocalRequest.PROFILE_EXPORT)
+    stacks = runtime.get_local_result()
+    if not stacks:
+        perror('No profile, try "profile on"')
+        return False
+
+    with open(filename, 'w') as f:
+        f.write(stacks)
+    pinfo('Profile saved to ' + filename)
+    return True
+
+def auto_balance(state):
+    global runtime
+    if state not in ('on', 'off', 'status'):
+        perror('State must be "on", "off" or "status"')
+        return False
+
+    runtime.add_local_request(LocalRequest.AUTO_BALANCE, state)
+    enabled, loads, decisions = runtime.get_local_result()
+
+    pinfo('Balancer is {}'.format('on' if enabled else 'off'))
+    pinfo('Runnable |  Queued | Workers |       IPS | Runtime')
+    for runtime_id, load in sorted(loads.items()):
+        pinfo('{runnable:8d} | {queued:7d} | {workers:7d} | {ips:9d} | '.format(**load)
+            + runtime_id + (' >>ME<<' if runtime_id == runtime.id else ''))
+    for when, text in decisions:
+        pinfo('{} {}'.format(time.strftime('%H:%M:%S', time.localtime(when)), text))
+
+    return True
+
+def colocate(state):
+    global runtime
+    if state not in ('on', 'off', 'status'):
+        perror('State must be "on", "off" or "status"')
+        return False
+
+    runtime.add_local_request(LocalRequest.COLOCATE, state)
+    enabled, proposals = runtime.get_local_result()
+
+    pinfo('Co-location is {}'.format('on' if enabled else 'off'))
+    pinfo('    Saves | To   | Verdict        | Thread')
+    for (program_id, thread_id), runtime_id, gain, verdict in proposals:
+        pinfo('{:9d} | {} | {:14} | {}:{}'.format(gain, runtime_id, verdict, program_id, thread_id))
+
+    return True
+
+def weight(program_id, weight):
+    global runtime, programs
+    program_id = int(program_id)
+
+    update_programs()
+    try:
+        dest_program = programs[program_id]
+    except IndexError:
+        perror('No such program {}'.format(program_id))
+        return False
+
+    runtime.add_local_request(LocalRequest.SET_WEIGHT, (dest_program, float(weight)))
+    result, msg = runtime.get_local_result()
+    if msg:
+        perror(msg)
+
+    return result
+
+def cpu_share():
+    global runtime
+    runtime.add_local_request(LocalRequest.CPU_SHARE)
+    shares = runtime.get_local_result()
+    if not shares:
+        perror('No thread ran yet')
+        return False
+
+    pinfo('   Weight |    Time(s) |  Share | Program')
+    for program_id, (weight, seconds, share) in sorted(shares.items()):
+        pinfo('{:9g} | {:10.3f} | {:5.1f}% | {}'.format(weight, seconds, share * 100, program_id))
+
+    return True
+
+def checkpoint(state):
+    global runtime
+    if state not in ('now', 'status'):
+        perror('State must be "now" or "status"')
+        return False
+
+    runtime.add_local_request(LocalRequest.CHECKPOINT, state)
+    result, stats = runtime.get_local_result()
+    if not result:
+        perror(stats)
+        return False
+    if stats is None:
+        pinfo('No checkpoint taken yet')
+        return True
+
+    pinfo('Checkpoint {seq} at {when}: {written} of {threads} threads written, '
+            '{compacted} compacted'.format(when=time.ctime(stats['time']), **stats))
+    pinfo('{bytes} bytes in {seconds:.3f}s, {percent:.2f}% of the time so far'.format(
+        percent=stats['overhead'] * 100, **stats))
+
+    return True
+
 def command_ok():
     global last_len
     sys.stdout.write( ((term.move_up() * lines)
@@ -255,14 +429,36 @@ def main():
     global runtime, last_len, lines
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--interface', '-i',
-            action='store', metavar='interface')
+    parser.add_argument('interface', metavar='interface')
+    parser.add_argument('programs', nargs='*', metavar='program')
+    parser.add_argument('-O', dest='optimize', type=int, choices=(0, 1, 2),
+            default=DEFAULT_LEVEL, help='bytecode optimization level')
+    parser.add_argument('--shards', '-s', type=int, default=0, metavar='N',
+            help='run threads on N worker processes')
+    parser.add_argument('--capacity', type=int, default=None, metavar='N',
+            help='let other runtimes move threads here while running fewer than N')
+    parser.add_argument('--policy', choices=sorted(POLICIES), default='round_robin',
+            help='how the cpu is shared between threads')
+    parser.add_argument('--checkpoint', default=None, metavar='DIR',
+            help='checkpoint the runtime periodically to DIR')
+    parser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL,
+            metavar='S', help='seconds between two checkpoints')
+    parser.add_argument('--restore', action='store_true',
+            help='resume from the last checkpoint in DIR')
+    parser.add_argument('--loop', choices=sorted(LOOPS), default='threads',
+            help='run the network on a thread of its own, or on one asyncio loop with the threads')
+    args = parser.parse_args()
+    if args.restore and args.checkpoint is None:
+        parser.error('--restore needs --checkpoint')
 
-    interface = sys.argv[1]
-    programs = sys.argv[2:]
-
-    runtime = Runtime(interface=interface)
-    for program in programs:
+    try:
+        runtime = Runtime(interface=args.interface, optimize=args.optimize, shards=args.shards,
+                policy=args.policy, capacity=args.capacity, checkpoint_dir=args.checkpoint,
+                checkpoint_interval=args.checkpoint_interval, restore=args.restore,
+                loop=args.loop)
+    except FileNotFoundError as ex:
+        parser.error(str(ex))
+    for program in args.programs:
         runtime.load_program(program)
 
     # Create thread for runtime
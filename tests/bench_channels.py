@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Channel benchmark: local SND/RCV between the threads of one runtime,
+through NetworkCommunication the way the interpreters use it
+
+    python -m tests.bench_channels lo --messages 1000000
+"""
+import time
+import argparse
+
+import logging
+logging.disable(logging.WARN)
+
+from gridvm.simplescript.runtime.communication import NetworkCommunication
+
+MESSAGES = 1000000
+THREADS = 100       # each sends to the next one, over a channel of its own
+BATCH = 4           # messages a thread sends before the next one receives them
+
+def run(comms, messages, threads):
+    """ Returns the messages passed around, and the seconds it took """
+    uids = [ ('bench', thread_id) for thread_id in range(threads) ]
+    for thread_uid in uids:
+        comms.update_thread_location(thread_uid, comms.runtime_id)
+    channels = [ (uids[(index + 1) % threads], sender) for index, sender in enumerate(uids) ]
+
+    rounds = max(1, messages // (threads * BATCH))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for recv, sender in channels:
+            for msg in range(BATCH):
+                comms.send_message(recv, sender, msg)
+        for recv, sender in channels:
+            # RCV probes the channel first, and once more when it's drained
+            while comms.can_receive_message(sender, recv):
+                comms.receive_message(sender, recv)
+    return rounds * threads * BATCH, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('interface', metavar='interface')
+    parser.add_argument('--messages', '-n', type=int, default=MESSAGES)
+    parser.add_argument('--threads', type=int, default=THREADS)
+    args = parser.parse_args()
+
+    comms = NetworkCommunication('bench', args.interface)
+    try:
+        messages, elapsed = run(comms, args.messages, args.threads)
+    finally:
+        comms.shutdown()
+
+    print('{} messages in {:.2f}s, {:.0f} messages/s'.format(
+        messages, elapsed, messages / elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark: loads a program of many threads into a runtime and checks
+the bytes each thread takes
+
+    python -m tests.bench_memory lo --threads 100000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+import logging
+logging.disable(logging.WARN)
+
+from gridvm.simplescript.runtime.runtime import Runtime
+
+THREADS = 100000
+MAX_THREAD_BYTES = 800      # registers and arrays of a thread included
+
+# every thread waits for its left neighbour, like most threads of a big program do
+SOURCE = """#SIMPLESCRIPT
+
+ADD $nxt $argv[0] 1
+MOD $nxt $nxt $argv[1]
+ADD $prv $argv[0] $argv[1]
+SUB $prv $prv 1
+MOD $prv $prv $argv[1]
+RCV $prv $cnt
+SND $nxt $cnt
+RET
+"""
+
+def write_program(directory, threads):
+    with open(os.path.join(directory, 'bench.ss'), 'w') as f:
+        f.write(SOURCE)
+
+    filename = os.path.join(directory, 'bench.mtss')
+    with open(filename, 'w') as f:
+        f.write('#SIMPLESCRIPT_MULTITHREADED {}\n'.format(threads))
+        for thread_id in range(threads):
+            f.write('#THREAD "bench.ss" {}\n'.format(threads))
+    return filename
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('interface', metavar='interface')
+    parser.add_argument('--threads', '-n', type=int, default=THREADS)
+    parser.add_argument('--max-bytes', type=int, default=MAX_THREAD_BYTES,
+            help='fail if a thread takes more')
+    args = parser.parse_args()
+
+    runtime = Runtime(interface=args.interface)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = write_program(directory, args.threads)
+
+        tracemalloc.start()
+        started = time.time()
+        runtime.load_program(filename)
+        elapsed = time.time() - started
+        used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    runtime.shutdown()
+    runtime.check_for_requests()
+
+    per_thread = used / args.threads
+    print('{} threads loaded in {:.2f}s, {:.0f} bytes per thread'.format(
+        args.threads, elapsed, per_thread))
+
+    if per_thread > args.max_bytes:
+        print('FAIL: more than {} bytes per thread'.format(args.max_bytes))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
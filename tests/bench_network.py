@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Network benchmark: two runtimes pass messages between a thread on each,
+with the network run on threads or on an asyncio loop
+
+    python -m tests.bench_network eth0 --loop both
+"""
+import os
+import time
+import argparse
+import tempfile
+import multiprocessing
+from threading import Thread
+
+import logging
+logging.disable(logging.WARN if not os.environ.get("BENCH_LOG") else logging.NOTSET)
+
+from gridvm.simplescript.runtime.runtime import Runtime, LocalRequest, LOOPS
+
+ROUNDS = 200        # round trips of the latency test
+MESSAGES = 2000     # messages of the throughput test
+START_DELAY = 1     # seconds thread 0 sleeps, while thread 1 moves to the other runtime
+
+# thread 0 sends argv[1] messages to thread 1, that replies to every
+# argv[2]-th one, so ping-pong is argv[2] = 1 and a stream argv[2] = argv[1]
+SOURCE = """#SIMPLESCRIPT
+
+BGT $argv[0] 0 L3
+SLP {delay}
+SET $i 0
+L1 ADD $i $i 1
+SND 1 $i
+MOD $k $i $argv[2]
+BGT $k 0 L2
+RCV 1 $v
+L2 BLT $i $argv[1] L1
+RET
+
+L3 SET $i 0
+L4 ADD $i $i 1
+RCV 0 $v
+MOD $k $i $argv[2]
+BGT $k 0 L5
+SND 0 $v
+L5 BLT $i $argv[1] L4
+RET
+""".format(delay=START_DELAY)
+
+def write_program(directory, name, messages, reply_every):
+    with open(os.path.join(directory, 'bench.ss'), 'w') as f:
+        f.write(SOURCE)
+
+    filename = os.path.join(directory, name + '.mtss')
+    with open(filename, 'w') as f:
+        f.write('#SIMPLESCRIPT_MULTITHREADED 2\n')
+        for thread_id in range(2):
+            f.write('#THREAD "bench.ss" {} {}\n'.format(messages, reply_every))
+    return filename
+
+def serve(interface, loop, conn):
+    """ The second runtime, in a process of its own so the two don't share the GIL """
+    runtime = Runtime(interface=interface, loop=loop)
+    runner = Thread(target=runtime.run)
+    runner.start()
+
+    conn.send(runtime.id)
+    conn.recv()
+    runtime.shutdown()
+    runner.join()
+
+def run_program(filename, interface, loop):
+    """ Run the program with thread 1 on a second runtime, returns the
+    seconds it took past the start delay """
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(interface, loop, child_conn))
+    server.start()
+    second = conn.recv()
+
+    runtime = Runtime(interface=interface, loop=loop)
+    runner = Thread(target=runtime.run)
+    runner.start()
+
+    try:
+        while second not in runtime._comms.get_runtimes():
+            time.sleep(0.01)
+
+        runtime.load_program(filename)
+        started = time.time()
+        program_id = next(iter(runtime._own_programs))
+        runtime.add_local_request(LocalRequest.MIGRATE, (program_id, 1, second))
+        success, error = runtime._request_rep.get()
+        if not success:
+            raise RuntimeError('Migration failed: {}'.format(error))
+
+        while runtime._own_programs:
+            time.sleep(0.001)
+        return time.time() - started - START_DELAY
+    finally:
+        # one at a time, so the second one is alone once the first is gone
+        runtime.shutdown()
+        runner.join()
+        if loop == 'threads':
+            runtime._comms.nethandler_thread.join()
+        conn.send(None)
+        server.join()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('interface', metavar='interface')
+    parser.add_argument('--loop', choices=sorted(LOOPS) + ['both'], default='both')
+    parser.add_argument('--rounds', type=int, default=ROUNDS)
+    parser.add_argument('--messages', type=int, default=MESSAGES)
+    args = parser.parse_args()
+
+    loops = sorted(LOOPS) if args.loop == 'both' else [ args.loop ]
+    with tempfile.TemporaryDirectory() as directory:
+        pingpong = write_program(directory, 'pingpong', args.rounds, 1)
+        stream = write_program(directory, 'stream', args.messages, args.messages)
+
+        for loop in loops:
+            elapsed = run_program(pingpong, args.interface, loop)
+            latency = elapsed / args.rounds
+            elapsed = run_program(stream, args.interface, loop)
+            throughput = args.messages / elapsed
+
+            print('{:8} round trip {:.3f} ms, {:.0f} messages/s'.format(
+                loop, latency * 1000, throughput))
+
+if __name__ == '__main__':
+    main()
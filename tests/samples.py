@@ -0,0 +1,100 @@
+"""
+Runs the sample programs under programs/ on bare interpreters, recording
+what each thread prints and sends
+"""
+from collections import deque
+from pathlib import Path
+
+from gridvm.simplescript.runtime.inter import SimpleScriptInterpreter, InterpreterStatus
+from gridvm.simplescript.runtime.source import load_source, ProgramInfo
+
+PROGRAMS = Path(__file__).resolve().parent.parent / 'programs'
+SAMPLES = [
+        'simpletest.ss',
+        'unitest.ss',
+        'counter/counter.mtss',
+        'counter_deadlock/counter_deadlock.mtss',
+        'self_counter/self_counter.mtss',
+        ]
+
+EVENTS = 200        # the sample counters never stop, a thread is cut off after this many
+MAX_SLICES = 10000  # a thread that loops without events is cut off too
+BUDGET = 7          # instructions per slice, odd so the threads interleave unevenly
+
+
+class RecordingCommunication(object):
+    """ Channels between the threads of one program, it records what each
+    thread prints and sends """
+    def __init__(self):
+        self._channels = { }    # (recv, sender) -> deque
+        self.events = { }       # thread_uid -> [ event ]
+        self.received = 0
+
+    def send_message(self, recv, sender, msg):
+        self._channels.setdefault( (recv, sender), deque() ).append(msg)
+        self.events.setdefault(sender, [ ]).append( ('SND', recv[1], msg) )
+        return True
+
+    def receive_message(self, sender, recv):
+        channel = self._channels.get( (recv, sender) )
+        if not channel:
+            return None
+        self.received += 1
+        return channel.popleft()
+
+    def send_print_request(self, runtime_id, thread_uid, msg):
+        self.events.setdefault(thread_uid, [ ]).append( ('PRN', msg) )
+
+
+def load_threads(sample, **options):
+    """ Returns [ (code, argv) ] of the threads of a sample program,
+    options are passed on to load_source() """
+    path = PROGRAMS / sample
+    if path.suffix == '.ss':
+        return [ (load_source(str(path), dump_to_objet_file=False, **options), [ 0 ]) ]
+
+    codes = { }
+    threads = [ ]
+    for info in ProgramInfo(str(path)).parse():
+        if info.source_file not in codes:
+            codes[info.source_file] = load_source(info.source_file,
+                    dump_to_objet_file=False, **options)
+        threads.append( (codes[info.source_file], info.args) )
+    return threads
+
+def run(sample, jit=False, **options):
+    """ Run a sample program until its threads finish, deadlock or produce
+    EVENTS events each. Returns the events of every thread, in order.
+
+    Threads only share their channels, so what a thread prints and sends
+    doesn't depend on how the threads are interleaved """
+    comms = RecordingCommunication()
+    inters = [ ]
+    for thread_id, (code, argv) in enumerate(load_threads(sample, **options)):
+        inter = SimpleScriptInterpreter('test', 'sample', thread_id, code, comms, jit=jit)
+        inter.start(argv)
+        inters.append(inter)
+    slices = [ 0 ] * len(inters)
+
+    def events(inter):
+        return len(comms.events.get(inter.thread_uid, ()))
+
+    def runnable(inter):
+        return (inter.status != InterpreterStatus.FINISHED
+                and slices[inter.thread_id] < MAX_SLICES and events(inter) < EVENTS)
+
+    progress = True
+    while progress:
+        progress = False
+        for inter in filter(runnable, inters):
+            before = (events(inter), comms.received)
+            status = inter.exec_slice(BUDGET)
+            slices[inter.thread_id] += 1
+            if status == InterpreterStatus.SLEEPING:
+                # time doesn't matter here
+                inter.status = InterpreterStatus.RUNNING
+            # a thread that is still blocked only ran its RCV again
+            progress = (progress or status != InterpreterStatus.BLOCKED
+                    or (events(inter), comms.received) != before)
+
+    return [ comms.events.get(inter.thread_uid, [ ])[:EVENTS] for inter in inters ]
@@ -0,0 +1,160 @@
+"""
+A runtime restored from a checkpoint must pick up where the one that took
+it left off, see Checkpointer
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from gridvm.simplescript.runtime import communication
+from gridvm.simplescript.runtime.checkpoint import Checkpointer, load_manifest, SEGMENT
+from gridvm.simplescript.runtime.runtime import Runtime
+
+# thread 0 leaves a few messages for thread 1, then every thread adds up
+# what the feeder (argv[1]) sends it. The feeder sleeps, the tests send for it
+SOURCE = """#SIMPLESCRIPT
+BEQ $argv[0] $argv[1] L3
+BGT $argv[0] 0 L1
+SND 1 10
+SND 1 11
+SND 1 12
+L1 SET $sum 0
+L2 RCV $argv[1] $v
+ADD $sum $sum $v
+BRA L2
+L3 SLP 100000
+RET
+"""
+
+THREADS = 4         # and the feeder
+FEEDER = THREADS
+INTERVAL = 3600     # the tests checkpoint by hand
+
+
+class LocalNetHandler(object):
+    """ A NetHandler without a network, all threads are local """
+    def __init__(self, comms, runtime_id, net_interface):
+        self.runtimes = { runtime_id: ('127.0.0.1', 0) }
+
+    def start(self):
+        pass
+
+    def notify(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = os.path.join(directory.name, 'checkpoints')
+
+        with open(os.path.join(directory.name, 'sum.ss'), 'w') as f:
+            f.write(SOURCE)
+        self.program = os.path.join(directory.name, 'sum.mtss')
+        with open(self.program, 'w') as f:
+            f.write('#SIMPLESCRIPT_MULTITHREADED {}\n'.format(THREADS + 1))
+            for thread_id in range(THREADS + 1):
+                f.write('#THREAD "sum.ss" {}\n'.format(FEEDER))
+
+        patcher = mock.patch.object(communication, 'NetHandler', LocalNetHandler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def new_runtime(self, **options):
+        runtime = Runtime('lo', **options)
+        self.addCleanup(runtime.shutdown)
+        return runtime
+
+    def settle(self, runtime):
+        """ Run rounds until every thread waits for the feeder, that sleeps """
+        runtime.check_for_requests()
+        run_list = runtime._next_round()
+        while run_list:
+            for inter in run_list:
+                runtime._run_slice(inter)
+            run_list = runtime._next_round()
+
+    def feed(self, runtime, thread_id, msg):
+        program_id = next(iter(runtime._programs))
+        runtime._comms.send_message( (program_id, thread_id), (program_id, FEEDER), msg)
+        self.settle(runtime)
+
+    def picture(self, runtime):
+        """ The registers and status of every thread, and the messages pending """
+        threads = { }
+        for inter in [ inter for threads in runtime._programs.values() for inter in threads.values() ]:
+            pc, registers, arrays, _, wake_up_at, waiting_from = inter.save_state()
+            arrays = [ array and dict(array.items()) for array in arrays ]
+            threads[inter.thread_uid] = (pc, registers, arrays, wake_up_at, waiting_from, inter.status)
+        pending = { channel: msgs for channel, msgs in runtime._comms.peek_messages().items() if msgs }
+        return threads, pending
+
+    def restored(self):
+        runtime = self.new_runtime()
+        Checkpointer(runtime, self.directory).restore(load_manifest(self.directory))
+        return runtime
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                if name.startswith(SEGMENT.split('{')[0]))
+
+    def test_restore(self):
+        runtime = self.new_runtime(checkpoint_dir=self.directory, checkpoint_interval=INTERVAL)
+        runtime.load_program(self.program)
+        self.settle(runtime)
+        self.feed(runtime, 2, 5)
+
+        stats = runtime._checkpointer.checkpoint()
+        self.assertEqual( (stats['written'], stats['threads']), (THREADS + 1, THREADS + 1) )
+
+        threads, pending = self.picture(runtime)
+        self.assertEqual(list(pending.values()), [ [ 10, 11, 12 ] ])
+        restored = self.restored()
+        self.assertEqual(self.picture(restored), (threads, pending))
+
+        # both go on the same way
+        for rt in (runtime, restored):
+            self.feed(rt, 1, 7)
+        self.assertEqual(self.picture(restored), self.picture(runtime))
+
+    def test_incremental(self):
+        runtime = self.new_runtime(checkpoint_dir=self.directory, checkpoint_interval=INTERVAL)
+        runtime.load_program(self.program)
+        self.settle(runtime)
+        checkpointer = runtime._checkpointer
+        checkpointer.checkpoint()
+        first = self.segments()
+        self.assertEqual(len(first), 1)
+
+        # nothing changed, nothing written
+        stats = checkpointer.checkpoint()
+        self.assertEqual( (stats['written'], stats['bytes']), (0, 0) )
+        self.assertEqual(self.segments(), first)
+
+        # only the thread that ran is written again
+        self.feed(runtime, 2, 5)
+        stats = checkpointer.checkpoint()
+        self.assertEqual( (stats['written'], stats['compacted']), (1, 0) )
+        self.assertEqual(len(self.segments()), 2)
+        self.assertEqual(self.picture(self.restored()), self.picture(runtime))
+
+        # the first segment is left with two threads out of five, below
+        # COMPACT_RATIO, so those are written again and the segment goes
+        self.feed(runtime, 1, 6)
+        self.feed(runtime, 3, 7)
+        stats = checkpointer.checkpoint()
+        self.assertEqual( (stats['written'], stats['compacted']), (2, 2) )
+        segments = self.segments()
+        self.assertEqual(len(segments), 2)
+        self.assertNotIn(first[0], segments)
+        self.assertEqual(set(load_manifest(self.directory)['segments']), set(segments))
+        self.assertEqual(self.picture(self.restored()), self.picture(runtime))
+
+
+if __name__ == '__main__':
+    unittest.main()
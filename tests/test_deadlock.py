@@ -0,0 +1,79 @@
+"""
+WaitForGraph must find the same cycles as following the edges by hand
+"""
+import random
+import unittest
+
+from gridvm.simplescript.runtime.deadlock import WaitForGraph
+
+TRIALS = 300
+STEPS = 200
+
+
+def on_cycle(edges, thread_id):
+    """ Whether following the edges from thread_id leads back to it """
+    seen = set()
+    current = thread_id
+    while current in edges and current not in seen:
+        seen.add(current)
+        current = edges[current]
+    return current == thread_id and thread_id in edges
+
+def brute_cycle(edges, thread_id):
+    cycle = [ thread_id ]
+    current = edges[thread_id]
+    while current != thread_id:
+        cycle.append(current)
+        current = edges[current]
+    return cycle
+
+
+class WaitForGraphTest(unittest.TestCase):
+    def test_ring(self):
+        graph = WaitForGraph()
+        for thread_id in range(1, 5):
+            self.assertIsNone(graph.add_edge(thread_id, thread_id - 1))
+        self.assertEqual(graph.add_edge(0, 4), [ 0, 4, 3, 2, 1 ])
+
+        # breaking the ring anywhere, then closing it again
+        graph.remove_edge(2)
+        self.assertIsNone(graph.add_edge(2, 5))
+        self.assertIsNone(graph.waiting_for(5))
+        self.assertEqual(graph.add_edge(2, 1), [ 2, 1, 0, 4, 3 ])
+
+    def test_self_loop(self):
+        graph = WaitForGraph()
+        self.assertEqual(graph.add_edge(0, 0), [ 0 ])
+        graph.remove_edge(0)
+        self.assertEqual(len(graph), 0)
+
+    def test_random_edges(self):
+        rng = random.Random(15)
+        for trial in range(TRIALS):
+            graph = WaitForGraph()
+            edges = { }
+            threads = rng.randint(1, 12)
+            for _ in range(STEPS):
+                waiter = rng.randrange(threads)
+                if rng.random() < 0.6:
+                    sender = edges[waiter] = rng.randrange(threads)
+                    cycle = graph.add_edge(waiter, sender)
+                    if on_cycle(edges, waiter):
+                        self.assertEqual(cycle, brute_cycle(edges, waiter))
+                    else:
+                        self.assertIsNone(cycle)
+                else:
+                    edges.pop(waiter, None)
+                    graph.remove_edge(waiter)
+
+                self.assertEqual(len(graph), len(edges))
+                for thread_id in range(threads):
+                    self.assertEqual(graph.waiting_for(thread_id), edges.get(thread_id))
+                    self.assertEqual(set(graph.waiters(thread_id)),
+                            { waiter for waiter, sender in edges.items() if sender == thread_id })
+                    if on_cycle(edges, thread_id):
+                        self.assertEqual(graph.cycle(thread_id), brute_cycle(edges, thread_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""
+Messages to threads of unknown location are held while the peers are asked
+where the thread is, see NetworkCommunication.check_discoveries()
+"""
+import unittest
+from unittest import mock
+
+from gridvm.network.protocol.packet.ptype import PacketType
+from gridvm.simplescript.runtime import communication
+from gridvm.simplescript.runtime.communication import (NetworkCommunication,
+        DISCOVER_TIMEOUT, DISCOVER_RETRIES)
+
+RUNTIME = 'self'
+PEER = 'peer'
+
+LOST = ('program', 1)       # nobody knows where it is at first
+LOCAL = ('program', 2)
+SENDER = ('program', 0)
+OTHER_SENDER = ('program', 3)
+
+
+class Clock(object):
+    """ Stands in for the time module """
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class QuietNetHandler(object):
+    def __init__(self, comms, runtime_id, net_interface):
+        self.runtimes = { runtime_id: ('127.0.0.1', 0) }
+
+    def start(self):
+        pass
+
+    def notify(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class DiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        for name, value in ( ('NetHandler', QuietNetHandler), ('time', self.clock) ):
+            patcher = mock.patch.object(communication, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.comms = NetworkCommunication(RUNTIME, 'lo')
+        self.comms.nethandler_thread.join()
+        self.packets = [ ]
+        self.comms.queue_packet = lambda runtime_id, packet: self.packets.append( (runtime_id, packet) )
+        self.located = [ ]
+        self.comms.set_location_listener(self.located.append)
+        self.comms.update_thread_location(LOCAL, RUNTIME)
+
+    def requests(self):
+        return [ packet['thread_uid'] for runtime_id, packet in self.packets
+                if packet.type == PacketType.DISCOVER_THREAD_REQ ]
+
+    def sent(self):
+        return [ (runtime_id, packet['sender'], packet['msg']) for runtime_id, packet in self.packets
+                if packet.type == PacketType.THREAD_MESSAGE and packet['recv'] == LOST ]
+
+    def test_single_request(self):
+        self.assertFalse(self.comms.send_message(LOST, SENDER, 1))
+        self.assertFalse(self.comms.send_message(LOST, OTHER_SENDER, 2))
+        self.assertFalse(self.comms.send_message(LOST, SENDER, 3))
+        self.assertEqual(self.requests(), [ LOST ])
+        self.assertTrue(self.comms.is_resolving(LOST))
+        self.assertEqual(self.comms.next_discovery(), self.clock.now + DISCOVER_TIMEOUT)
+
+        # nothing new until it times out
+        self.clock.now += DISCOVER_TIMEOUT / 2
+        self.assertEqual(self.comms.check_discoveries(), [ ])
+        self.assertEqual(self.requests(), [ LOST ])
+        self.assertEqual(self.sent(), [ ])
+
+        # other threads don't wait for it
+        self.assertTrue(self.comms.send_message(LOCAL, SENDER, 4))
+        self.assertEqual(self.comms.receive_message(SENDER, LOCAL), 4)
+
+    def test_flush_in_order(self):
+        self.comms.send_message(LOST, SENDER, 1)
+        self.comms.send_message(LOST, OTHER_SENDER, 2)
+        self.comms.update_thread_location(LOST, PEER)
+
+        # held until the runtime checks, behind the ones held already
+        self.assertTrue(self.comms.send_message(LOST, SENDER, 3))
+        self.assertEqual(self.sent(), [ ])
+        self.assertEqual(self.comms.next_discovery(), self.clock.now)
+
+        self.assertEqual(self.comms.check_discoveries(), [ ])
+        self.assertEqual(self.sent(), [ (PEER, SENDER, 1), (PEER, OTHER_SENDER, 2), (PEER, SENDER, 3) ])
+        self.assertEqual(self.located, [ LOST ])
+        self.assertFalse(self.comms.is_resolving(LOST))
+        self.assertIsNone(self.comms.next_discovery())
+
+        # from now on they go straight out
+        self.assertTrue(self.comms.send_message(LOST, SENDER, 4))
+        self.assertEqual(self.sent()[-1], (PEER, SENDER, 4))
+        self.assertEqual(self.requests(), [ LOST ])
+
+    def test_give_up(self):
+        self.comms.send_message(LOST, SENDER, 1)
+        for tries in range(1, DISCOVER_RETRIES):
+            self.clock.now += DISCOVER_TIMEOUT
+            self.assertEqual(self.comms.check_discoveries(), [ ])
+            self.assertEqual(self.requests(), [ LOST ] * (tries + 1))
+
+        self.clock.now += DISCOVER_TIMEOUT
+        self.assertEqual(self.comms.check_discoveries(), [ LOST ])
+        self.assertEqual(len(self.requests()), DISCOVER_RETRIES)
+        self.assertEqual(self.located, [ LOST ])
+        self.assertFalse(self.comms.is_resolving(LOST))
+        self.assertIsNone(self.comms.next_discovery())
+
+        # what was held is gone, a late answer sends nothing
+        self.comms.update_thread_location(LOST, PEER)
+        self.assertEqual(self.comms.check_discoveries(), [ ])
+        self.assertEqual(self.sent(), [ ])
+
+        # but the thread is known from then on
+        self.assertTrue(self.comms.send_message(LOST, SENDER, 2))
+        self.assertEqual(self.sent(), [ (PEER, SENDER, 2) ])
+        self.assertEqual(len(self.requests()), DISCOVER_RETRIES)
+
+
+if __name__ == '__main__':
+    unittest.main()
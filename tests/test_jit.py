@@ -0,0 +1,44 @@
+"""
+Compiled blocks must behave like the instructions they replace
+"""
+import unittest
+from unittest import mock
+
+from gridvm.simplescript.runtime import inter
+
+from .samples import SAMPLES, run
+
+# low enough that the blocks of the samples get compiled early on
+JIT_THRESHOLD = 2
+
+
+class JitTest(unittest.TestCase):
+    def test_samples_print_something(self):
+        for sample in SAMPLES:
+            with self.subTest(sample=sample):
+                self.assertTrue(any(run(sample)))
+
+    def test_blocks_get_compiled(self):
+        compiled = [ ]
+        compile_block = inter.compile_block
+        def recording(code, start):
+            block = compile_block(code, start)
+            compiled.append(block)
+            return block
+
+        with mock.patch.object(inter, 'JIT_THRESHOLD', JIT_THRESHOLD), \
+                mock.patch.object(inter, 'compile_block', recording):
+            run('counter/counter.mtss', jit=True)
+        self.assertTrue(any(compiled))
+
+    def test_jit_matches_interpreter(self):
+        for sample in SAMPLES:
+            for level in (0, 1, 2):
+                expected = run(sample, optimize=level)
+                with self.subTest(sample=sample, level=level), \
+                        mock.patch.object(inter, 'JIT_THRESHOLD', JIT_THRESHOLD):
+                    self.assertEqual(run(sample, jit=True, optimize=level), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
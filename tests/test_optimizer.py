@@ -0,0 +1,20 @@
+"""
+The optimized code must behave like the code as generated: the sample
+programs print and send the same things at every optimization level
+"""
+import unittest
+
+from .samples import SAMPLES, run
+
+
+class OptimizerTest(unittest.TestCase):
+    def test_levels_match_unoptimized(self):
+        for sample in SAMPLES:
+            expected = run(sample, optimize=0)
+            for level in (1, 2):
+                with self.subTest(sample=sample, level=level):
+                    self.assertEqual(run(sample, optimize=level), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
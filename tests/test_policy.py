@@ -0,0 +1,95 @@
+"""
+FairSharePolicy must split the cpu time between programs by their weights,
+whatever their thread count
+"""
+import os
+import tempfile
+import unittest
+from time import perf_counter
+
+from gridvm.simplescript.runtime.inter import SimpleScriptInterpreter
+from gridvm.simplescript.runtime.policy import FairSharePolicy
+from gridvm.simplescript.runtime.scheduler import Scheduler
+from gridvm.simplescript.runtime.source import load_source
+
+# a thread that never blocks
+SPIN = """#SIMPLESCRIPT
+SET $i 0
+L1 ADD $i $i 1
+BRA L1
+"""
+
+QUANTUM = 200       # instructions per slice
+DURATION = 1.0      # seconds the threads run for
+TOLERANCE = 0.05    # off the expected share
+
+
+class IdleCommunication(object):
+    """ What Scheduler needs of NetworkCommunication, the threads only spin """
+    def set_message_listener(self, listener):
+        pass
+
+    def set_location_listener(self, listener):
+        pass
+
+    def can_receive_message(self, sender, recv):
+        return False
+
+    def is_resolving(self, thread_uid):
+        return False
+
+
+class FairShareTest(unittest.TestCase):
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spin.ss')
+            with open(path, 'w') as f:
+                f.write(SPIN)
+            self.code = load_source(path, dump_to_objet_file=False)
+
+        self.comms = IdleCommunication()
+        self.scheduler = Scheduler(self.comms, FairSharePolicy())
+
+    def add_program(self, program_id, threads, weight):
+        self.scheduler.policy.set_weight(program_id, weight)
+        for thread_id in range(threads):
+            inter = SimpleScriptInterpreter('test', program_id, thread_id, self.code, self.comms)
+            inter.start( [ thread_id ] )
+            self.scheduler.add(inter)
+
+    def run_for(self, seconds):
+        """ Run rounds the way Runtime does """
+        deadline = perf_counter() + seconds
+        while perf_counter() < deadline:
+            for inter in self.scheduler.next_round():
+                started = perf_counter()
+                inter.exec_slice(QUANTUM)
+                self.scheduler.account(inter, perf_counter() - started)
+                self.scheduler.add(inter)
+
+    def test_weights(self):
+        # the light program has more threads, they share its part
+        self.add_program('light', 3, 1)
+        self.add_program('heavy', 1, 3)
+        self.run_for(DURATION)
+
+        shares = self.scheduler.policy.cpu_share()
+        self.assertAlmostEqual(shares['light'][2], 0.25, delta=TOLERANCE)
+        self.assertAlmostEqual(shares['heavy'][2], 0.75, delta=TOLERANCE)
+
+    def test_late_program(self):
+        # a program that starts later doesn't get to catch up
+        self.add_program('first', 1, 1)
+        self.run_for(DURATION / 2)
+        before = dict(self.scheduler.policy.cpu_time)
+
+        self.add_program('second', 1, 1)
+        self.run_for(DURATION / 2)
+        since = { program_id: seconds - before.get(program_id, 0.0)
+                for program_id, seconds in self.scheduler.policy.cpu_time.items() }
+        shares = self.scheduler.policy.cpu_share(since)
+        self.assertAlmostEqual(shares['second'][2], 0.5, delta=TOLERANCE)
+
+
+if __name__ == '__main__':
+    unittest.main()
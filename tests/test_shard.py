@@ -0,0 +1,156 @@
+"""
+Snapshots of a pool of shards, see ShardPool.snapshot()
+"""
+import os
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from gridvm.simplescript.runtime import shard
+from gridvm.simplescript.runtime.shard import ShardPool, ShardTimeout
+from gridvm.simplescript.runtime.inter import SimpleScriptInterpreter, InterpreterStatus
+from gridvm.simplescript.runtime.runtime import ThreadPackage
+from gridvm.simplescript.runtime.source import load_source
+
+# a thread that waits for a message nobody sends
+WAIT = """#SIMPLESCRIPT
+RCV 100 $msg
+RET
+"""
+
+# a thread that keeps its shard busy for a while, argv[1] iterations
+SPIN = """#SIMPLESCRIPT
+SET $i 0
+L1 ADD $i $i 1
+BLT $i $argv[1] L1
+RET
+"""
+
+QUANTUM = 10 ** 9   # a slice runs until the thread blocks or finishes
+SPIN_LOOPS = 2000000
+
+
+class PoolComms(object):
+    """ What ShardPool needs of NetworkCommunication """
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self.messages = [ ]
+
+    def set_shard_router(self, router):
+        pass
+
+    def update_shard_location(self, thread_uid, shard):
+        pass
+
+    def send_message(self, recv, sender, msg):
+        self.messages.append( (recv, sender, msg) )
+        return True
+
+    def send_print_request(self, runtime_id, thread_uid, msg):
+        pass
+
+    def add_traffic(self, traffic):
+        pass
+
+
+class PoolRuntime(object):
+    """ What ShardPool needs of Runtime """
+    def __init__(self):
+        self._comms = PoolComms()
+        self.statuses = { }
+
+    def update_status(self, thread_uid, runtime_id, status, waiting_from):
+        self.statuses[thread_uid] = status
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.codes = { }
+        for name, source in ( ('wait', WAIT), ('spin', SPIN) ):
+            path = os.path.join(directory.name, name + '.ss')
+            with open(path, 'w') as f:
+                f.write(source)
+            self.codes[name] = load_source(path, dump_to_objet_file=False)
+
+        self.runtime = PoolRuntime()
+
+    def start_pool(self, count):
+        self.pool = ShardPool(self.runtime, count, QUANTUM)
+        self.addCleanup(self.pool.shutdown)
+
+    def wait_for(self, thread_uids, status):
+        """ Until the shards report status for all of thread_uids """
+        deadline = time.time() + 10
+        while any(self.runtime.statuses.get(thread_uid) != status for thread_uid in thread_uids):
+            self.assertLess(time.time(), deadline)
+            self.pool.dispatch()
+            self.runtime._comms.wakeup.wait(0.05)
+            self.runtime._comms.wakeup.clear()
+
+    def place(self, name, thread_id, shard, argv=()):
+        inter = SimpleScriptInterpreter('test', 'sample', thread_id, self.codes[name], None)
+        inter.start( [ thread_id ] + list(argv) )
+        package = ThreadPackage.from_inter(inter, { })
+        self.pool.place(package.pack(), package, shard)
+        return inter.thread_uid
+
+    def test_snapshot(self):
+        self.start_pool(2)
+        uids = { self.place('wait', thread_id, thread_id % 2) for thread_id in range(4) }
+        self.wait_for(uids, InterpreterStatus.BLOCKED)
+
+        blobs, alive, in_flight = self.pool.snapshot()
+        self.assertEqual(set(blobs), uids)
+        self.assertEqual(alive, uids)
+        self.assertEqual(in_flight, [ ])
+        for thread_uid, blob in blobs.items():
+            package = ThreadPackage.unpack(blob)
+            self.assertEqual( (package.program_id, package.thread_id), thread_uid)
+            self.assertEqual(package.state[3], InterpreterStatus.BLOCKED)
+
+        # nothing changed
+        blobs, alive, in_flight = self.pool.snapshot()
+        self.assertEqual(blobs, { })
+        self.assertEqual(alive, uids)
+
+        # a message it doesn't wait for yet
+        self.pool.route_message(1, ('sample', 1), ('sample', 7), 42)
+        blobs, alive, in_flight = self.pool.snapshot()
+        self.assertEqual(set(blobs), { ('sample', 1) })
+        package = ThreadPackage.unpack(blobs[ ('sample', 1) ])
+        self.assertEqual(package.pending_msgs, { ( ('sample', 1), ('sample', 7) ): [ 42 ] })
+
+    def test_busy_shard(self):
+        with mock.patch.object(shard, 'PACK_TIMEOUT', 0.2):
+            self.start_pool(2)
+            waiting = self.place('wait', 0, 1)
+            self.assertEqual(self.pool.snapshot()[1], { waiting })
+
+            spinning = self.place('spin', 1, 0, [ SPIN_LOOPS ])
+            time.sleep(0.1)
+            with self.assertRaises(ShardTimeout):
+                self.pool.snapshot()
+
+            # the shards skip what is left of the dropped snapshots
+            deadline = time.time() + 60
+            while True:
+                try:
+                    blobs, alive, in_flight = self.pool.snapshot()
+                    break
+                except ShardTimeout:
+                    self.assertLess(time.time(), deadline)
+
+        # after a dropped snapshot every thread is packed again
+        self.assertIn(waiting, blobs)
+        self.assertIn(waiting, alive)
+        if spinning in alive:
+            self.assertIn(spinning, blobs)
+        self.assertEqual(self.pool.snapshot()[0], { })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+SimpleScriptArray must behave like the dict it replaces, whichever form it
+is in: dense ints, a list, or sparse
+"""
+import pickle
+import random
+import unittest
+from array import array
+
+from gridvm.simplescript.runtime.ss_array import SimpleScriptArray
+
+OPERATIONS = 2000
+
+
+def form(values):
+    return type(values._items)
+
+def check(test, values, expected):
+    """ values holds what the dict 'expected' holds, and reads back the same """
+    test.assertEqual(len(values), len(expected))
+    test.assertEqual(dict(values.items()), expected)
+    for index, value in expected.items():
+        test.assertIn(index, values)
+        test.assertEqual(values[index], value)
+    if form(values) is not dict:
+        # dense, the items are a list in index order
+        test.assertEqual([ value for _, value in values.items() ],
+                [ expected[index] for index in range(len(expected)) ])
+
+def roundtrip(values):
+    return pickle.loads(pickle.dumps(values, pickle.HIGHEST_PROTOCOL))
+
+
+class SimpleScriptArrayTest(unittest.TestCase):
+    def test_dense(self):
+        values = SimpleScriptArray([ 5, 6 ])
+        values[2] = 7
+        values[0] = -1
+        self.assertIs(form(values), array)
+        check(self, values, { 0: -1, 1: 6, 2: 7 })
+
+    def test_dense_to_list(self):
+        values = SimpleScriptArray(range(3))
+        values[1] = 1.5
+        values[3] = 2 ** 64
+        self.assertIs(form(values), list)
+        check(self, values, { 0: 0, 1: 1.5, 2: 2, 3: 2 ** 64 })
+
+    def test_list_to_sparse(self):
+        values = SimpleScriptArray([ 0.5 ])
+        self.assertIs(form(values), list)
+        values[3] = 1
+        values[-1] = 2
+        self.assertIs(form(values), dict)
+        check(self, values, { 0: 0.5, 3: 1, -1: 2 })
+
+    def test_float_index(self):
+        values = SimpleScriptArray([ 10, 11 ])
+        values[1.0] = 12
+        self.assertEqual(values[1], 12)
+        self.assertEqual(values[1.0], 12)
+        self.assertIn(0.0, values)
+        self.assertIs(form(values), array)
+
+        values[0.5] = 13
+        self.assertIs(form(values), dict)
+        check(self, values, { 0: 10, 1: 12, 0.5: 13 })
+
+    def test_missing(self):
+        for values in (SimpleScriptArray([ 1 ]), SimpleScriptArray([ 1.5 ]),
+                SimpleScriptArray({ 5: 1 })):
+            with self.subTest(form=form(values)):
+                for index in (-1, 7, 0.5):
+                    self.assertNotIn(index, values)
+                    with self.assertRaises(KeyError):
+                        values[index]
+
+    def test_pickle(self):
+        for values in (SimpleScriptArray(), SimpleScriptArray([ 1, -2 ** 63 ]),
+                SimpleScriptArray([ 1, 2.5 ]), SimpleScriptArray({ 3: 4, -1: 0.5 })):
+            with self.subTest(form=form(values)):
+                copy = roundtrip(values)
+                self.assertIs(form(copy), form(values))
+                check(self, copy, dict(values.items()))
+
+    def test_random_operations(self):
+        rng = random.Random(9)
+        indexes = list(range(-2, 24)) + [ 1.0, 2.5 ]
+        plain = [ 0, -7, 2 ** 63 - 1, 2 ** 63, 1.5 ]
+        for trial in range(20):
+            values = SimpleScriptArray()
+            expected = { }
+            for _ in range(OPERATIONS // 20):
+                if rng.random() < 0.8:
+                    # mostly appends, so it stays dense for a while
+                    index = len(expected) if rng.random() < 0.9 else rng.choice(indexes)
+                    value = rng.choice(plain) if rng.random() < 0.05 else rng.randrange(100)
+                    values[index] = value
+                    expected[index] = value
+                else:
+                    values = roundtrip(values)
+                check(self, values, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()